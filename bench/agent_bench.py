@@ -0,0 +1,302 @@
+"""
+离线基准测试：不需要真实的 API Key 和 MCP 服务，测 MCPAgent 一轮对话的开销。
+
+按场景文件启动脚本化的 LLM 桩（bench/fake_llm.py）和若干 FastMCP 桩（bench/fake_mcp.py），然后依次测：
+    turn_latency    单个会话连续提问，每轮耗时的分位数（第一轮单独记为冷启动）
+    throughput      多个会话同时提问，每秒完成的轮数和延迟分位数
+    history_growth  单个会话聊很多轮，上下文 token 数、消息数和每轮耗时随轮数的变化
+
+结果是一个 JSON（附带 git commit），用 --json 保存；--compare 与之前保存的结果逐项对比，
+--fail-on-regression 让延迟类指标变慢超过给定百分比时返回非零，便于在不同提交之间比较。
+
+用法：
+    python bench/agent_bench.py --scenario bench/scenarios/tool_chain.json --json bench-results.json
+    python bench/agent_bench.py --compare bench-results.json --fail-on-regression 20
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from core.agent import MCPAgent  # noqa: E402
+from core.tracing import percentile  # noqa: E402
+
+BENCH = Path(__file__).resolve().parent
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_port(port: int, proc: subprocess.Popen, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"桩进程启动失败（退出码 {proc.returncode}）：{' '.join(proc.args)}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f"端口 {port} 在 {timeout} 秒内没有就绪")
+
+
+class Stubs:
+    """按场景启动 LLM 桩和 MCP 桩子进程，退出时全部结束"""
+
+    def __init__(self, scenario_path: Path, scenario: dict, latency_scale: float):
+        self.procs: list[subprocess.Popen] = []
+        self.endpoints: dict[str, str] = {}
+        self.base_url = ""
+        self._start(scenario_path, scenario, latency_scale)
+
+    def _spawn(self, args: list[str], port: int):
+        proc = subprocess.Popen([sys.executable, *args], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.procs.append(proc)
+        wait_port(port, proc)
+
+    def _start(self, scenario_path: Path, scenario: dict, latency_scale: float):
+        try:
+            for name, server in scenario["servers"].items():
+                port = free_port()
+                self._spawn([
+                    str(BENCH / "fake_mcp.py"), "--port", str(port),
+                    "--tools", ",".join(server["tools"]),
+                    "--latency-ms", str(server.get("latency_ms", 50) * latency_scale),
+                    "--jitter-ms", str(server.get("jitter_ms", 0) * latency_scale),
+                    "--payload-bytes", str(server.get("payload_bytes", 1000)),
+                ], port)
+                self.endpoints[name] = f"http://127.0.0.1:{port}/mcp"
+            port = free_port()
+            self._spawn([str(BENCH / "fake_llm.py"), "--scenario", str(scenario_path), "--port", str(port)], port)
+            self.base_url = f"http://127.0.0.1:{port}/v1"
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        for proc in self.procs:
+            proc.terminate()
+        for proc in self.procs:
+            try:
+                proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+
+def make_agent(stubs: Stubs, args, runtime=None, user_id: str = "bench") -> MCPAgent:
+    return MCPAgent(
+        endpoints=stubs.endpoints,
+        api_key="bench",
+        base_url=stubs.base_url,
+        model="bench",
+        default_ttl=60.0 if args.tool_cache else 0.0,  # 默认关掉工具缓存，每轮都真实调用
+        runtime=runtime,
+        user_id=user_id,
+    ).connect()
+
+
+def latency_stats(values: list[float]) -> dict:
+    return {
+        "count": len(values),
+        "mean_ms": round(sum(values) / len(values) * 1000, 1) if values else 0.0,
+        "p50_ms": round(percentile(values, 50) * 1000, 1),
+        "p95_ms": round(percentile(values, 95) * 1000, 1),
+        "p99_ms": round(percentile(values, 99) * 1000, 1),
+        "max_ms": round(max(values, default=0.0) * 1000, 1),
+    }
+
+
+def timed_ask(agent: MCPAgent, prompt: str) -> float:
+    start = time.perf_counter()
+    agent.ask(prompt, [])
+    return time.perf_counter() - start
+
+
+def bench_turn_latency(stubs: Stubs, args) -> dict:
+    agent = make_agent(stubs, args)
+    try:
+        cold = timed_ask(agent, "第 0 轮：请调用工具回答")
+        warm = [timed_ask(agent, f"第 {n} 轮：请调用工具回答") for n in range(1, args.turns)]
+    finally:
+        agent.close()
+    return {"cold_ms": round(cold * 1000, 1), **latency_stats(warm)}
+
+
+def bench_throughput(stubs: Stubs, args) -> dict:
+    runtime = None
+    if args.shared:
+        from core.runtime import SharedRuntime
+
+        runtime = SharedRuntime()
+    latencies, errors = [], []
+    lock = threading.Lock()
+    barrier = threading.Barrier(args.sessions + 1)
+
+    def session(index: int):
+        agent = make_agent(stubs, args, runtime, user_id=f"user-{index}")
+        barrier.wait()
+        try:
+            for n in range(args.session_turns):
+                try:
+                    elapsed = timed_ask(agent, f"会话 {index} 第 {n} 轮")
+                except Exception as e:
+                    with lock:
+                        errors.append(f"会话 {index} 第 {n} 轮：{e}")
+                    continue
+                with lock:
+                    latencies.append(elapsed)
+        finally:
+            agent.close()
+
+    threads = [threading.Thread(target=session, args=(i,), daemon=True) for i in range(args.sessions)]
+    for t in threads:
+        t.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    return {
+        "sessions": args.sessions,
+        "mode": "shared" if args.shared else "isolated",
+        "errors": len(errors),
+        "elapsed_s": round(elapsed, 3),
+        "turns_per_s": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        **latency_stats(latencies),
+    }
+
+
+def bench_history_growth(stubs: Stubs, args) -> dict:
+    agent = make_agent(stubs, args)
+    samples = []
+    try:
+        for n in range(args.growth_turns):
+            elapsed = timed_ask(agent, f"第 {n} 轮：请调用工具回答")
+            samples.append({
+                "turn": n,
+                "latency_ms": round(elapsed * 1000, 1),
+                "context_tokens": agent.context.total_tokens,
+                "messages": len(agent.context.messages),
+            })
+    finally:
+        agent.close()
+    window = max(1, min(10, len(samples) // 4))
+    head = [s["latency_ms"] for s in samples[:window]]
+    tail = [s["latency_ms"] for s in samples[-window:]]
+    return {
+        "turns": len(samples),
+        "max_context_tokens": max(s["context_tokens"] for s in samples),
+        "final_context_tokens": samples[-1]["context_tokens"],
+        "final_messages": samples[-1]["messages"],
+        "first_turns_mean_ms": round(sum(head) / len(head), 1),
+        "last_turns_mean_ms": round(sum(tail) / len(tail), 1),
+        "samples": samples,
+    }
+
+
+BENCHMARKS = {
+    "turn_latency": bench_turn_latency,
+    "throughput": bench_throughput,
+    "history_growth": bench_history_growth,
+}
+
+
+def git_meta() -> dict:
+    def git(*cmd):
+        try:
+            return subprocess.run(["git", *cmd], cwd=ROOT, capture_output=True, text=True, timeout=10).stdout.strip()
+        except (OSError, subprocess.TimeoutExpired):
+            return ""
+
+    return {"commit": git("rev-parse", "HEAD"), "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+
+def flatten(obj, prefix: str = "") -> dict[str, float]:
+    """把嵌套结果拍平成 "throughput.p95_ms" 这样的数值项；samples 之类的列表不参与对比"""
+    flat = {}
+    for key, value in obj.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(baseline: dict, current: dict, threshold: float | None) -> int:
+    """逐项打印变化；threshold 不为空时，耗时类（*_ms / *_s）变慢超过该百分比算回归"""
+    old, new = flatten(baseline["results"]), flatten(current["results"])
+    regressions = 0
+    print(f"\n对比基线 {baseline['meta'].get('commit', '')[:10]} → {current['meta'].get('commit', '')[:10]}")
+    for name in sorted(old.keys() & new.keys()):
+        before, after = old[name], new[name]
+        change = (after - before) / before * 100 if before else 0.0
+        slower = name.endswith(("_ms", "_s")) and threshold is not None and change > threshold
+        regressions += slower
+        print(f"  {'❌' if slower else '  '} {name:<40} {before:>12} → {after:>12} ({change:+.1f}%)")
+    return 1 if regressions else 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", default=str(BENCH / "scenarios" / "tool_chain.json"))
+    parser.add_argument("--only", choices=list(BENCHMARKS), action="append", help="只跑指定的项目，可重复")
+    parser.add_argument("--turns", type=int, default=20, help="turn_latency 的轮数")
+    parser.add_argument("--sessions", type=int, default=10, help="throughput 的并发会话数")
+    parser.add_argument("--session-turns", type=int, default=3, help="throughput 里每个会话的轮数")
+    parser.add_argument("--shared", action="store_true", help="throughput 使用多用户模式的 SharedRuntime")
+    parser.add_argument("--growth-turns", type=int, default=60, help="history_growth 的轮数")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="按比例缩放场景里的工具延迟")
+    parser.add_argument("--tool-cache", action="store_true", help="打开工具结果缓存（默认关闭）")
+    parser.add_argument("--json", help="把结果另存为 JSON 文件")
+    parser.add_argument("--compare", help="与之前保存的结果对比")
+    parser.add_argument("--fail-on-regression", type=float, help="耗时类指标变慢超过这个百分比时返回非零")
+    args = parser.parse_args()
+
+    scenario_path = Path(args.scenario).resolve()
+    scenario = json.loads(scenario_path.read_text(encoding="utf-8"))
+    stubs = Stubs(scenario_path, scenario, args.latency_scale)
+    results = {}
+    try:
+        for name in args.only or list(BENCHMARKS):
+            print(f"▶ {name} …", file=sys.stderr)
+            results[name] = BENCHMARKS[name](stubs, args)
+    finally:
+        stubs.close()
+
+    report = {
+        "meta": {
+            **git_meta(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "scenario": scenario_path.name,
+            "config": {k: v for k, v in vars(args).items() if k not in ("json", "compare", "fail_on_regression")},
+        },
+        "results": results,
+    }
+    summary = {name: {k: v for k, v in res.items() if k != "samples"} for name, res in results.items()}
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+        return compare(baseline, report, args.fail_on_regression)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,80 @@
+"""
+聊天记录重开耗时：往临时库里写一个 N 轮的会话，再按应用的方式只恢复最近一段，统计耗时。
+
+每轮包含用户提问、带工具调用的助手消息、工具结果（可选超过内联上限、存进 BlobStore）和最终回答。
+
+用法：
+    python bench/chat_reload.py --turns 1000 --restore-turns 20 --restore-messages 200
+"""
+import argparse
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from core.blob_store import BlobStore  # noqa: E402
+from core.chat_store import ChatStore  # noqa: E402
+from core.context import ContextManager  # noqa: E402
+
+
+def fill(store: ChatStore, session: str, turns: int, tool_bytes: int):
+    ui_seq = 0
+    for n in range(turns):
+        call = {"id": f"call-{n}", "type": "function", "function": {"name": "echo", "arguments": "{}"}}
+        store.append_llm(session, {"role": "user", "content": f"第 {n} 个问题"}, True)
+        store.append_llm(session, {"role": "assistant", "content": " ", "tool_calls": [call]}, False)
+        store.append_llm(session, {"role": "tool", "tool_call_id": call["id"], "content": "x" * tool_bytes}, False)
+        store.append_llm(session, {"role": "assistant", "content": f"第 {n} 个回答"}, False)
+        ui = [
+            {"role": "user", "text": f"第 {n} 个问题"},
+            {"role": "assistant", "success": "工具echo执行完毕"},
+            {"role": "assistant", "content": f"第 {n} 个回答"},
+        ]
+        store.append_ui(session, ui_seq, ui)
+        ui_seq += len(ui)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=1000)
+    parser.add_argument("--tool-bytes", type=int, default=8000, help="每条工具结果的大小，超过 4096 时存进 BlobStore")
+    parser.add_argument("--restore-turns", type=int, default=20)
+    parser.add_argument("--restore-messages", type=int, default=200)
+    parser.add_argument("--json", help="把结果另存为 JSON 文件")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        blob_store = BlobStore(Path(tmp) / "blobs")
+        store = ChatStore(Path(tmp) / "chats.sqlite", blob_store)
+        start = time.perf_counter()
+        fill(store, "bench", args.turns, args.tool_bytes)
+        write_s = time.perf_counter() - start
+
+        # 模拟进程重启：新建 ChatStore，缓存全部失效
+        store = ChatStore(Path(tmp) / "chats.sqlite", blob_store)
+        start = time.perf_counter()
+        saved = store.ui_count("bench")
+        ui = store.load_ui("bench", max(0, saved - args.restore_messages), saved)
+        context = ContextManager()
+        context.set_system("system")
+        context.restore(store.load_llm_turns("bench", args.restore_turns))
+        reload_s = time.perf_counter() - start
+
+    result = {
+        "turns": args.turns,
+        "write_s": round(write_s, 3),
+        "reload_ms": round(reload_s * 1000, 2),
+        "ui_messages": len(ui),
+        "llm_messages": len(context.messages),
+    }
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if args.json:
+        Path(args.json).write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding="utf-8")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,105 @@
+"""
+OpenAI 兼容的脚本化 LLM 桩（/v1/chat/completions 流式 + /v1/models），按场景文件回放工具调用序列。
+
+场景文件（JSON）里与本桩有关的字段：
+    ttft_ms   首个 chunk 之前的等待
+    chunk_ms  之后每个 chunk 的间隔
+    steps     一轮对话里模型依次给出的回复，例如
+              [{"content": "我先查一下。", "tool_calls": [{"name": "web_search", "arguments": {"query": "a"}}]},
+               {"content": "结论……"}]
+回复的选取是无状态的：数一数最后一条用户消息之后已经有几条 assistant 消息，就回放第几步，
+因此多个会话并发请求也互不干扰。步数用完后返回最后一步的文本。
+
+用法：
+    python bench/fake_llm.py --scenario bench/scenarios/tool_chain.json --port 8940
+"""
+import argparse
+import asyncio
+import json
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+TEXT_PIECE = 8  # 文本按这么多字符切成一个 chunk
+
+
+def _chunk(delta: dict, finish_reason=None) -> dict:
+    return {
+        "id": "bench", "object": "chat.completion.chunk", "created": 0, "model": "bench",
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+def pick_step(steps: list[dict], messages: list[dict]) -> dict:
+    last_user = max((i for i, m in enumerate(messages) if m.get("role") == "user"), default=-1)
+    replied = sum(1 for m in messages[last_user + 1:] if m.get("role") == "assistant")
+    if replied < len(steps):
+        return steps[replied]
+    return {"content": steps[-1].get("content") or "（场景已结束）"}
+
+
+def step_chunks(step: dict, turn_key: int) -> list[dict]:
+    content = step.get("content") or ""
+    chunks = [_chunk({"role": "assistant", "content": content[i:i + TEXT_PIECE]})
+              for i in range(0, len(content), TEXT_PIECE)]
+    for n, call in enumerate(step.get("tool_calls") or []):
+        chunks.append(_chunk({"tool_calls": [{
+            "index": n,
+            "id": f"call-{turn_key}-{n}",
+            "type": "function",
+            "function": {"name": call["name"], "arguments": json.dumps(call.get("arguments") or {}, ensure_ascii=False)},
+        }]}))
+    chunks.append(_chunk({}, "tool_calls" if step.get("tool_calls") else "stop"))
+    return chunks
+
+
+def build_app(scenario: dict) -> Starlette:
+    steps = scenario["steps"]
+    ttft = scenario.get("ttft_ms", 50) / 1000
+    gap = scenario.get("chunk_ms", 5) / 1000
+
+    async def chat(request):
+        body = await request.json()
+        messages = body["messages"]
+        chunks = step_chunks(pick_step(steps, messages), len(messages))
+        if (body.get("stream_options") or {}).get("include_usage"):
+            prompt_tokens = len(json.dumps(messages, ensure_ascii=False)) // 4
+            chunks.append({
+                "id": "bench", "object": "chat.completion.chunk", "created": 0, "model": "bench", "choices": [],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(chunks),
+                          "total_tokens": prompt_tokens + len(chunks), "prompt_tokens_details": {"cached_tokens": 0}},
+            })
+
+        async def sse():
+            await asyncio.sleep(ttft)
+            for n, chunk in enumerate(chunks):
+                if n:
+                    await asyncio.sleep(gap)
+                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(sse(), media_type="text/event-stream")
+
+    async def models(request):
+        return JSONResponse({"object": "list", "data": [{"id": "bench", "object": "model"}]})
+
+    return Starlette(routes=[
+        Route("/v1/chat/completions", chat, methods=["POST"]),
+        Route("/v1/models", models),
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", required=True)
+    parser.add_argument("--port", type=int, default=8940)
+    args = parser.parse_args()
+    with open(args.scenario, encoding="utf-8") as f:
+        scenario = json.load(f)
+    uvicorn.run(build_app(scenario), host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""
+FastMCP 桩服务：按名字注册若干工具，每个工具等待固定延迟（加随机抖动）后返回指定大小的文本。
+用来在没有真实 MCP 服务的情况下测 Agent 的工具调用开销。
+
+用法：
+    python bench/fake_mcp.py --port 8001 --tools web_search,fetch_page --latency-ms 150 --jitter-ms 50 --payload-bytes 4000
+"""
+import argparse
+import asyncio
+import json
+import random
+
+from fastmcp import FastMCP
+
+
+def make_tool(name: str, latency_ms: float, jitter_ms: float, payload_bytes: int):
+    async def tool(query: str = "") -> str:
+        await asyncio.sleep(max(0.0, latency_ms + random.uniform(-jitter_ms, jitter_ms)) / 1000)
+        head = json.dumps({"tool": name, "query": query}, ensure_ascii=False)
+        return head + "x" * max(0, payload_bytes - len(head))
+
+    tool.__name__ = name
+    tool.__doc__ = f"基准测试用的桩工具 {name}：按 query 返回固定大小的文本"
+    return tool
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, required=True)
+    parser.add_argument("--tools", default="echo", help="逗号分隔的工具名")
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--payload-bytes", type=int, default=1000)
+    args = parser.parse_args()
+
+    mcp = FastMCP("bench")
+    for name in args.tools.split(","):
+        mcp.tool(make_tool(name.strip(), args.latency_ms, args.jitter_ms, args.payload_bytes), name=name.strip())
+    mcp.run(transport="streamable-http", host="127.0.0.1", port=args.port, show_banner=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+client.py 冷启动导入耗时检查。
+
+解析 client.py 顶层的 import 语句，在全新的子进程里用 `python -X importtime` 执行一遍，
+输出最耗时的模块，并检查：
+- torch / pandas / unstructured 等重依赖没有在顶层被导入（它们应当在用到时才导入）；
+- 顶层导入的总耗时不超过阈值。
+任一检查失败时以非 0 状态码退出，可以直接放进 CI。
+
+用法：
+    python bench/import_time.py [--max-ms 800] [--top 15]
+"""
+import argparse
+import ast
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+CLIENT = ROOT / "client.py"
+
+# 这些包不允许出现在 client.py 的顶层导入链里
+FORBIDDEN = ("torch", "pandas", "unstructured")
+
+
+def top_level_imports(path: Path) -> list[str]:
+    """client.py 模块顶层（不含函数体内）的 import 语句源码"""
+    source = path.read_text(encoding="utf-8")
+    tree = ast.parse(source)
+    stmts = []
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            stmts.append(ast.get_source_segment(source, node))
+    return stmts
+
+
+def measure(stmts: list[str]) -> list[tuple[int, int, str]]:
+    """返回 [(self_us, cumulative_us, 模块名), ...]，模块名保留 importtime 的缩进层级"""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "\n".join(stmts)],
+        cwd=ROOT,
+        env={**os.environ, "PYTHONPATH": str(ROOT)},
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"导入失败：\n{proc.stderr[-2000:]}")
+
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        rows.append((int(self_us), int(cumulative_us), name.rstrip()[1:]))  # 去掉 "|" 后面的一个空格
+    return rows
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--max-ms", type=float, default=float(os.getenv("IMPORT_TIME_BUDGET_MS", "800")),
+                        help="顶层导入总耗时上限（毫秒）")
+    parser.add_argument("--top", type=int, default=15, help="列出耗时最多的前 N 个顶层包")
+    args = parser.parse_args(argv)
+
+    stmts = top_level_imports(CLIENT)
+    rows = measure(stmts)
+
+    # importtime 里没有缩进的行就是被直接导入的顶层包，它们的 cumulative 之和即总耗时
+    roots = [(cum, name.strip()) for _, cum, name in rows if not name.startswith(" ")]
+    total_ms = sum(cum for cum, _ in roots) / 1000
+    loaded = {name.strip() for _, _, name in rows}
+
+    print(f"client.py 顶层导入 {len(stmts)} 条语句，共 {total_ms:.0f} ms")
+    for cum, name in sorted(roots, reverse=True)[:args.top]:
+        print(f"  {cum / 1000:8.1f} ms  {name}")
+
+    failures = []
+    for pkg in FORBIDDEN:
+        if pkg in loaded or any(m.startswith(pkg + ".") for m in loaded):
+            failures.append(f"{pkg} 在顶层被导入，应改为用到时再导入")
+    if total_ms > args.max_ms:
+        failures.append(f"导入耗时 {total_ms:.0f} ms 超过上限 {args.max_ms:.0f} ms")
+
+    for msg in failures:
+        print(f"❌ {msg}")
+    if not failures:
+        print("✅ 导入耗时检查通过")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+"""
+多用户负载测试：模拟 N 个会话同时提问，统计每轮对话的延迟分位数。
+
+每个会话在自己的线程里建一个 MCPAgent（与 Streamlit 会话一致），连续提问若干轮。
+--mode shared 使用多用户模式的 SharedRuntime（共享事件循环、连接池和并发限制），
+--mode isolated 则是默认的每会话独立资源，便于对比。
+
+LLM 与 MCP 服务可以指向真实服务，也可以指向本地的桩（bench/fake_llm.py、bench/fake_mcp.py）；
+不想手动起桩时用 bench/agent_bench.py。
+
+用法：
+    python bench/load_test.py --base-url http://127.0.0.1:8940/v1 --mcp-url http://127.0.0.1:8000/mcp \\
+        --sessions 20 --turns 3 --mode shared
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from core.agent import MCPAgent  # noqa: E402
+from core.tracing import percentile  # noqa: E402
+
+
+def run_session(index: int, args, runtime, latencies: list, errors: list, barrier: threading.Barrier):
+    agent = MCPAgent(
+        endpoints={"bench_server": args.mcp_url},
+        api_key=args.api_key,
+        base_url=args.base_url,
+        model=args.model,
+        runtime=runtime,
+        user_id=f"user-{index}",
+    ).connect()
+    barrier.wait()  # 所有会话建好后同时开始，模拟并发高峰
+    try:
+        for turn in range(args.turns):
+            start = time.perf_counter()
+            try:
+                agent.ask(f"{args.prompt}（会话 {index} 第 {turn + 1} 轮）", [])
+            except Exception as e:
+                errors.append(f"会话 {index} 第 {turn + 1} 轮：{e}")
+                continue
+            latencies.append(time.perf_counter() - start)
+    finally:
+        agent.close()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default=os.getenv("GOOGLE_BASE_URL", "http://127.0.0.1:8940/v1"))
+    parser.add_argument("--api-key", default=os.getenv("GOOGLE_API_KEY", "bench"))
+    parser.add_argument("--model", default="gemini-2.5-flash")
+    parser.add_argument("--mcp-url", default="http://127.0.0.1:8000/mcp")
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--prompt", default="请调用工具回答这个问题")
+    parser.add_argument("--mode", choices=["shared", "isolated"], default="shared")
+    parser.add_argument("--max-llm", type=int, default=16)
+    parser.add_argument("--max-llm-per-user", type=int, default=2)
+    parser.add_argument("--max-tools", type=int, default=32)
+    parser.add_argument("--max-tools-per-user", type=int, default=4)
+    parser.add_argument("--json", help="把结果另存为 JSON 文件")
+    args = parser.parse_args()
+
+    runtime = None
+    if args.mode == "shared":
+        from core.runtime import SharedRuntime
+
+        runtime = SharedRuntime(
+            max_llm=args.max_llm, max_llm_per_user=args.max_llm_per_user,
+            max_tools=args.max_tools, max_tools_per_user=args.max_tools_per_user,
+        )
+
+    latencies, errors = [], []
+    barrier = threading.Barrier(args.sessions + 1)
+    threads = [
+        threading.Thread(target=run_session, args=(i, args, runtime, latencies, errors, barrier), daemon=True)
+        for i in range(args.sessions)
+    ]
+    for t in threads:
+        t.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    result = {
+        "mode": args.mode,
+        "sessions": args.sessions,
+        "turns": args.turns,
+        "completed": len(latencies),
+        "errors": len(errors),
+        "elapsed_s": round(elapsed, 3),
+        "turns_per_s": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "p50_s": round(percentile(latencies, 50), 3),
+        "p95_s": round(percentile(latencies, 95), 3),
+        "p99_s": round(percentile(latencies, 99), 3),
+        "max_s": round(max(latencies, default=0.0), 3),
+    }
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    for msg in errors[:10]:
+        print(f"❌ {msg}")
+    if args.json:
+        Path(args.json).write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding="utf-8")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,32 +1,25 @@
 import types
-try:
-    import torch
-
-    # 伪造一个“类包路径对象”，满足监视器 list(module.__path__._path) 的要求
-    class _FakePath(list):
-        @property
-        def _path(self):       # 必须带 _path
-            return []          # 空列表即可
-
-    torch.classes.__path__ = _FakePath()
-except ImportError:
-    pass
-import asyncio, os, json
+import os, json
 from dotenv import load_dotenv, set_key, dotenv_values
 from pathlib import Path
-from openai import OpenAI
-from fastmcp import Client
-from fastmcp.client.transports import StreamableHttpTransport
-from copy import deepcopy
 import streamlit as st
 import time
-import datetime
 from pathlib import Path
 import base64
-import pandas as pd
 import re
-from unstructured.partition.pdf import partition_pdf
+import uuid
 from typing import List
+from functools import partial
+from core.blob_store import BlobStore
+from core.catalog import ToolCatalog
+from core.chat_store import ChatStore
+from core.context import count_text_tokens
+from core.ingest import PDF_STRATEGIES, PDFIngestor
+from core.images import ImagePreprocessor
+from core.media import MediaPublisher, media_key
+from core.retrieval import SEARCH_TOOL_NAME, DocumentIndex, format_chunks
+from core.tracing import Tracer
+from core.turn_budget import describe
 
 ENV_PATH = Path(__file__).with_name(".env")  # 100% 指向当前脚本所在目录
 WINPATH_RE = re.compile(r'^([A-Za-z]):[\\/](.*)')
@@ -47,339 +40,295 @@ def to_container_path(path: str) -> str:
     return f"/mnt/{drive.lower()}/{rest}"
 
 
-def tools_to_gemini(tool):
-    return {
-        "type": "function",
-        "function": {
-            "name": tool.name,
-            "description": tool.description,
-            "parameters": tool.inputSchema,  # ← 字段改名！
-        },
-    }
-
-
-def tools_to_openrouter(tool):
-    """
-    将 MCP / 自定义工具描述转换为 OpenRouter (OpenAI-compatible) 的
-    Chat-Function-Calling 工具格式。
-    """
-    # ---------- 1️⃣ 基础准备 ----------
-    # • deepcopy 防止原始 schema 被我们就地修改
-    # • schema 不一定含有 "type" / "properties" / "required" 键，需要兜底
-    raw = deepcopy(tool.inputSchema) or {}
-
-    schema = {
-        "type": "object",
-        # 如果原 schema 已经给出了 properties/required 就直接拿过来，否则给默认空字典/列表
-        "properties": raw.get("properties", {}),
-        "required": raw.get("required", []),
-    }
-
-    # ---------- 2️⃣ 为每个字段补全类型 ----------
-    # 遵循 JSON-Schema Draft-07（OpenAI / OpenRouter 要求）
-    for prop_name, prop_schema in schema["properties"].items():
-        if "type" not in prop_schema:
-            # 如果用户没写 type，默认按 string 处理
-            prop_schema["type"] = "string"
-
-        # 如果字段本身声明的是数组，但忘了 items，也要补上
-        if prop_schema["type"] == "array" and "items" not in prop_schema:
-            prop_schema["items"] = {"type": "string"}
-
-    # ---------- 3️⃣ 组装最终工具描述 ----------
-    return {
-        "type": "function",
-        "function": {
-            "name": tool.name,  # 函数名
-            "description": tool.description,  # 描述
-            "parameters": schema,  # 完整 JSON-Schema
-        },
-    }
-
-
-def stream_data(answer):
-    for word in answer.split(" "):
-        yield word + " "
-        time.sleep(0.1)
-
-
-def get_task():
-    # 找到当前文件所在目录
-    base_dir = Path(__file__).resolve().parent
-    # 拼出 JSON 文件的完整路径
-    json_path = base_dir / "Tasklist" / "Task.json"
-    # 读取并解析
-    with json_path.open("r", encoding="utf-8") as f:
-        tasks = json.load(f)
-
-    if not tasks:
-        return "用户还未创建任何的定时任务"
-
-    # 3. 拼接文本
-    lines = []
-    for idx, task in enumerate(tasks, start=1):
-        name = task.get("TaskName", "")
-        desc = task.get("Description", "")
-        sched = task.get("Schedule", "")
-        time = task.get("Time", "")
-        date = task.get("Date", "")
-
-        lines.append(f"任务{idx}：{name}")
-        lines.append(f"任务描述: {desc}")
-
-        # 根据 daily/once 分别处理
-        if sched == "daily":
-            lines.append(f"调度方式: 每日 {time} 执行一次")
-        elif sched == "once":
-            lines.append(f"调度方式: 在 {date} 的 {time} 执行一次")
-        else:
-            # 如果有其他类型，直接原样输出
-            lines.append(f"调度方式: {sched} {date} {time}")
-
-        # 分隔线
-        if idx != len(tasks):
-            lines.append("========================")
-
-    # 4. 合并并输出
-    result = "\n".join(lines)
-    return result
-
-
-TASK = get_task()
-
-
-SYSTEM_MESSAGE = f"""
-现在的时间是：{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}。
-在此之前用户有可能创建了一系列的定时或每日自动执行的脚本任务，任务的内容如下：
-
-{TASK}
-
-你是一名严格遵守步骤的 AI 助手，当前可用工具有：
+def _clear_on_first(deltas, placeholder):
+    """第一段文本到达时清掉占位提示"""
+    for i, delta in enumerate(deltas):
+        if i == 0:
+            placeholder.empty()
+        yield delta
+
+
+@st.cache_resource
+def get_media_publisher() -> MediaPublisher | None:
+    """开启了 server.enableStaticServing 时，图片 / GIF 走静态文件服务"""
+    if not st.get_option("server.enableStaticServing"):
+        return None
+    app_dir = Path(__file__).resolve().parent
+    # 静态目录无需登录即可访问：只发布本应用目录（上传文件、videos_to_gifs 等）和 MEDIA_ALLOWED_DIRS 下的文件，
+    # 其他路径照常显示但不进静态目录；发布的文件和聊天记录一样在 CHAT_RETENTION_DAYS 天后清理
+    extra = [p for p in os.getenv("MEDIA_ALLOWED_DIRS", "").split(os.pathsep) if p.strip()]
+    retention_days = float(os.getenv("CHAT_RETENTION_DAYS", "30"))
+    return MediaPublisher(
+        app_dir / "static",
+        max_bytes=int(os.getenv("STATIC_MEDIA_MAX_MB", "512")) << 20,
+        allowed_roots=[app_dir, *map(Path, extra)],
+        max_age=retention_days * 86400 or None,
+    )
 
-{{TOOLS}}
 
-================== 任务说明 ==================
-🔹 **第一步：判断用户意图是否明确**
+@st.cache_resource
+def get_dataset_cache():
+    """进程级表格预览缓存：csv / xlsx 第一次展示时转成 parquet"""
+    from core.dataframe_preview import DatasetCache  # pyarrow 较重，展示表格时才导入
 
-1. **已明确**  
-   - 如果用户输入已经包含清晰的目标、操作对象和期望结果  
-     （如：“请帮我上网搜查比特币实时价格并把结果保存到 data/bitcoin.json”），  
-     直接进入 *第二步·工作流*。
+    return DatasetCache(
+        Path(__file__).resolve().parent / "cache" / "datasets",
+        max_bytes=int(os.getenv("DATAFRAME_CACHE_MAX_MB", "2048")) << 20,
+    )
 
-2. **不明确**  
-   - 如果用户输入含糊或信息不足  
-     （如仅输入“比特币”或“保存”），请先：  
-     • 参考你能调用的工具，推测用户最可能的需求；  
-     • 用一句简洁的中文向用户**先确认需求**，并顺带说明你能执行的选项，格式示例：  
-       “请问您是想要 **___(推测的需求)___** 吗？如果是，我可以帮助你先**__(做的事情)__**,然后.....”  
-     • 等待并读取用户的补充或确认；  
-     • 只有在目标变得明确后，才进入 *第二步·工作流*。
 
-🔹 **第二步：工作流**
+def render_dataframe(ref: dict, view: str | None = None):
+    """
+    按引用预览表格：只读选中的列和前若干行。
+    历史记录里（view 不为空）可以选择列、点“加载更多”；对话进行中只显示第一页，避免点击控件打断这一轮。
+    """
+    page = int(os.getenv("DATAFRAME_PAGE_ROWS", "1000"))
+    max_columns = int(os.getenv("DATAFRAME_MAX_COLUMNS", "50"))
+    columns = ref["columns"][:max_columns]
+    limit = page
+    if view is not None:
+        limit = st.session_state.get(f"df-{view}-rows", page)
+        if len(ref["columns"]) > 1:
+            with st.expander(f"📋 {ref['name']}：选择要显示的列"):
+                columns = st.multiselect("列", ref["columns"], default=columns, key=f"df-{view}-cols")
+    try:
+        table = get_dataset_cache().preview(ref, columns=columns or None, limit=limit)
+    except (OSError, ValueError) as e:
+        # parquet 缓存被清理、源文件也已经移走时，历史记录照常显示，只是这张表看不了了
+        st.warning(f"无法显示表格 {ref['name']}：{e}")
+        return
+    st.dataframe(table)
+    st.caption(f"显示前 {table.num_rows} / {ref['rows']} 行 · {table.num_columns} / {len(ref['columns'])} 列")
+    if view is not None and table.num_rows < ref["rows"]:
+        st.button(
+            f"加载更多（再读 {page} 行）", key=f"df-{view}-more",
+            on_click=lambda: st.session_state.update({f"df-{view}-rows": limit + page}),
+        )
 
-1. 当任务需要工具时，先用中文说明【整体计划】；  
-   例如：“好的，我将先查询温哥华的天气，然后把结果保存成 weather.json。”  
-2. **同一条消息**里仅 **调用一个** tool（一次只能调用一个 tool）。  
-3. 获得工具返回值后：  
-   - 用中文总结当前进展，并决定下一步；  
-   - 若还需其他工具，重复步骤 1–2；  
-   - 若已完成所有步骤，则给出最终总结并结束。
 
-⚠️ **禁止** 跳过步骤，也不要在一条消息里触发多个互相关联的工具。
-"""
+@st.cache_resource
+def get_image_preprocessor() -> ImagePreprocessor:
+    """进程级图片预处理器，结果按内容哈希缓存，所有会话共享"""
+    return ImagePreprocessor(
+        max_side=int(os.getenv("IMAGE_MAX_SIDE", "1536")),
+        quality=int(os.getenv("IMAGE_WEBP_QUALITY", "80")),
+    )
 
 
-class MCPAgent:
-    def __init__(self, endpoints: dict[str, str], api_key: str, base_url: str, model: str):
-        self.endpoints = endpoints
+@st.cache_resource(max_entries=32)
+def _gif_data_uri(path: str, mtime_ns: int, size: int) -> str:
+    # 没有静态服务时的退路：同一个文件版本只编码一次，重跑时直接复用
+    with open(path, "rb") as f:
+        b64 = base64.b64encode(f.read()).decode("utf-8")
+    return f"data:image/gif;base64,{b64}"
+
+
+def render_gif(path: str) -> bool:
+    """显示成功返回 True；文件读不到时显示一条警告并返回 False"""
+    publisher = get_media_publisher()
+    src = publisher.url(path) if publisher else None
+    if src is None and re.match(r"https?://", path):
+        src = path
+    if src is None:
+        try:
+            src = _gif_data_uri(*media_key(path))
+        except OSError as e:
+            # 聊天记录会被持久化，文件不在了也不能让整段历史渲染失败
+            st.warning(f"无法显示动画 {path}：{e.strerror or e}")
+            return False
+    st.markdown(f'<img src="{src}" alt="动画">', unsafe_allow_html=True)
+    return True
+
+
+def render_image(path: str, width: int, suffix: str | None = None) -> bool:
+    """显示成功返回 True；本地文件不存在时显示一条警告并返回 False"""
+    publisher = get_media_publisher()
+    src = publisher.url(path, suffix) if publisher else None
+    if src is None and not re.match(r"https?://", path) and not os.path.isfile(path):
+        st.warning(f"无法显示图片 {path}：文件不存在")
+        return False
+    st.image(src or path, width=width)
+    return True
+
+
+def render_frontend_tool(name: str, args: dict) -> tuple[str, list[dict]]:
+    """在脚本线程里执行前端工具，返回 (tool 消息内容, 需要追加给模型的额外消息)"""
+    extra_msgs = []
+    if name == "show_image_frontend":
+        image_path = args["image_path"].strip('"').strip("'")
+        # image_path = to_container_path(image_path)
+        if not render_image(image_path, width=300):
+            return json.dumps({"error": f"图片 {image_path} 不存在"}, ensure_ascii=False), extra_msgs
+        st.session_state.messages.append({"role": "assistant", "image": image_path})
+        return "图片展示成功", extra_msgs
+    elif name == "show_video_frontend":
+        video_path = args["video_path"].strip('"').strip("'")
+        # video_path = to_container_path(video_path)
+        st.video(video_path)
+        st.session_state.messages.append({"role": "assistant", "video": video_path})
+        return "视频展示成功", extra_msgs
+    elif name == "show_dataframe_frontend":
+        dataframe_path = args["dataframe_path"].strip('"').strip("'")
+        path = str(dataframe_path)
+        # path = to_container_path(path)
+        try:
+            with st.spinner(f"正在读取表格 {Path(path).name}…"):
+                ref = get_dataset_cache().open(path)  # 第一次打开时转成 parquet，之后直接复用
+        except (ValueError, OSError) as e:
+            # 路径错误、文件不存在或格式不对：作为工具结果交给模型处理，而不是中断整轮对话
+            return json.dumps({"error": f"无法展示表格：{e}"}, ensure_ascii=False), extra_msgs
+        render_dataframe(ref)
+        # 聊天记录里只保存引用；view 区分同一张表的多次展示，作为控件 key
+        st.session_state.messages.append({"role": "assistant", "dataframe": ref, "view": uuid.uuid4().hex[:12]})
+        columns = ", ".join(ref["columns"][:50]) + ("…" if len(ref["columns"]) > 50 else "")
+        return f"表格展示成功：共 {ref['rows']} 行 {len(ref['columns'])} 列，列名：{columns}", extra_msgs
+    elif name == "show_gif_frontend":
+        gif_path = args["gif_path"].strip('"').strip("'")
+        if not render_gif(str(gif_path)):
+            return json.dumps({"error": f"无法读取 gif 文件 {gif_path}"}, ensure_ascii=False), extra_msgs
+        st.session_state.messages.append({"role": "assistant", "gif": gif_path})
+        return "gif图展示成功", extra_msgs
+    elif name == "read_image_file":
+        image_path2 = args["path"].strip('"').strip("'")
+
+        try:
+            with open(image_path2, "rb") as f:
+                image_part = get_image_preprocessor().image_part(f.read())
+        except (OSError, ValueError) as e:  # 文件读不到 / 不是能解码的图片
+            return json.dumps({"error": f"无法读取图片：{e}"}, ensure_ascii=False), extra_msgs
+
+        extra_msgs.append({
+            "role": "user",
+            "content": [{"type": "text", "text": "图片内容如下:"}, image_part]
+        })
+        return "图片读取成功，内容见下一条消息", extra_msgs
+
+
+def _reply_deltas(events, waiting, received: list):
+    """
+    从事件流里取出本次回复的文本增量，直到回复结束；等待期间在“思考中”的位置显示已等待的秒数和重试提示。
+    收到的增量同时记进 received，回复中途出错时已经显示的部分不会丢。
+    """
+    start, note, streaming = time.monotonic(), "🤔 正在思考中，请稍候…", False
+    for kind, data in events:
+        if kind == "delta":
+            streaming = True
+            received.append(data["text"])
+            yield data["text"]
+        elif kind == "llm_retry":
+            note = (f"⚠️ 模型请求失败（{str(data['error']) or type(data['error']).__name__}），"
+                    f"{data['delay']:.1f} 秒后第 {data['attempt']} 次重试…")
+            waiting.caption(note)
+        elif kind == "tick":
+            # 每次刷新界面，Streamlit 都有机会响应“停止”按钮
+            if streaming:
+                waiting.empty()
+            else:
+                waiting.caption(f"{note}（{time.monotonic() - start:.0f} 秒）")
+        elif kind == "llm_end":
+            return
 
-        self.llm = OpenAI(
-            base_url=base_url,
-            api_key=api_key
-        )
-        self.model = model
-
-        self.tools = []
-        self.tool_to_server = {}
-        self.tool_desc = ""
-
-        self.history = []
-
-    async def connect(self):
-        pulls = []
-        for server, url in self.endpoints.items():
-            async with Client(StreamableHttpTransport(url)) as cli:
-                tools = await cli.list_tools()
-                pulls.append((server, tools))
-
-        for server, tools in pulls:
-            for t in tools:
-                if t.name in self.tool_to_server:
-                    raise ValueError(f"存在重复的函数名{t.name}")
-                self.tools.append(tools_to_gemini(t))  # 随时切换
-                self.tool_to_server[t.name] = server
-
-            joint = "\n".join(f"  - {t.name} —— {t.description}" for t in tools)
-            self.tool_desc += f"\n 【{server}】\n {joint} \n"
-            # print(self.tool_desc)
-
-        self.history = [
-            {"role": "system", "content": SYSTEM_MESSAGE.replace("{TOOLS}", self.tool_desc)}
-        ]
-        return self
-
-    def ask(self, user_msg: str, image_list: List[dict]):
-        if image_list:
-            self.history.append(
-                {
-                    "role": "user",
-                    "content": [{"type": "text", "text": user_msg}] + image_list
-                }
-            )
-        else:
-            self.history.append(
-                {"role": "user", "content": user_msg}
-            )
 
-        while True:
-            with st.spinner("🤔 正在思考中，请稍候…", show_time=True):
-                choice = self.llm.chat.completions.create(
-                    model=self.model,
-                    reasoning_effort="high",
-                    messages=self.history,
-                    tools=self.tools,
-                    tool_choice="auto"
-                ).choices[0]
-
-            if choice.finish_reason != "tool_calls":
-                self.history.append(choice.message)
-                return choice.message.content
-
-            assistant_msg = choice.message
-            safe_assistant = {
-                "role": "assistant",
-                "tool_calls": assistant_msg.tool_calls,
-                # content 可能是 None / ""，一律替换成占位符
-                "content": assistant_msg.content or " ",
-            }
-            self.history.append(safe_assistant)
-
-            intro = (assistant_msg.content or "").strip()
+def cancel_turn():
+    """
+    “停止”按钮的回调。点击会让 Streamlit 中断正在执行的脚本，ask_events() 随之取消后台这一轮
+    （包括还在执行的 MCP 请求）；这里只需在聊天记录里留一条说明。
+    """
+    if st.session_state.get("turn_running"):
+        st.session_state.turn_running = False
+        st.session_state.messages.append({"role": "assistant", "content": "⏹ 已停止本轮回答"})
+
+
+def render_turn(agent, user_msg: str, image_list: List[dict], question: str) -> str:
+    """消费 agent.ask_events() 的事件并渲染到当前聊天气泡里，返回最终回复；question 是用户输入的原文"""
+    # 事件之间最多隔 0.5 秒刷新一次界面，卡住的工具也不会让“停止”按钮失灵
+    events = agent.ask_events(user_msg, image_list, tick=0.5, question=question)
+    stop = st.empty()
+    stop.button("⏹ 停止", key="cancel_turn_btn", on_click=cancel_turn)
+    beat = st.empty()
+    st.session_state.turn_running = True
+    intro, received = "", []
+    try:
+        for kind, data in events:
+            if kind == "tick":
+                beat.empty()
+                continue
+            if kind == "llm_start":
+                waiting = st.empty()
+                waiting.caption("🤔 正在思考中，请稍候…")
+                # 文本增量实时渲染；第一段文字到达时撤掉“思考中”提示
+                written = st.write_stream(_clear_on_first(_reply_deltas(events, waiting, received), waiting))
+                waiting.empty()
+                intro, received = (written.strip() if isinstance(written, str) else ""), []
+                continue
+            if kind == "done":
+                stop.empty()
+                st.session_state.turn_running = False
+                return data["content"]
+
+            # 后面跟着工具调用，说明刚才那段文字是调用前的说明，需要留在聊天记录里
             if intro:
-                st.write(intro)
                 st.session_state.messages.append({"role": "assistant", "content": intro})
-
-            call = choice.message.tool_calls[0]
-            name = call.function.name
-            args = json.loads(call.function.arguments)
-
-            if name == "show_image_frontend":
-                image_path = args["image_path"].strip('"').strip("'")
-                # image_path = to_container_path(image_path)
-                st.image(image_path,width=300)
-                self.history.append({
-                    "role": "tool",
-                    "tool_call_id": call.id,  # ← 一定要填 call.id
-                    "name": name,  # ← 有些版本需要 name 字段
-                    "content": "图片展示成功"
-                })
-
-                st.session_state.messages.append({"role": "assistant", "image": image_path})
-            elif name == "show_video_frontend":
-                video_path = args["video_path"].strip('"').strip("'")
-                # video_path = to_container_path(video_path)
-                st.video(video_path)
-                self.history.append({
-                    "role": "tool",
-                    "tool_call_id": call.id,  # ← 一定要填 call.id
-                    "name": name,  # ← 有些版本需要 name 字段
-                    "content": "视频展示成功"
-                })
-
-                st.session_state.messages.append({"role": "assistant", "video": video_path})
-            elif name == "show_dataframe_frontend":
-                with st.container():
-                    dataframe_path = args["dataframe_path"].strip('"').strip("'")
-                    path = str(dataframe_path)
-                    # path = to_container_path(path)
-                    if path.lower().endswith(".csv"):
-                        df = pd.read_csv(path)
-                        st.dataframe(df)
-                        st.session_state.messages.append({"role": "assistant", "dataframe": df})
-                    elif path.lower().endswith((".xls", ".xlsx")):
-                        df = pd.read_excel(path, sheet_name=0)
-                        st.dataframe(df)
-                        st.session_state.messages.append({"role": "assistant", "dataframe": df})
-                    else:
-                        raise ValueError("无法展示表格")
-                    self.history.append({
-                        "role": "tool",
-                        "tool_call_id": call.id,  # ← 一定要填 call.id
-                        "name": name,  # ← 有些版本需要 name 字段
-                        "content": "表格展示成功"
-                    })
-            elif name == "show_gif_frontend":
-                gif_path = args["gif_path"].strip('"').strip("'")
-                path = str(gif_path)
-                with open(path, "rb") as f:
-                    gif_bytes = f.read()
-                b64 = base64.b64encode(gif_bytes).decode("utf-8")
-                st.markdown(
-                    f'<img src="data:image/gif;base64,{b64}" alt="动画">',
-                    unsafe_allow_html=True
-                )
-                st.session_state.messages.append({"role": "assistant", "gif": gif_path})
-                self.history.append({
-                    "role": "tool",
-                    "tool_call_id": call.id,  # ← 一定要填 call.id
-                    "name": name,  # ← 有些版本需要 name 字段
-                    "content": "gif图展示成功"
-                })
-            elif name =="read_image_file":
-                image_path2 = args["path"].strip('"').strip("'")
-
-                def encode_image_to_data_uri(image_path: str) -> str:
-                    # 先猜一下文件的 MIME 类型
-                    mime_type, _ = mimetypes.guess_type(image_path)
-                    if mime_type is None:
-                        # 如果猜不出来，就用扩展名简单拼一个
-                        ext = os.path.splitext(image_path)[1].lstrip('.').lower()
-                        mime_type = f"image/{ext}"
-
-                    # 读文件并做 base64 编码
-                    with open(image_path, "rb") as f:
-                        data = f.read()
-                    b64 = base64.b64encode(data).decode('utf-8')
-
-                    # 拼成 Data URI
-                    return f"data:{mime_type};base64,{b64}"
-                data_uri = encode_image_to_data_uri(image_path2)
-
-                self.history.append({
-                    "role": "user",
-                    "content": [{"type": "text", "text": "图片内容如上:"},
-                                {"type": "image_url", "image_url": {"url": data_uri,"detail": "auto"}}]
-                })
-            else:
-                with st.spinner(f"正在执行工具{name}", show_time=True):
-                    server_name = self.tool_to_server[name]
-                    url = self.endpoints[server_name]
-
-                    async def _run_once():
-                        async with Client(StreamableHttpTransport(url)) as cli:
-                            return await cli.call_tool(name, args)
-
-                    result = asyncio.run(_run_once())  # 保证 ask() 仍然是同步接口
-                    # result 现在一定是 str / dict / bool … 可以被 JSON 序列化
-
-                    self.history.append({
-                        "role": "tool",
-                        "tool_call_id": call.id,  # ← 一定要填 call.id
-                        "name": name,  # ← 有些版本需要 name 字段
-                        "content": json.dumps(result, ensure_ascii=False, default=str)
-                    })
-                st.success(f"工具{name}执行完毕")
-                st.session_state.messages.append({"role": "assistant", "success": f"工具{name}执行完毕"})
+                intro = ""
+            if kind == "tool_wait":
+                name = data["name"]
+                limit = f"（上限 {data['timeout']:g} 秒）" if data.get("timeout") else ""
+                with st.spinner(f"正在执行工具{name}{limit}", show_time=True):
+                    kind, data = next(events)
+                    while kind == "tick":
+                        beat.empty()
+                        kind, data = next(events)
+                if kind == "tool_done":
+                    st.success(f"工具{name}执行完毕")
+                    st.session_state.messages.append({"role": "assistant", "success": f"工具{name}执行完毕"})
+                else:
+                    st.error(f"工具{name}执行失败：{data['error']}")
+                    st.session_state.messages.append({"role": "assistant", "content": f"❌ 工具{name}执行失败：{data['error']}"})
+            elif kind == "budget_warning":
+                st.caption(f"⏳ 本轮{describe(data['budget'], data['used'], data['limit'])}，已提醒模型尽快收尾")
+            elif kind == "budget_exhausted":
+                note = f"⛔ 本轮{describe(data['budget'], data['used'], data['limit'])}，已达上限，停止调用工具并直接作答"
+                st.warning(note)
+                st.session_state.messages.append({"role": "assistant", "content": note})
+            elif kind == "frontend":
+                content, extra_msgs = render_frontend_tool(data["name"], data["args"])
+                data["reply"](content, extra_msgs)
+    except Exception as e:
+        # 重试 / 对冲都失败或回复中途断开：保留已经显示的部分，错误作为本轮回复留在聊天记录里
+        st.session_state.turn_running = False  # 出错不是用户停止的，之后误点“停止”不应留下记录
+        stop.empty()
+        partial = intro or "".join(received).strip()
+        if partial:
+            st.session_state.messages.append({"role": "assistant", "content": partial})
+        note = f"❌ 本轮回答出错：{str(e) or type(e).__name__}"
+        st.error(note)
+        return note
+
+
+def evict_agent():
+    """让旧 Agent 失效，并关闭它持有的 MCP 长连接"""
+    old = st.session_state.pop("agent", None)
+    if old is not None:
+        old.close()
+
+
+def delete_chat():
+    """删除当前会话的聊天记录（释放它占用的上传文件和大段消息），换成一个新会话"""
+    state = st.session_state
+    chat_store = get_chat_store()
+    publisher = get_media_publisher()
+    if publisher is not None:
+        # 这个会话展示过的图片 / GIF 从公开的静态目录撤下
+        for msg in chat_store.load_ui(state.chat_id, 0, chat_store.ui_count(state.chat_id)):
+            if "image" in msg or "gif" in msg:
+                publisher.unpublish(msg.get("image") or msg["gif"], msg.get("suffix"))
+    chat_store.delete(state.chat_id)
+    evict_agent()  # 模型历史随会话一起清空
+    for key in ("messages", "msg_groups", "documents_restored"):
+        state.pop(key, None)
+    state.documents = DocumentIndex()  # 已上传文档的检索索引也随会话删除
+    state.chat_id = uuid.uuid4().hex
+    chat_store.claim(state.chat_id, state.user_id)
 
 
 # ① 先把 .env 读进来（如果文件不存在等会儿再创建）
@@ -394,48 +343,92 @@ AVAILABLE_SERVICES = {
         "url": "http://127.0.0.1:8000/mcp",
         "needs_key": False,
         "env_var": None,  # 不需要则填 None
+        # 按工具名配置的选项：
+        #   serial=True  有副作用，不能和同批次的其他工具并发执行
+        #   cache=False  结果永不缓存，执行后清空所有工具的缓存
+        #   ttl=秒数      结果缓存时长；只给只读工具配置，未配置的按 TOOL_CACHE_TTL（默认 0，不缓存）
+        #   timeout=秒数  单次调用的截止时间，覆盖服务级的 timeout
+        "tool_options": {
+            "read_file": {"ttl": 30},
+            "read_multiple_files": {"ttl": 30},
+            "list_directory": {"ttl": 30},
+            "search_files": {"ttl": 30},
+            "get_file_info": {"ttl": 30},
+            "write_file": {"serial": True, "cache": False},
+            "edit_file": {"serial": True, "cache": False},
+            "create_directory": {"serial": True, "cache": False},
+            "move_file": {"serial": True, "cache": False},
+            "delete_path": {"serial": True, "cache": False},
+        },
     },
     "谷歌地图": {
         "endpoint": "googlemap_server",
         "url": "http://127.0.0.1:8001/mcp",
         "needs_key": True,  # 需要额外 Key
         "env_var": "GOOGLE_MAPS_API_KEY",
+        "tool_options": {
+            "query_search": {"ttl": 600},
+        },
     },
     "高德地图服务": {
         "endpoint": "amap_server",
         "url": "http://127.0.0.1:8002/mcp",
         "needs_key": True,  # 需要额外 Key
         "env_var": "AMAP_API_KEY",
+        "tool_options": {
+            "keyword_search": {"ttl": 600},
+            "get_amap_driving_route": {"ttl": 300},
+            "get_amap_transit_route": {"ttl": 300},
+        },
     },
     "BiliBili服务": {
         "endpoint": "bilibili_server",
         "url": "http://127.0.0.1:8003/mcp",
         "needs_key": False,  # 需要额外 Key
         "env_var": None,
+        "tool_options": {
+            "search_and_enrich": {"ttl": 300},
+        },
     },
     "代码执行服务": {
         "endpoint": "code_executed_server",
         "url": "http://127.0.0.1:8004/mcp",
         "needs_key": False,  # 需要额外 Key
         "env_var": None,
+        "timeout": 120,  # 本服务所有工具的截止秒数，未配置时用 TOOL_TIMEOUT
+        "tool_options": {
+            "python_code_execution": {"serial": True, "cache": False},
+        },
     },
     "虚拟货币数据服务": {
         "endpoint": "CoinMarketCap_server",
         "url": "http://127.0.0.1:8005/mcp",
         "needs_key": True,  # 需要额外 Key
         "env_var": "COINMARKETCAP_API_KEY",
+        "tool_options": {
+            "get_cryptos_data": {"ttl": 60},
+            "get_specify_crypto": {"ttl": 60},
+        },
     },
     "图片生成服务": {
         "endpoint": "Draw_server",
         "url": "http://127.0.0.1:8006/mcp",
         "needs_key": False,  # 需要额外 Key
         "env_var": None,
+        "timeout": 180,
+        "tool_options": {
+            "draw_image": {"cache": False},
+        },
     },
     "视频爬取服务": {
         "endpoint": "ScrapVideo_server",
         "url": "http://127.0.0.1:8007/mcp",
         "needs_key": False,  # 需要额外 Key
         "env_var": None,
+        "timeout": 300,  # 下载视频本来就慢
+        "tool_options": {
+            "download_videos": {"cache": False},
+        },
     },
     "Streamlit前端渲染服务": {
         "endpoint": "streamlit_server",
@@ -448,24 +441,39 @@ AVAILABLE_SERVICES = {
         "url": "http://127.0.0.1:8009/mcp",
         "needs_key": False,  # 需要额外 Key
         "env_var": None,
+        "timeout": 60,  # 浏览器卡在某个页面时不要一直等下去
+        "tool_options": {
+            "search_and_analyse": {"ttl": 300},
+        },
     },
     "youtube视频服务": {
         "endpoint": "youtube_server",
         "url": "http://127.0.0.1:8010/mcp",
         "needs_key": True,  # 需要额外 Key
         "env_var": "YOUTUBE_API_KEY",
+        "tool_options": {
+            "search_videos_with_stats": {"ttl": 300},
+        },
     },
     "定时任务服务":{
         "endpoint":"mornitor_server",
         "url":"http://127.0.0.1:8011/mcp",
         "needs_key": True,  # 需要额外 Key
         "env_var": "PUSHDEER_API_KEY",
+        "tool_options": {
+            "create_search_task": {"serial": True, "cache": False},
+            "sent_phone_task": {"serial": True, "cache": False},
+            "delete_task": {"serial": True, "cache": False},
+        },
     },
     "视频处理服务":{
         "endpoint":"mornitor_server",
         "url":"http://127.0.0.1:8012/mcp",
         "needs_key": False,  # 需要额外 Key
         "env_var": None,
+        "tool_options": {
+            "mp4_to_gif_ffmpeg": {"cache": False, "timeout": 300},
+        },
     }
 
     # 下面想开哪个就放哪个，同理添加
@@ -501,7 +509,7 @@ with st.sidebar:
             ENV_PATH.touch(exist_ok=True)
             set_key(ENV_PATH, "GOOGLE_API_KEY", api_input.strip(),quote_mode="never")
             load_dotenv(ENV_PATH, override=True)
-            st.session_state.pop("agent", None)
+            evict_agent()
             st.success("Gemini Key 已保存 ✅")
             st.rerun()
         else:
@@ -555,10 +563,31 @@ with st.sidebar:
             else:
                 st.session_state["selected_services"] = chosen
                 load_dotenv(ENV_PATH, override=True)  # 重新加载全部 Key
-                st.session_state.pop("agent", None)  # 使旧 Agent 失效
+                evict_agent()  # 使旧 Agent 失效
                 st.success("服务配置已保存 ✅")
                 st.rerun()
 
+    # ---------- C. 工具调用方式 ----------
+    st.toggle(
+        "⚡ 允许一次调用多个工具",
+        key="parallel_tools",
+        help="开启后提示模型把互不依赖的工具调用放在同一条消息里，并发执行以减少往返次数",
+        on_change=evict_agent,  # 系统提示词变了，需要重建 Agent
+    )
+
+    # ---------- D. 上传文件解析方式 ----------
+    st.selectbox(
+        "📄 PDF 解析方式",
+        options=list(PDF_STRATEGIES),
+        format_func=PDF_STRATEGIES.get,
+        key="pdf_strategy",
+        help="快速模式直接读取 PDF 自带的文本层；扫描件、复杂版面请选高精度",
+    )
+
+    # ---------- E. 聊天记录 ----------
+    st.button("🗑 删除当前会话", key="delete_chat_btn", on_click=delete_chat,
+              help="删除本会话保存的聊天记录和附件，开始一个新会话")
+
 # ───── 3. 生成 endpoints 字典（放 Sidebar 之后、build_agent 之前） ─────
 if "selected_services" not in st.session_state:
     st.session_state["selected_services"] = ["文件系统服务", "Streamlit前端渲染服务"]
@@ -571,43 +600,249 @@ if not endpoints:
     st.sidebar.warning("至少勾选一个服务才能启动聊天 🚦")
     st.stop()
 
+tool_options = {}
+for lbl in st.session_state["selected_services"]:
+    tool_options.update(AVAILABLE_SERVICES[lbl].get("tool_options", {}))
+server_timeouts = {
+    AVAILABLE_SERVICES[lbl]["endpoint"]: AVAILABLE_SERVICES[lbl]["timeout"]
+    for lbl in st.session_state["selected_services"]
+    if "timeout" in AVAILABLE_SERVICES[lbl]
+}
+
+
+@st.cache_resource
+def get_ingestor() -> PDFIngestor:
+    """进程级 PDF 解析进程池 + 磁盘缓存，所有会话共享"""
+    workers = os.getenv("INGEST_WORKERS")
+    return PDFIngestor(
+        Path(__file__).resolve().parent / "cache" / "ingest",
+        max_workers=int(workers) if workers else None,
+    )
+
+
+@st.cache_resource
+def get_blob_store() -> BlobStore:
+    """进程级上传文件存储，相同内容只存一份"""
+    return BlobStore(
+        Path(__file__).resolve().parent / "cache" / "blobs",
+        max_bytes=int(os.getenv("BLOB_STORE_MAX_MB", "1024")) << 20,
+    )
+
+
+@st.cache_resource
+def get_chat_store() -> ChatStore:
+    """进程级聊天记录存储；会话 id 放在 URL 的 ?chat= 里，刷新或重启后可以接着聊"""
+    return ChatStore(
+        Path(__file__).resolve().parent / "cache" / "chats.sqlite", get_blob_store(),
+        # 超过这么多天没有更新的会话连同附件一起删除，0 表示永久保留
+        retention_days=float(os.getenv("CHAT_RETENTION_DAYS", "30")),
+    )
+
 
-def build_agent(api_key: str, endpoints: dict):
+@st.cache_resource
+def get_tracer() -> Tracer:
+    """进程级 tracing：span 写到 TRACE_DIR（默认 logs/）下的 JSONL，设为空字符串则只在内存里统计"""
+    directory = os.getenv("TRACE_DIR", str(Path(__file__).resolve().parent / "logs"))
+    return Tracer(directory or None)
+
+
+@st.cache_resource
+def get_tool_catalog() -> ToolCatalog:
+    """进程级工具目录，所有会话共享；新标签页 / 改配置时不必重新 list_tools"""
+    return ToolCatalog()
+
+
+def multi_user_mode() -> bool:
+    """MULTI_USER_MODE=1 时所有会话共享事件循环、连接池，并受统一的并发限制"""
+    return os.getenv("MULTI_USER_MODE", "").lower() in ("1", "true", "yes")
+
+
+@st.cache_resource
+def get_runtime():
+    from core.runtime import SharedRuntime
+
+    return SharedRuntime(
+        max_llm=int(os.getenv("LLM_MAX_CONCURRENCY", "16")),
+        max_llm_per_user=int(os.getenv("LLM_MAX_CONCURRENCY_PER_USER", "2")),
+        max_tools=int(os.getenv("TOOL_MAX_CONCURRENCY", "32")),
+        max_tools_per_user=int(os.getenv("TOOL_MAX_CONCURRENCY_PER_USER", "4")),
+    )
+
+
+def build_agent(api_key: str, endpoints: dict, tool_options: dict, parallel_prompt: bool,
+                local_tools: dict, user_id: str, chat_id: str, server_timeouts: dict):
+    from core.agent import MCPAgent  # openai / fastmcp 较重，侧边栏渲染出来之后再导入
     model_name = "gemini-2.5-flash"
     endpoints = endpoints
     base_url = os.getenv("GOOGLE_BASE_URL")
 
-    agent = asyncio.run(
-        MCPAgent(
-            endpoints=endpoints,
-            model=model_name,
-            api_key=api_key,
-            base_url=base_url,
-        ).connect()
-    )
+    agent = MCPAgent(
+        endpoints=endpoints,
+        model=model_name,
+        api_key=api_key,
+        base_url=base_url,
+        tool_options=tool_options,
+        parallel_prompt=parallel_prompt,
+        context_budget=int(os.getenv("CONTEXT_TOKEN_BUDGET", "60000")),
+        max_tool_tokens=int(os.getenv("TOOL_RESULT_TOKEN_LIMIT", "6000")),
+        cache_size=int(os.getenv("TOOL_CACHE_SIZE", "256")),
+        default_ttl=float(os.getenv("TOOL_CACHE_TTL", "0")),
+        local_tools=local_tools,
+        runtime=get_runtime() if multi_user_mode() else None,
+        user_id=user_id,
+        tool_top_k=int(os.getenv("TOOL_ROUTER_TOP_K", "12")),
+        compact_tools=os.getenv("TOOL_DESCRIPTOR_MODE", "compact") == "compact",
+        llm_timeout=float(os.getenv("LLM_FIRST_CHUNK_TIMEOUT", "120")),
+        llm_idle_timeout=float(os.getenv("LLM_IDLE_TIMEOUT", "60")),
+        llm_max_retries=int(os.getenv("LLM_MAX_RETRIES", "3")),
+        hedge=os.getenv("LLM_HEDGE", "").lower() in ("1", "true", "yes"),
+        journal=partial(get_chat_store().append_llm, chat_id, owner=user_id),
+        tracer=get_tracer(),
+        server_timeouts=server_timeouts,
+        tool_timeout=float(os.getenv("TOOL_TIMEOUT", "120")) or None,  # 0 表示不限
+        # 每轮对话的上限，防止模型陷在工具循环里；0 表示不限，用到 TURN_BUDGET_WARN 时提醒模型收尾
+        max_steps=int(os.getenv("TURN_MAX_STEPS", "12")),
+        max_turn_tokens=int(os.getenv("TURN_MAX_TOKENS", "300000")),
+        max_turn_seconds=float(os.getenv("TURN_MAX_SECONDS", "600")),
+        budget_warn_ratio=float(os.getenv("TURN_BUDGET_WARN", "0.8")),
+    ).connect(catalog=get_tool_catalog())
+    # 只把最近几轮放回模型历史，更早的对话留在库里
+    agent.restore_history(get_chat_store().load_llm_turns(chat_id, int(os.getenv("CHAT_RESTORE_TURNS", "20"))))
     return agent
 
 
 # ───────────────── 主流程 ─────────────────
+# 本会话上传文档的检索索引；Agent 重建（改配置）时保留
+if "documents" not in st.session_state:
+    st.session_state.documents = DocumentIndex()
+# 多用户模式下按会话做并发限制与公平排队
+if "user_id" not in st.session_state:
+    st.session_state.user_id = uuid.uuid4().hex
+# 聊天记录按 URL 里的 ?chat= 持久化；没有就开一个新会话
+chat_store = get_chat_store()
+if "chat_id" not in st.session_state:
+    st.session_state.chat_id = st.query_params.get("chat") or uuid.uuid4().hex
+    # 同一个链接在多个标签页打开时，最后打开的负责写入；其他标签页再发消息会 fork 成新会话
+    chat_store.claim(st.session_state.chat_id, st.session_state.user_id)
+st.session_state.chat_id = chat_store.resolve(st.session_state.chat_id, st.session_state.user_id)
+st.query_params["chat"] = st.session_state.chat_id
+
 if "agent" not in st.session_state:
     key_in_env = os.getenv("GOOGLE_API_KEY", "")
     if key_in_env:  # ✅ 已有 KEY，安全初始化
-        st.session_state.agent = build_agent(key_in_env, endpoints)
+        st.session_state.agent = build_agent(
+            key_in_env, endpoints, tool_options, st.session_state.get("parallel_tools", False),
+            st.session_state.documents.as_tools(), st.session_state.user_id, st.session_state.chat_id,
+            server_timeouts,
+        )
     else:  # ❌ 还没有 KEY，提示用户去填
         st.info("请在左侧填写 GOOGLE_API_KEY 后点击保存再开始聊天")
         st.stop()  # 终止本次执行，等待用户输入
 
 agent = st.session_state.agent
 
-# 初始化聊天历史记录
+for server in agent.sync_servers():
+    st.sidebar.success(f"✅ {server} 的工具列表已更新")
+for server, err in agent.unreachable.items():
+    st.sidebar.warning(f"⚠️ {server} 暂时无法连接，正在后台重试：{err}")
+st.sidebar.caption(f"🧠 上下文约 {agent.context.total_tokens} / {agent.context.budget} tokens")
+st.sidebar.caption(f"🗃 工具缓存：命中 {agent.cache.hits} · 未命中 {agent.cache.misses} · 条目 {len(agent.cache)}")
+if agent.turn_tools and len(agent.turn_tools) < len(agent.tools):
+    st.sidebar.caption(f"🧰 上一轮发送了 {len(agent.turn_tools)} / {len(agent.tools)} 个工具")
+if agent.runtime is not None:
+    stats = agent.runtime.stats()
+    st.sidebar.caption(
+        f"👥 多用户模式：LLM 执行中 {stats['llm_running']} · 排队 {stats['llm_waiting']}；"
+        f"工具执行中 {stats['tools_running']} · 排队 {stats['tools_waiting']}"
+    )
+if agent.usage["prompt_tokens"]:
+    cached_ratio = agent.usage["cached_tokens"] / agent.usage["prompt_tokens"]
+    st.sidebar.caption(
+        f"💾 提示词缓存：命中 {agent.usage['cached_tokens']} / {agent.usage['prompt_tokens']} 输入 tokens"
+        f"（{cached_ratio:.0%}，共 {agent.usage['requests']} 次请求）"
+    )
+
+latency = agent.resilient.stats.snapshot()
+if latency["requests"]:
+    st.sidebar.caption(
+        f"⏱ 模型首字延迟 p50 {latency['ttft_p50']:.1f}s · p95 {latency['ttft_p95']:.1f}s · p99 {latency['ttft_p99']:.1f}s；"
+        f"重试 {latency['retries']} · 超时 {latency['timeouts']} · 对冲 {latency['hedges']}（胜出 {latency['hedge_wins']}）"
+    )
+
+# 按模型 / 工具统计的耗时，最慢的排在前面，用来定位是哪个服务拖慢了对话
+trace_rows = get_tracer().summary()
+if trace_rows:
+    with st.sidebar.expander("📊 耗时统计（全进程最近的请求）"):
+        st.markdown(
+            "| 类型 | 模型 / 工具 | 次数 | 失败 | p50 | p95 |\n|---|---|---:|---:|---:|---:|\n"
+            + "\n".join(
+                f"| {r['name']} | {r['key']} | {r['count']} | {r['errors']} | {r['p50_ms']:.0f}ms | {r['p95_ms']:.0f}ms |"
+                for r in trace_rows
+            )
+        )
+
+# 初始化聊天历史记录；重开的会话只从库里读最近的一段
 if "messages" not in st.session_state:
-    st.session_state.messages = []
+    saved = chat_store.ui_count(st.session_state.chat_id)
+    first = max(0, saved - int(os.getenv("CHAT_RESTORE_MESSAGES", "200")))
+    st.session_state.messages = chat_store.load_ui(st.session_state.chat_id, first, saved)
+    st.session_state.ui_first = first  # messages[0] 在库里的序号
+    st.session_state.ui_saved = saved  # 已写入库的消息数
+
+
+def persist_messages(trim: bool = False):
+    """把还没写入的界面消息追加到库里；trim=True 时内存里只保留最近的一段"""
+    state = st.session_state
+    pending = state.messages[state.ui_saved - state.ui_first:]
+    if pending:
+        chat_id = chat_store.append_ui(state.chat_id, state.ui_saved, pending, owner=state.user_id)
+        state.ui_saved += len(pending)
+        if chat_id != state.chat_id:  # 会话被别的标签页接管，这边的记录 fork 到了新会话
+            state.chat_id = st.query_params["chat"] = chat_id
+    overflow = len(state.messages) - int(os.getenv("CHAT_MEMORY_MESSAGES", "500"))
+    if trim and overflow > 0:
+        del state.messages[:overflow]
+        state.ui_first += overflow
+
+
+# 上一次运行如果中途出错，没来得及写入的消息在这里补上
+persist_messages()
+
+# 上传的文件放在进程共享的 BlobStore；本会话持有的引用在会话结束时释放
+blob_store = get_blob_store()
+if "blobs" not in st.session_state:
+    st.session_state.blobs = blob_store.session()
+blobs = st.session_state.blobs
+
+
+def restore_documents():
+    """重开的会话用聊天记录里保存的上传文件重建检索索引，否则模型看得到历史里的文档却检索不到"""
+    state = st.session_state
+    state.documents_restored = True
+    uploads = [msg["download"] for msg in state.messages if "download" in msg]
+    for upload in uploads:
+        name = upload["file_name"]
+        try:
+            data = blob_store.read(upload["blob"])
+        except OSError:
+            continue  # 文件已被清理，只能让用户重新上传
+        if name.lower().endswith("pdf"):
+            # 上传时解析过的 PDF 直接读解析缓存
+            with st.spinner(f"📑 正在恢复 {name} 的检索索引…"):
+                text = get_ingestor().extract([data], strategy=state.get("pdf_strategy", "fast"))[0]
+        else:
+            text = data.decode("utf-8")
+        state.documents.add(name, text)
+
 
+if not st.session_state.get("documents_restored") and not len(st.session_state.documents):
+    restore_documents()
 
-def group_by_role(messages):
-    """把相邻、角色相同的消息合成一个分组。"""
-    groups = []
-    for msg in messages:
+
+def group_by_role(messages, groups=None, start=0):
+    """把相邻、角色相同的消息合成一个分组；传入已有的 groups 时只处理 messages[start:]"""
+    groups = [] if groups is None else groups
+    for msg in messages[start:]:
         if groups and groups[-1]["role"] == msg["role"]:
             groups[-1]["messages"].append(msg)
         else:
@@ -615,40 +850,77 @@ def group_by_role(messages):
     return groups
 
 
-# 先做分组
-grouped_msgs = group_by_role(st.session_state.messages)
+def message_groups() -> list[dict]:
+    """分组结果缓存在会话里，每次运行只给新追加的消息分组；前面的消息变了（裁剪 / 加载更早的）才重建"""
+    state = st.session_state
+    cache = state.get("msg_groups")
+    if cache is None or cache["first"] != state.ui_first or cache["count"] > len(state.messages):
+        cache = {"first": state.ui_first, "count": 0, "groups": []}
+    group_by_role(state.messages, cache["groups"], cache["count"])
+    cache["count"] = len(state.messages)
+    state.msg_groups = cache
+    return cache["groups"]
+
+
+RENDER_GROUPS = int(os.getenv("CHAT_RENDER_GROUPS", "20"))
+if "render_groups" not in st.session_state:
+    st.session_state.render_groups = RENDER_GROUPS
+
+
+def load_earlier():
+    """多显示 RENDER_GROUPS 组；内存里的消息不够时从库里再读一段"""
+    state = st.session_state
+    state.render_groups += RENDER_GROUPS
+    if len(message_groups()) < state.render_groups and state.ui_first > 0:
+        start = max(0, state.ui_first - int(os.getenv("CHAT_RESTORE_MESSAGES", "200")))
+        state.messages[:0] = chat_store.load_ui(state.chat_id, start, state.ui_first)
+        state.ui_first = start
+
+
+# 只渲染最近的若干组，会话再长每次运行的开销也不变
+grouped_msgs = message_groups()
+if len(grouped_msgs) > st.session_state.render_groups or st.session_state.ui_first > 0:
+    st.button("⬆️ 加载更早的消息", on_click=load_earlier, key="load_earlier_btn")
 
 # 再逐组渲染
-for group in grouped_msgs:
-    role = group["role"]
-    with st.chat_message(role):
-        for msg in group["messages"]:
-            if msg.get("image"):
-                st.image(msg["image"],width=200)
-            elif msg.get("video"):
-                st.video(msg["video"])
-            elif msg.get("text"):
-                st.markdown(msg["text"])
-            elif msg.get("content"):
-                st.markdown(msg["content"])
-            elif msg.get("success"):
-                st.success(msg["success"])
-            elif msg.get("download"):  # ← 新增
-                meta = msg["download"]
-                st.download_button(
-                    label=meta["label"],
-                    data=meta["data"],
-                    file_name=meta["file_name"],
-                    mime=meta["mime"],
-                )
-            elif msg.get("gif"):
-                with open(msg["gif"], "rb") as f:
-                    gif_bytes = f.read()
-                b64 = base64.b64encode(gif_bytes).decode("utf-8")
-                st.markdown(
-                    f'<img src="data:image/gif;base64,{b64}" alt="动画">',
-                    unsafe_allow_html=True
-                )
+with get_tracer().span("ui.render_history", key="history", groups=min(len(grouped_msgs), st.session_state.render_groups)):
+    for group in grouped_msgs[-st.session_state.render_groups:]:
+        role = group["role"]
+        with st.chat_message(role):
+            for msg in group["messages"]:
+                if msg.get("image"):
+                    render_image(msg["image"], width=200, suffix=msg.get("suffix"))
+                elif msg.get("video"):
+                    st.video(msg["video"])
+                elif msg.get("text"):
+                    st.markdown(msg["text"])
+                elif msg.get("content"):
+                    st.markdown(msg["content"])
+                elif msg.get("success"):
+                    st.success(msg["success"])
+                elif msg.get("download"):  # ← 新增
+                    meta = msg["download"]
+                    st.download_button(
+                        label=meta["label"],
+                        data=partial(blob_store.read, meta["blob"]),  # 点击下载时才从磁盘读取
+                        file_name=meta["file_name"],
+                        mime=meta["mime"],
+                    )
+                elif msg.get("gif"):
+                    render_gif(msg["gif"])
+                elif msg.get("dataframe"):
+                    render_dataframe(msg["dataframe"], view=msg["view"])
+
+
+def attach_download(label: str, file_bytes: bytes, file_name: str, mime: str):
+    """上传的文件存进 BlobStore，聊天记录里只保存 digest"""
+    digest = blobs.put(file_bytes)
+    st.download_button(label=label, data=partial(blob_store.read, digest), file_name=file_name, mime=mime)
+    st.session_state.messages.append({
+        "role": "user",
+        "download": {"label": label, "blob": digest, "file_name": file_name, "mime": mime},
+    })
+
 
 if prompt := st.chat_input(
         "ask any question or upload image or file",
@@ -657,6 +929,8 @@ if prompt := st.chat_input(
 ):
     full_prompt = ""
     data_uri_list = []
+    pdf_uploads = []  # (序号, 文件名, 内容)，统一交给进程池并行解析
+    new_docs = []  # (序号, 文件名, 正文)，短文档直接放进提示词，长文档只放检索到的片段
 
     if prompt and prompt["files"]:
         for i, uploaded in enumerate(prompt["files"]):
@@ -665,94 +939,34 @@ if prompt := st.chat_input(
             uploaded.seek(0)
 
             if name.endswith(("jpg", "jpeg", "png")):
-                base64_str = base64.b64encode(file_bytes).decode("utf-8")
-                data_uri = f"data:{uploaded.type};base64,{base64_str}"
-                data_uri_list.append({"type": "image_url", "image_url": {"url": data_uri,"detail": "auto"}})
+                # 缩放、转 WEBP、去元数据后再发给模型
+                try:
+                    data_uri_list.append(get_image_preprocessor().image_part(file_bytes))
+                except ValueError as e:
+                    st.warning(f"图片 {uploaded.name} 无法识别，已忽略：{e}")
+                    continue
+                # 聊天记录里只留磁盘路径和 digest，不再持有 UploadedFile
+                digest = blobs.put(file_bytes)
+                image_path = str(blobs.store.path(digest))
+                suffix = Path(name).suffix  # blob 文件没有扩展名，静态服务要靠它决定 Content-Type
                 with st.chat_message("user"):
-                    st.image(uploaded, width=200)
-                st.session_state.messages.append({"role": "user", "image": uploaded})
+                    render_image(image_path, width=200, suffix=suffix)
+                st.session_state.messages.append({"role": "user", "image": image_path, "suffix": suffix, "blob": digest})
             elif name.endswith("pdf"):
-                elements = partition_pdf(file=uploaded)
-                # 把所有段落拼成一个大字符串
-                text = "\n\n".join(
-                    e.text for e in elements
-                    if hasattr(e, "text") and e.text.strip()
-                )
-                st.download_button(
-                    label=f"📑 {uploaded.name}",
-                    data=file_bytes,
-                    file_name=uploaded.name,
-                    mime="application/pdf",
-                )
-                # —— 把同样的元数据塞到聊天历史 ——
-                st.session_state.messages.append({
-                    "role": "user",
-                    "download": {  # 这里的键名随便取，只要你自己识别得出来
-                        "label": f"📑 {uploaded.name}",
-                        "data": file_bytes,
-                        "file_name": uploaded.name,
-                        "mime": "application/pdf",
-                    }
-                })
-
-                full_prompt += f"\n用户上传的第{i}个文档内容如下：\n\n{text}"
+                pdf_uploads.append((i, uploaded.name, file_bytes))
+                attach_download(f"📑 {uploaded.name}", file_bytes, uploaded.name, "application/pdf")
             elif name.endswith("py"):
                 code = file_bytes.decode("utf-8")
-                st.download_button(
-                    label=f"🐍 {uploaded.name}",
-                    data=file_bytes,
-                    file_name=uploaded.name,
-                    mime="text/x-python",
-                )
-                # —— 把同样的元数据塞到聊天历史 ——
-                st.session_state.messages.append({
-                    "role": "user",
-                    "download": {  # 这里的键名随便取，只要你自己识别得出来
-                        "label": f"📑 {uploaded.name}",
-                        "data": file_bytes,
-                        "file_name": uploaded.name,
-                        "mime": "application/pdf",
-                    }
-                })
-                full_prompt += f"\n用户上传的第{i}个文档内容如下：\n\n{code}"
+                attach_download(f"🐍 {uploaded.name}", file_bytes, uploaded.name, "text/x-python")
+                new_docs.append((i, uploaded.name, code))
             elif name.endswith("md"):
                 md = file_bytes.decode("utf-8")
-                full_prompt += f"\n用户上传的第{i}个文档内容如下：\n\n{md}"
-                st.download_button(
-                    label=f"📝 {uploaded.name}",
-                    data=file_bytes,
-                    file_name=uploaded.name,
-                    mime="text/markdown",
-                )
-                # —— 把同样的元数据塞到聊天历史 ——
-                st.session_state.messages.append({
-                    "role": "user",
-                    "download": {  # 这里的键名随便取，只要你自己识别得出来
-                        "label": f"📑 {uploaded.name}",
-                        "data": file_bytes,
-                        "file_name": uploaded.name,
-                        "mime": "application/pdf",
-                    }
-                })
+                new_docs.append((i, uploaded.name, md))
+                attach_download(f"📝 {uploaded.name}", file_bytes, uploaded.name, "text/markdown")
             elif name.endswith("txt"):
                 txt = file_bytes.decode("utf-8")
-                full_prompt += f"\n用户上传的第{i}个文档内容如下：\n\n{txt}"
-                st.download_button(
-                    label=f"📄 {uploaded.name}",
-                    data=file_bytes,
-                    file_name=uploaded.name,
-                    mime="text/plain",
-                )
-                # —— 把同样的元数据塞到聊天历史 ——
-                st.session_state.messages.append({
-                    "role": "user",
-                    "download": {  # 这里的键名随便取，只要你自己识别得出来
-                        "label": f"📑 {uploaded.name}",
-                        "data": file_bytes,
-                        "file_name": uploaded.name,
-                        "mime": "application/pdf",
-                    }
-                })
+                new_docs.append((i, uploaded.name, txt))
+                attach_download(f"📄 {uploaded.name}", file_bytes, uploaded.name, "text/plain")
             elif name.endswith("mp4"):
                 # 2) 构造要保存的路径
                 save_dir = Path(__file__).resolve().parent/"videos"
@@ -766,6 +980,58 @@ if prompt := st.chat_input(
                 full_prompt += f"\n用户上传了一个视频文件，视频文件的绝对路径是:{save_path}"
             else:
                 st.info("不支持此文件格式")
+
+    if pdf_uploads:
+        # 多份 PDF 按页拆开并行解析，每份一个进度条；解析过的内容直接读缓存
+        bars = [st.progress(0.0, text=f"📑 {file_name} 解析中…") for _, file_name, _ in pdf_uploads]
+
+        def show_progress(k: int, done: int, total: int):
+            bars[k].progress(done / total, text=f"📑 {pdf_uploads[k][1]} 已解析 {done}/{total} 页")
+
+        strategy = st.session_state.get("pdf_strategy", "fast")
+        with get_tracer().span("ingest.pdf", key=strategy, files=len(pdf_uploads),
+                               bytes=sum(len(data) for _, _, data in pdf_uploads)):
+            texts = get_ingestor().extract(
+                [data for _, _, data in pdf_uploads],
+                strategy=strategy,
+                on_progress=show_progress,
+            )
+        for bar in bars:
+            bar.empty()
+        for (i, file_name, _), text in zip(pdf_uploads, texts):
+            new_docs.append((i, file_name, text))
+
+    question = prompt.text if prompt and prompt.text else ""
+    documents = st.session_state.documents
+    top_k = int(os.getenv("RETRIEVAL_TOP_K", "4"))
+    inlined = set()
+    for i, doc_name, text in sorted(new_docs):
+        documents.add(doc_name, text)
+        if count_text_tokens(text) <= int(os.getenv("DOC_INLINE_TOKENS", "2000")):
+            inlined.add(doc_name)
+            full_prompt += f"\n用户上传的第{i}个文档内容如下：\n\n{text}"
+        elif not question:
+            full_prompt += (
+                f"\n用户上传的第{i}个文档《{doc_name}》较长，以下只是开头部分，"
+                f"其余内容请用 {SEARCH_TOOL_NAME} 检索：\n\n{format_chunks(documents.leading(doc_name, top_k))}"
+            )
+    long_docs = {doc_name for _, doc_name, _ in new_docs} - inlined
+    if question and long_docs:
+        # 只在上传长文档的这一轮附带与问题相关的片段；片段会写进历史，之后的提问由模型按需调用检索工具
+        min_coverage = float(os.getenv("RETRIEVAL_MIN_COVERAGE", "0.5"))  # 片段至少命中这个比例的查询词
+        hits = [c for c in documents.search(question, top_k * 2, min_coverage) if c["doc"] in long_docs][:top_k]
+        if hits:
+            full_prompt += (
+                f"\n以下是刚上传的文档中与问题最相关的片段（需要更多内容时可调用 {SEARCH_TOOL_NAME}）：\n\n"
+                f"{format_chunks(hits)}"
+            )
+        else:
+            full_prompt += (
+                f"\n用户上传了较长的文档《{'》《'.join(sorted(long_docs))}》，"
+                f"没有找到与问题直接相关的片段，需要时请用 {SEARCH_TOOL_NAME} 检索"
+            )
+    elif question and not new_docs and len(documents):
+        full_prompt += f"\n（本会话已上传文档：{'、'.join(documents.docs)}，需要时可调用 {SEARCH_TOOL_NAME} 检索）"
     if prompt and prompt.text:
         with st.chat_message("user"):
             st.markdown(prompt.text)
@@ -773,6 +1039,9 @@ if prompt := st.chat_input(
             st.session_state.messages.append({"role": "user", "text": prompt.text})
 
     with st.chat_message("assistant"):
-        answer = agent.ask(full_prompt, data_uri_list)
-        st.markdown(answer)
-        st.session_state.messages.append({"role": "assistant", "content": answer})
+        try:
+            answer = render_turn(agent, full_prompt, data_uri_list, question)  # 回复与工具执行过程在这里流式渲染
+            st.session_state.messages.append({"role": "assistant", "content": answer})
+        finally:
+            persist_messages(trim=True)
+            st.session_state.render_groups = RENDER_GROUPS  # 发了新消息，窗口回到最近的几组
@@ -0,0 +1,740 @@
+import asyncio
+import contextlib
+import json
+import queue
+from collections import deque
+from copy import deepcopy
+
+from openai import AsyncOpenAI
+
+from core.catalog import ToolCatalog, fingerprint
+from core.context import ContextManager
+from core.llm_resilience import LatencyStats, ResilientLLM
+from core.mcp_pool import LoopThread, MCPSessionPool, close_on_collect
+from core.prompts import build_context_message, build_system_message
+from core.streaming import StreamedReply, parse_arguments
+from core.tool_cache import ToolResultCache, tool_cache_key
+from core.tool_router import ToolRouter
+from core.tracing import Tracer
+from core.turn_budget import TurnBudget, describe
+
+# 这些工具由前端直接处理，不走 MCP 服务端
+FRONTEND_TOOLS = {
+    "show_image_frontend", "show_video_frontend", "show_dataframe_frontend", "show_gif_frontend", "read_image_file",
+}
+
+
+class ToolTimeoutError(Exception):
+    """工具在截止时间内没有返回；payload() 是交给模型的结构化错误"""
+
+    def __init__(self, name: str, timeout: float):
+        super().__init__(f"工具{name}超过 {timeout:g} 秒没有返回，已取消")
+        self.name = name
+        self.timeout = timeout
+
+    def payload(self) -> dict:
+        return {
+            "error": "timeout",
+            "tool": self.name,
+            "timeout_s": self.timeout,
+            "message": f"工具在 {self.timeout:g} 秒内没有返回，调用已取消。可以缩小请求范围后重试，或改用其他工具。",
+        }
+
+
+def tools_to_gemini(tool):
+    return {
+        "type": "function",
+        "function": {
+            "name": tool.name,
+            "description": tool.description,
+            "parameters": tool.input_schema,  # ← 字段改名！
+        },
+    }
+
+
+def tools_to_openrouter(tool):
+    """
+    将 MCP / 自定义工具描述转换为 OpenRouter (OpenAI-compatible) 的
+    Chat-Function-Calling 工具格式。
+    """
+    # ---------- 1️⃣ 基础准备 ----------
+    # • deepcopy 防止原始 schema 被我们就地修改
+    # • schema 不一定含有 "type" / "properties" / "required" 键，需要兜底
+    raw = deepcopy(tool.input_schema) or {}
+
+    schema = {
+        "type": "object",
+        # 如果原 schema 已经给出了 properties/required 就直接拿过来，否则给默认空字典/列表
+        "properties": raw.get("properties", {}),
+        "required": raw.get("required", []),
+    }
+
+    # ---------- 2️⃣ 为每个字段补全类型 ----------
+    # 遵循 JSON-Schema Draft-07（OpenAI / OpenRouter 要求）
+    for prop_name, prop_schema in schema["properties"].items():
+        if "type" not in prop_schema:
+            # 如果用户没写 type，默认按 string 处理
+            prop_schema["type"] = "string"
+
+        # 如果字段本身声明的是数组，但忘了 items，也要补上
+        if prop_schema["type"] == "array" and "items" not in prop_schema:
+            prop_schema["items"] = {"type": "string"}
+
+    # ---------- 3️⃣ 组装最终工具描述 ----------
+    return {
+        "type": "function",
+        "function": {
+            "name": tool.name,  # 函数名
+            "description": tool.description,  # 描述
+            "parameters": schema,  # 完整 JSON-Schema
+        },
+    }
+
+
+class MCPAgent:
+    """
+    异步 Agent 核心：AsyncOpenAI + MCP 长连接，全部跑在本会话独占的后台事件循环上。
+    Streamlit 脚本线程通过 ask_events() 这个同步桥接拿到流式事件并负责渲染；
+    前端类工具以 "frontend" 事件交给脚本线程执行，结果再回传给事件循环。
+    """
+
+    def __init__(self, endpoints: dict[str, str], api_key: str, base_url: str, model: str,
+                 tool_options: dict[str, dict] | None = None, parallel_prompt: bool = False,
+                 context_budget: int = 60000, max_tool_tokens: int = 6000,
+                 cache_size: int = 256, default_ttl: float = 0.0,
+                 local_tools: dict[str, tuple[dict, object]] | None = None,
+                 runtime=None, user_id: str = "default",
+                 tool_top_k: int = 0, compact_tools: bool = False,
+                 llm_timeout: float = 120.0, llm_idle_timeout: float = 60.0,
+                 llm_max_retries: int = 3, hedge: bool = False, journal=None,
+                 tracer: Tracer | None = None,
+                 server_timeouts: dict[str, float] | None = None, tool_timeout: float | None = 120.0,
+                 max_steps: int | None = 12, max_turn_tokens: int | None = 300000,
+                 max_turn_seconds: float | None = 600.0, budget_warn_ratio: float = 0.8):
+        self.endpoints = endpoints
+        # 进程内实现的工具：name -> (OpenAI 工具 schema, handler(args) -> str)，例如文档检索
+        self.local_tools = local_tools or {}
+        # 工具名 -> 选项，例如 {"write_file": {"serial": True}}，来自 AVAILABLE_SERVICES
+        self.tool_options = tool_options or {}
+        # 单次工具调用的截止时间：工具的 timeout 选项 > 服务的 timeout > tool_timeout（None 表示不限）
+        self.server_timeouts = server_timeouts or {}
+        self.tool_timeout = tool_timeout
+        # 每轮对话的上限（工具轮数 / token / 秒数，None 表示不限），见 TurnBudget
+        self.turn_limits = {"max_steps": max_steps, "max_tokens": max_turn_tokens,
+                            "max_seconds": max_turn_seconds, "warn_ratio": budget_warn_ratio}
+        self.budget: TurnBudget | None = None  # 进行中（或最近一轮）的预算
+        self.parallel_prompt = parallel_prompt
+
+        # 默认每个会话一个常驻事件循环，LLM 与 MCP 的连接都绑定在它上面；
+        # 多用户模式下改用进程级 SharedRuntime 的事件循环、连接池和并发限制
+        self.runtime = runtime
+        self.user_id = user_id
+        if runtime is None:
+            self.runner = LoopThread(name="agent-loop")
+            self.llm = AsyncOpenAI(
+                base_url=base_url,
+                api_key=api_key,
+                max_retries=0,  # 重试由 ResilientLLM 负责
+            )
+        else:
+            self.runner = runtime.runner
+            self.llm = runtime.llm(api_key, base_url)
+        self.model = model
+        # 超时、429/5xx 退避重试和对冲请求；多用户模式下延迟统计全进程共享，对冲阈值更准
+        self.resilient = ResilientLLM(
+            self.llm,
+            stats=runtime.llm_stats if runtime is not None else LatencyStats(),
+            max_retries=llm_max_retries,
+            first_chunk_timeout=llm_timeout,
+            idle_timeout=llm_idle_timeout,
+            hedge=hedge,
+        )
+
+        self.tools = []
+        self.tool_to_server = {}
+        self.tool_desc = ""
+        # 每轮只发送相关的工具子集（0 表示总是发送全部）；compact 时系统提示词里只列工具名，
+        # 描述和参数只在 tools 的 schema 里出现一次
+        self.tool_top_k = tool_top_k
+        self.compact_tools = compact_tools
+        self.router = ToolRouter([], 0)
+        self.turn_tools: list[dict] = []  # 最近一轮实际发送的工具
+        self._used_tools: set[str] = set()
+        self._offered_tools: set[str] = set()  # 本会话发给过模型的工具，之后一直保留
+        self.server_tools: dict[str, list] = {}  # server -> MCP 工具列表
+        self.fingerprints: dict[str, str] = {}  # server -> 工具列表指纹
+        self.catalog = None
+
+        # 发送给模型的历史由 ContextManager 按 token 预算维护
+        self.context = ContextManager(budget=context_budget, max_tool_tokens=max_tool_tokens)
+        # journal(msg, new_turn)：每条写入历史的消息都追加到持久化存储（见 ChatStore.append_llm）
+        self.context.on_message = journal
+        # 工具结果缓存：只缓存配置了 ttl 的只读工具（default_ttl 默认 0，即不缓存），cache=False 的工具（有副作用）永不缓存
+        self.cache = ToolResultCache(max_entries=cache_size)
+        self.default_ttl = default_ttl
+        # 累计的 API 用量；cached_tokens 是服务商提示词缓存命中的输入 token
+        self.usage = {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+        # 每轮对话、每次 LLM 请求和工具调用的耗时；多个会话共用一个 Tracer 时统计是全进程的
+        self.tracer = tracer or Tracer()
+        self._turn_span = None
+        self._turn_tasks: set[asyncio.Task] = set()  # 本轮发起的工具调用，取消时一并取消
+        self.pool = None
+        self._pools = []
+        self._late_servers = deque()  # 后台线程写入，脚本线程在 sync_servers() 里消费
+        if runtime is None:
+            self._closer = close_on_collect(self, self._shutdown_factory(self.runner, self.llm, self._pools))
+        else:
+            self._closer = close_on_collect(self, self._release_factory(self.runner, self._pools))
+
+    # ───────────── 建立连接 ─────────────
+    def connect(self, catalog: ToolCatalog | None = None):
+        # 每个 endpoint 只握手一次，之后 ask() 里的工具调用都复用这条长连接
+        self.pool = MCPSessionPool(
+            self.endpoints, self.runner,
+            session_factory=self.runtime.session if self.runtime is not None else None,
+        )
+        self._pools.append(self.pool)
+        self.catalog = catalog
+
+        # 进程级目录里已有的服务直接用缓存建 Agent，再在后台重新拉取并比对指纹
+        cached = catalog.lookup(self.endpoints) if catalog else {}
+        for server, (tools, fp) in cached.items():
+            self._register(server, tools, fp)
+        if cached:
+            self.pool.revalidate(list(cached), on_late=self._late_servers.append)
+
+        # 其余服务并发发现；没按时应答的在后台重试，连上后由 sync_servers() 并入
+        missing = [s for s in self.endpoints if s not in cached]
+        if missing:
+            for server, tools in self.pool.discover(on_late=self._late_servers.append, servers=missing).items():
+                self._register(server, tools, self._remember(server, tools))
+
+        self.context.set_system(self._system_message())
+
+        # 建 Agent 时就把到 LLM 的连接预热好，第一次提问不再付 TCP/TLS 握手的代价
+        if self.runtime is None:  # 共享客户端由 SharedRuntime 在创建时预热
+            self.runner.submit(self._warm_up())
+        return self
+
+    def restore_history(self, turns: list[list[dict]]):
+        """重开会话时恢复最近几轮历史；要在 connect() 之后调用，系统提示词占 messages[0]"""
+        self.context.restore(turns)
+        self._used_tools.update(
+            call["function"]["name"] for turn in turns for msg in turn for call in msg.get("tool_calls") or []
+        )
+        return self
+
+    async def _warm_up(self):
+        try:
+            await self.llm.models.list()
+        except Exception:
+            pass  # 预热失败不影响使用，真正请求时会再报错
+
+    def _remember(self, server, tools) -> str:
+        if self.catalog is None:
+            return fingerprint(tools)
+        return self.catalog.store(server, self.endpoints[server], tools)
+
+    def _register(self, server, tools, fp: str):
+        for t in tools:
+            owner = self.tool_to_server.get(t.name)
+            if owner is not None and owner != server:
+                raise ValueError(f"存在重复的函数名{t.name}")
+        self.server_tools[server] = list(tools)
+        self.fingerprints[server] = fp
+        self._rebuild_tools()
+
+    def _rebuild_tools(self):
+        # 按服务名、工具名排序，保证同一组服务生成的系统提示词和 tools 参数逐字节一致
+        self.tools, self.tool_to_server, self.tool_desc = [], {}, ""
+        for server in sorted(self.endpoints):
+            tools = self.server_tools.get(server)
+            if tools is None:
+                continue
+            tools = sorted(tools, key=lambda t: t.name)
+            for t in tools:
+                self.tools.append(tools_to_gemini(t))  # 随时切换
+                self.tool_to_server[t.name] = server
+
+            if self.compact_tools:
+                self.tool_desc += f"\n 【{server}】 {', '.join(t.name for t in tools)} \n"
+                continue
+            joint = "\n".join(f"  - {t.name} —— {t.description}" for t in tools)
+            self.tool_desc += f"\n 【{server}】\n {joint} \n"
+            # print(self.tool_desc)
+
+        if self.local_tools:
+            local = sorted(self.local_tools.items())
+            for _, (schema, _) in local:
+                self.tools.append(schema)
+            if self.compact_tools:
+                self.tool_desc += f"\n 【本地工具】 {', '.join(name for name, _ in local)} \n"
+            else:
+                joint = "\n".join(f"  - {name} —— {schema['function']['description']}" for name, (schema, _) in local)
+                self.tool_desc += f"\n 【本地工具】\n {joint} \n"
+        if self.compact_tools and self.tool_desc:
+            self.tool_desc = "（各工具的用途和参数见函数定义）\n" + self.tool_desc
+
+        # 前端渲染和本地工具很轻，总是保留
+        self.router = ToolRouter(self.tools, self.tool_top_k, pinned=FRONTEND_TOOLS | set(self.local_tools))
+
+    def _system_message(self) -> str:
+        return build_system_message(self.tool_desc, self.parallel_prompt)
+
+    @property
+    def history(self) -> list[dict]:
+        return self.context.messages
+
+    @property
+    def unreachable(self) -> dict[str, str]:
+        return dict(self.pool.unreachable) if self.pool else {}
+
+    def sync_servers(self) -> list[str]:
+        """把后台重连 / 重新校验得到的工具列表并入 Agent，返回工具有变化的服务名"""
+        changed = []
+        while self._late_servers:
+            server, tools = self._late_servers.popleft()
+            fp = self._remember(server, tools)
+            if self.fingerprints.get(server) == fp:
+                continue
+            self._register(server, tools, fp)
+            changed.append(server)
+        if changed:
+            self.context.set_system(self._system_message())
+        return changed
+
+    @staticmethod
+    def _shutdown_factory(runner: LoopThread, llm: AsyncOpenAI, pools: list):
+        # finalizer 不能引用 self，这里只捕获需要释放的对象；pool 在 connect() 时才登记进 pools
+        async def _close():
+            for pool in pools:
+                await pool.close()
+            await llm.close()
+
+        def shutdown():
+            try:
+                runner.run(_close(), timeout=10)
+            except Exception:
+                pass
+            runner.stop()
+
+        return shutdown
+
+    @staticmethod
+    def _release_factory(runner: LoopThread, pools: list):
+        # 多用户模式：共享的事件循环和连接留给其他会话，只取消本会话的后台任务
+        def release():
+            for pool in pools:
+                try:
+                    runner.run(pool.close(), timeout=10)
+                except Exception:
+                    pass
+
+        return release
+
+    def close(self):
+        self._closer()
+
+    def _llm_slot(self):
+        if self.runtime is None:
+            return contextlib.nullcontext()
+        return self.runtime.llm_limiter.slot(self.user_id)
+
+    def _tool_slot(self):
+        if self.runtime is None:
+            return contextlib.nullcontext()
+        return self.runtime.tool_limiter.slot(self.user_id)
+
+    # ───────────── 同步桥接 ─────────────
+    def ask_events(self, user_msg: str, image_list: list[dict], tick: float | None = None,
+                   question: str | None = None):
+        """
+        在后台事件循环里跑一轮对话，把事件逐个交给调用方（Streamlit 脚本线程）。
+        question 是用户自己输入的问题，用来挑选本轮的工具；user_msg 里还可能带着上传的文档、
+        检索到的片段，不适合拿来打分。为 None 时用 user_msg。事件有：
+            ("llm_start", {})                         开始一次 LLM 请求
+            ("llm_retry", {"attempt", "delay", "error"})  请求失败，delay 秒后重试（还没有输出任何文本）
+            ("delta", {"text"})                       回复的文本增量
+            ("llm_end", {"content"})                  本次回复的文本结束
+            ("tool_wait", {"name", "timeout"?})       开始等待某个工具的结果（后端工具带截止秒数）
+            ("tool_done", {"name"}) / ("tool_error", {"name", "error"})
+            ("frontend", {"name", "args", "reply"})   需要脚本线程渲染的前端工具，渲染后调用 reply(content, extra_msgs)
+            ("budget_warning", {"budget", "used", "limit"})  本轮某项预算（steps / tokens / seconds）快用完了
+            ("budget_exhausted", {"budget", "used", "limit"}) 预算用完，接下来的一次请求不再提供工具，强制作答
+            ("done", {"content"})                     本轮结束
+            ("tick", {})                              给了 tick 时，每隔 tick 秒没有新事件就发一次，
+                                                      调用方借此刷新界面，Streamlit 才能及时响应“停止”按钮
+        """
+        events = queue.Queue()
+        future = self.runner.submit(self._turn(user_msg, image_list, events.put, question))
+        try:
+            while True:
+                try:
+                    kind, data = events.get(timeout=tick)
+                except queue.Empty:
+                    yield "tick", {}
+                    continue
+                if kind == "error":
+                    raise data["error"]
+                yield kind, data
+                if kind == "done":
+                    return
+        finally:
+            # 脚本线程被打断（例如 Streamlit rerun）时，一并取消后台的这一轮
+            if not future.done():
+                future.cancel()
+
+    def ask(self, user_msg: str, image_list: list[dict]) -> str:
+        """不需要渲染时的便捷接口：前端工具一律返回“无法展示”"""
+        for kind, data in self.ask_events(user_msg, image_list):
+            if kind == "frontend":
+                data["reply"]("当前环境无法展示前端内容", [])
+            elif kind == "done":
+                return data["content"]
+
+    # ───────────── 异步核心 ─────────────
+    async def _turn(self, user_msg: str, image_list: list[dict], emit, question: str | None = None):
+        def send(kind, **data):
+            emit((kind, data))
+
+        try:
+            with self.tracer.span("turn", key=self.model, user=self.user_id) as span:
+                self._turn_span = span
+                content = await self._run_turn(user_msg, image_list, send, question)
+        except BaseException as e:
+            # 被取消（用户点了停止 / 页面重跑）或出错：停掉还在跑的工具调用，并让历史保持合法
+            for task in list(self._turn_tasks):
+                task.cancel()
+            self._close_dangling_calls("cancelled" if isinstance(e, asyncio.CancelledError) else "failed")
+            send("error", error=e)
+            raise
+        send("done", content=content)
+
+    async def _run_turn(self, user_msg: str, image_list: list[dict], send, question: str | None = None) -> str:
+        if image_list:
+            self.context.begin_turn(
+                {
+                    "role": "user",
+                    "content": [{"type": "text", "text": user_msg}] + image_list
+                }
+            )
+        else:
+            self.context.begin_turn(
+                {"role": "user", "content": user_msg}
+            )
+        # 时间、定时任务等易变信息跟在提问之后，前面的历史保持不变，可以继续命中提示词缓存
+        self.context.append({"role": "user", "content": build_context_message()})
+
+        # 每轮按提问挑一次工具子集，同一轮内的多次请求保持一致
+        # tools 数组也是服务商提示词缓存前缀的一部分：发过的工具一直保留，数组只在需要新工具时变长，
+        # 而不是每轮换一组；完整列表只是匹配不上时的退路，不计入
+        self.turn_tools = self.router.select(user_msg if question is None else question, self._used_tools,
+                                             self._offered_tools)
+        if len(self.turn_tools) < len(self.tools):
+            self._offered_tools.update(t["function"]["name"] for t in self.turn_tools)
+        self.budget = budget = TurnBudget(**self.turn_limits)
+        loop = asyncio.get_running_loop()
+        while True:
+            final = self._check_budget(budget, send)
+            # 所有服务都还没连上时不能传空的 tools 列表；预算用完后仍带上 tools（前缀不变，提示词缓存可以命中），
+            # 但 tool_choice="none" 强制模型直接作答
+            tool_kwargs = {"tools": self.turn_tools, "tool_choice": "none" if final else "auto"} if self.turn_tools else {}
+            self.context.compact()  # 超出预算时把最早的几轮折叠成摘要
+            send("llm_start")
+            pending, barrier = {}, []
+            # 强制作答的这次请求即使模型仍然要了工具也不执行，不必提前发起
+            reply = StreamedReply(on_tool_call=None if final else lambda pos, c: self._prefetch(c, pending, barrier))
+            stream = self.resilient.stream(
+                on_retry=lambda attempt, delay, err: send("llm_retry", attempt=attempt, delay=delay, error=err),
+                model=self.model,
+                reasoning_effort="high",
+                messages=self.context.messages,
+                stream=True,
+                stream_options={"include_usage": True},
+                **tool_kwargs
+            )
+            # 除了强制作答的最后一次，请求（含重试）不能超过本轮剩余的耗时预算；最后一次只受 llm_timeout 限制
+            deadline = None if final else budget.remaining_seconds()
+            with self.tracer.span("llm.request", key=self.model, model=self.model,
+                                  messages=len(self.context.messages), tools=len(self.turn_tools)) as span:
+                # aclosing：本轮被取消时立即关闭底层 HTTP 流，而不是等垃圾回收
+                async with self._llm_slot(), contextlib.aclosing(stream):
+                    start = loop.time()
+                    try:
+                        async with asyncio.timeout(deadline) as cutoff:
+                            async for chunk in stream:
+                                if "ttft_ms" not in span.attributes:
+                                    span.set(ttft_ms=round((loop.time() - start) * 1000, 1))
+                                text = reply.feed(chunk)
+                                if text:
+                                    send("delta", text=text)
+                    except TimeoutError:
+                        if not cutoff.expired():
+                            raise  # ResilientLLM 自己的首 chunk / 间隔超时
+                        # 耗时预算在请求中途用完：丢掉这次不完整的回复和提前发起的工具调用，下一次请求强制作答
+                        span.set(cut_off=True)
+                        for task in pending.values():
+                            task.cancel()
+                        send("llm_end", content=reply.content)
+                        continue
+                reply.close()
+                self._record_usage(reply.usage, span)
+                # 服务端没返回 usage 时按上下文的估算值计
+                usage = reply.usage
+                budget.record((usage.prompt_tokens or 0) + (usage.completion_tokens or 0) if usage is not None
+                              else self.context.total_tokens)
+                span.set(tool_calls=len(reply.tool_calls), finish_reason=reply.finish_reason)
+            send("llm_end", content=reply.content)
+
+            if not reply.tool_calls or final:
+                # 个别服务商不遵守 tool_choice="none"，这时丢掉工具调用，只保留文本
+                self.context.append({"role": "assistant", "content": reply.content or " "})
+                self._turn_span.set(**budget.used())
+                return reply.content
+
+            self.context.append({
+                "role": "assistant",
+                "tool_calls": reply.tool_calls,
+                # content 可能是 None / ""，一律替换成占位符
+                "content": reply.content or " ",
+            })
+
+            # 所有 tool 消息必须紧跟在 assistant 消息之后、按调用顺序排列；
+            # read_image_file 追加的图片消息放到最后
+            tool_msgs, extra_msgs = await self._run_tool_calls(reply.tool_calls, pending, send)
+            self.context.extend(tool_msgs)
+            self.context.extend(extra_msgs)
+            budget.step()
+
+    def _check_budget(self, budget: TurnBudget, send) -> bool:
+        """每次请求 LLM 之前调用：快用完时提醒模型收尾，用完时要求直接作答；返回这次是否是强制的最后一次请求"""
+        hit = budget.exhausted()
+        if hit is not None:
+            send("budget_exhausted", budget=hit[0], used=hit[1], limit=hit[2])
+            self._turn_span.set(budget_exhausted=hit[0])
+            self.context.append({
+                "role": "user",
+                "content": f"【系统提示】本轮对话已达到上限（{describe(*hit)}），不能再调用工具。"
+                           "请根据目前已有的信息直接给出最终回答，并说明还有哪些没有完成。",
+            })
+            return True
+        warnings = budget.warnings()
+        if warnings:
+            for kind, used, limit in warnings:
+                send("budget_warning", budget=kind, used=used, limit=limit)
+            # 只在第一次请求之后才可能出现，此时上一条是工具结果，追加 user 消息不会打乱调用顺序
+            self.context.append({
+                "role": "user",
+                "content": f"【系统提示】本轮对话的预算快用完了（{'，'.join(describe(*w) for w in warnings)}），"
+                           "请尽量少调用工具，尽快给出回答。",
+            })
+        return False
+
+    def _record_usage(self, usage, span=None):
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        if span is not None:
+            span.set(
+                prompt_tokens=usage.prompt_tokens,
+                cached_tokens=getattr(details, "cached_tokens", None) or 0,
+                completion_tokens=usage.completion_tokens,
+            )
+        self.usage["requests"] += 1
+        self.usage["prompt_tokens"] += usage.prompt_tokens or 0
+        self.usage["cached_tokens"] += getattr(details, "cached_tokens", None) or 0
+        self.usage["completion_tokens"] += usage.completion_tokens or 0
+
+    def _close_dangling_calls(self, reason: str):
+        """最后一条 assistant 消息里还没有结果的工具调用补一条错误结果，否则下一轮请求会被服务端拒绝"""
+        msgs = self.context.messages
+        last = next((i for i in range(len(msgs) - 1, -1, -1) if msgs[i].get("role") == "assistant"), None)
+        if last is None:
+            return
+        answered = {m.get("tool_call_id") for m in msgs[last + 1:] if m.get("role") == "tool"}
+        for call in msgs[last].get("tool_calls") or []:
+            if call["id"] not in answered:
+                self.context.append({
+                    "role": "tool",
+                    "tool_call_id": call["id"],
+                    "name": call["function"]["name"],
+                    "content": json.dumps({"error": reason, "message": "这次调用在完成前被中止，没有结果"},
+                                          ensure_ascii=False),
+                })
+
+    def _timeout_for(self, server: str, name: str) -> float | None:
+        """单次调用的截止秒数：工具配置 > 服务配置 > tool_timeout，且不超过本轮剩余的耗时预算"""
+        opts = self.tool_options.get(name, {})
+        timeout = opts["timeout"] if "timeout" in opts else self.server_timeouts.get(server, self.tool_timeout)
+        remaining = self.budget.remaining_seconds() if self.budget is not None else None
+        if remaining is not None and (timeout is None or remaining < timeout):
+            return remaining
+        return timeout
+
+    def _is_serial(self, name: str) -> bool:
+        return self.tool_options.get(name, {}).get("serial", False)
+
+    def _prefetch(self, call: dict, pending: dict, barrier: list):
+        """流式输出中一拼好工具调用就立即开始执行，不必等整段回复生成完"""
+        name = call["function"]["name"]
+        if name in FRONTEND_TOOLS or name not in self.tool_to_server:
+            return
+        if self._is_serial(name):
+            barrier.append(name)  # 串行工具及其之后的调用留到执行阶段按顺序处理
+        if barrier:
+            return
+        try:
+            args = parse_arguments(call)
+        except json.JSONDecodeError:
+            return
+        pending[call["id"]] = self._submit(name, args)
+
+    def _submit(self, name: str, args: dict) -> asyncio.Future:
+        """
+        发起一次后端工具调用，返回的 task 结果就是 tool 消息的 content。
+        可缓存的工具先查缓存；相同参数的调用还在执行时直接复用它的 task。
+        """
+        server = self.tool_to_server[name]
+        opts = self.tool_options.get(name, {})
+        loop = asyncio.get_running_loop()
+        if opts.get("cache", True) is False:
+            return self._track_task(loop.create_task(self._fetch(server, name, args)))
+
+        key = tool_cache_key(name, args)
+        content, inflight = self.cache.lookup(key)
+        if content is not None:
+            done = loop.create_future()
+            done.set_result(content)
+            return done
+        if inflight is not None:
+            return inflight
+        task = self._track_task(loop.create_task(self._fetch(server, name, args, key, opts.get("ttl", self.default_ttl))))
+        self.cache.track(key, task)
+        return task
+
+    def _track_task(self, task: asyncio.Task) -> asyncio.Task:
+        self._turn_tasks.add(task)
+        task.add_done_callback(self._turn_tasks.discard)
+        return task
+
+    async def _fetch(self, server: str, name: str, args: dict, key: str | None = None, ttl: float = 0):
+        # 流式阶段提前发起的调用也挂在本轮下面，而不是挂在当时进行中的 LLM 请求下面
+        with self.tracer.span("tool.call", key=f"{server}/{name}", parent=self._turn_span, server=server, tool=name,
+                              args_bytes=len(json.dumps(args, ensure_ascii=False))) as span:
+            timeout = self._timeout_for(server, name)
+            span.set(timeout_s=timeout)
+            async with self._tool_slot():
+                try:
+                    # 截止时间只算真正的调用，不含排队；超时后取消这次 MCP 请求
+                    async with asyncio.timeout(timeout):
+                        # 连接断开后只重试可缓存、非串行的工具，有副作用的不会被执行两次
+                        result = await self.pool.call_tool(server, name, args,
+                                                           retry=key is not None and not self._is_serial(name))
+                except TimeoutError:
+                    raise ToolTimeoutError(name, timeout) from None
+            # result 现在一定是 str / dict / bool … 可以被 JSON 序列化
+            content = json.dumps(result, ensure_ascii=False, default=str)
+            span.set(result_bytes=len(content))
+        if key is None:
+            self.cache.clear()  # 有副作用的工具执行后，之前缓存的结果都不再可信
+        elif ttl > 0:
+            self.cache.put(key, content, ttl)
+        return content
+
+    def _launch_segment(self, calls: list[dict], start: int, pending: dict):
+        """从 start 开始并发发起后端工具调用，遇到下一个串行工具为止"""
+        for call in calls[start:]:
+            name = call["function"]["name"]
+            if name in FRONTEND_TOOLS or name not in self.tool_to_server:
+                continue
+            if self._is_serial(name):
+                break
+            if call["id"] in pending:
+                continue
+            try:
+                args = parse_arguments(call)
+            except json.JSONDecodeError:
+                continue
+            pending[call["id"]] = self._submit(name, args)
+
+    async def _run_tool_calls(self, calls: list[dict], pending: dict, send):
+        """
+        执行同一条 assistant 消息里的全部工具调用：
+        - 普通后端工具在 MCP 服务上并发执行（流式阶段可能已经提前发起）；
+        - serial 工具要等前面的调用全部结束后单独执行，后面的调用再接着并发；
+        - 前端工具交给脚本线程按顺序渲染。
+        """
+        self._launch_segment(calls, 0, pending)
+        tool_msgs, extra_msgs = [], []
+        for i, call in enumerate(calls):
+            name = call["function"]["name"]
+            self._used_tools.add(name)
+            try:
+                args = parse_arguments(call)
+            except json.JSONDecodeError as e:
+                content = json.dumps({"error": f"参数不是合法的 JSON: {e}"}, ensure_ascii=False)
+            else:
+                if name in FRONTEND_TOOLS:
+                    content = await self._run_frontend(name, args, extra_msgs, send)
+                elif name in self.local_tools:
+                    content = self._run_local(name, args, send)
+                elif name not in self.tool_to_server:
+                    content = json.dumps({"error": f"工具{name}不存在"}, ensure_ascii=False)
+                else:
+                    content = await self._run_backend(call, name, args, pending, send)
+                    if self._is_serial(name):
+                        self._launch_segment(calls, i + 1, pending)
+            tool_msgs.append({
+                "role": "tool",
+                "tool_call_id": call["id"],  # ← 一定要填 call.id
+                "name": name,  # ← 有些版本需要 name 字段
+                "content": content,
+            })
+        return tool_msgs, extra_msgs
+
+    async def _run_backend(self, call: dict, name: str, args: dict, pending: dict, send) -> str:
+        send("tool_wait", name=name, timeout=self._timeout_for(self.tool_to_server[name], name))
+        if call["id"] not in pending:
+            # 串行工具：等之前发起的调用都结束再执行
+            if pending:
+                await asyncio.wait(list(pending.values()))
+            pending[call["id"]] = self._submit(name, args)
+        try:
+            content = await pending[call["id"]]
+        except ToolTimeoutError as e:
+            # 结构化的超时错误交给模型，它可以换参数重试或改用别的工具
+            send("tool_error", name=name, error=str(e))
+            return json.dumps(e.payload(), ensure_ascii=False)
+        except Exception as e:
+            # 一个工具失败不影响同批次的其他工具，把错误交给模型自行调整
+            send("tool_error", name=name, error=str(e))
+            return json.dumps({"error": str(e)}, ensure_ascii=False)
+        send("tool_done", name=name)
+        return content
+
+    def _run_local(self, name: str, args: dict, send) -> str:
+        send("tool_wait", name=name)
+        try:
+            with self.tracer.span("tool.call", key=f"local/{name}", server="local", tool=name,
+                                  args_bytes=len(json.dumps(args, ensure_ascii=False))) as span:
+                content = self.local_tools[name][1](args)
+                span.set(result_bytes=len(content))
+        except Exception as e:
+            send("tool_error", name=name, error=str(e))
+            return json.dumps({"error": str(e)}, ensure_ascii=False)
+        send("tool_done", name=name)
+        return content
+
+    async def _run_frontend(self, name: str, args: dict, extra_msgs: list, send) -> str:
+        loop = asyncio.get_running_loop()
+        answered = loop.create_future()
+
+        def reply(content: str, extra: list[dict]):
+            # 由脚本线程调用，切回事件循环线程完成 Future
+            loop.call_soon_threadsafe(answered.set_result, (content, extra))
+
+        with self.tracer.span("tool.call", key=f"frontend/{name}", server="frontend", tool=name):
+            send("frontend", name=name, args=args, reply=reply)
+            content, extra = await answered
+        extra_msgs.extend(extra)
+        return content
@@ -0,0 +1,132 @@
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import weakref
+from pathlib import Path
+
+
+class BlobStore:
+    """
+    进程级的内容寻址存储（由 st.cache_resource 持有，所有会话共享）：
+    - 文件按 SHA-256 存到磁盘，多个用户上传同一份文件只存一份；
+    - sqlite 索引记录大小、引用计数和最近访问时间；
+    - 总大小超过 max_bytes 时，按 LRU 淘汰引用计数为 0 的文件；
+    - pinned 记录有多少条持久化的聊天记录引用了这个文件，不为 0 时不淘汰；
+      聊天记录被删除（ChatStore.delete / prune）时 unpin()，之后照常参与 LRU。
+    会话里的聊天记录只保存 digest，需要时再从磁盘读。
+    """
+
+    def __init__(self, root: Path, max_bytes: int = 1 << 30):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.root / "index.sqlite", check_same_thread=False, isolation_level=None)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS blobs ("
+            " digest TEXT PRIMARY KEY, size INTEGER NOT NULL,"
+            " refs INTEGER NOT NULL DEFAULT 0, last_access REAL NOT NULL,"
+            " pinned INTEGER NOT NULL DEFAULT 0)"
+        )
+        try:
+            self._db.execute("ALTER TABLE blobs ADD COLUMN pinned INTEGER NOT NULL DEFAULT 0")
+        except sqlite3.OperationalError:
+            pass  # 新建的表已经有这一列
+        # 引用都来自会话，进程重启后旧会话已经不存在了
+        self._db.execute("UPDATE blobs SET refs = 0")
+
+    def path(self, digest: str) -> Path:
+        return self.root / digest[:2] / digest[2:]
+
+    def put(self, data: bytes, pinned: bool = False) -> str:
+        """写入一份内容并加一个引用，返回 digest；pinned=True 时不加会话引用，改为加一个聊天记录引用"""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        with self._lock:
+            if not path.exists():
+                path.parent.mkdir(exist_ok=True)
+                # 先写临时文件再原子改名，读者不会看到写了一半的文件
+                fd, tmp = tempfile.mkstemp(dir=path.parent)
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, path)
+            self._db.execute(
+                "INSERT INTO blobs (digest, size, refs, last_access, pinned) VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT(digest) DO UPDATE SET refs = refs + excluded.refs,"
+                " last_access = excluded.last_access, pinned = pinned + excluded.pinned",
+                (digest, len(data), 0 if pinned else 1, time.time(), int(pinned)),
+            )
+            self._evict()
+        return digest
+
+    def read(self, digest: str) -> bytes:
+        with self._lock:
+            self._db.execute("UPDATE blobs SET last_access = ? WHERE digest = ?", (time.time(), digest))
+        return self.path(digest).read_bytes()
+
+    def pin(self, digests: list[str]):
+        """已经存在的文件各加一个聊天记录引用（同一个 digest 可以出现多次）"""
+        with self._lock:
+            self._db.executemany("UPDATE blobs SET pinned = pinned + 1 WHERE digest = ?", [(d,) for d in digests])
+
+    def unpin(self, digests: list[str]):
+        """释放一批聊天记录引用；没有任何引用的文件随后可以被淘汰"""
+        with self._lock:
+            self._db.executemany(
+                "UPDATE blobs SET pinned = MAX(pinned - 1, 0) WHERE digest = ?",
+                [(d,) for d in digests],
+            )
+            self._evict()
+
+    def release(self, digests: list[str]):
+        """释放一批引用（同一个 digest 可以出现多次）"""
+        with self._lock:
+            self._db.executemany(
+                "UPDATE blobs SET refs = MAX(refs - 1, 0) WHERE digest = ?",
+                [(d,) for d in digests],
+            )
+            self._evict()
+
+    @property
+    def total_bytes(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+    def _evict(self):
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # 仍被会话或聊天记录引用的文件不能删，只淘汰没人用的，最久未访问的先删
+        rows = self._db.execute(
+            "SELECT digest, size FROM blobs WHERE refs = 0 AND pinned = 0 ORDER BY last_access"
+        ).fetchall()
+        for digest, size in rows:
+            if total <= self.max_bytes:
+                break
+            self.path(digest).unlink(missing_ok=True)
+            self._db.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+            total -= size
+
+    def session(self) -> "SessionBlobs":
+        return SessionBlobs(self)
+
+
+class SessionBlobs:
+    """
+    单个 Streamlit 会话持有的引用；会话结束、对象被回收时统一释放，
+    这些文件随后就可以被 LRU 淘汰。
+    """
+
+    def __init__(self, store: BlobStore):
+        self.store = store
+        self._digests: list[str] = []
+        weakref.finalize(self, store.release, self._digests)
+
+    def put(self, data: bytes) -> str:
+        digest = self.store.put(data)
+        self._digests.append(digest)
+        return digest
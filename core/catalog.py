@@ -0,0 +1,46 @@
+import hashlib
+import json
+import threading
+
+
+def fingerprint(tools) -> str:
+    """工具列表的版本指纹：名称、描述、参数 schema 任何一项变化都会改变指纹"""
+    payload = sorted(
+        ([t.name, t.description or "", t.input_schema or {}] for t in tools),
+        key=lambda item: item[0],
+    )
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+
+class ToolCatalog:
+    """
+    进程级的工具目录缓存，所有 Streamlit 会话共享（由 st.cache_resource 持有）。
+    每个 (server, url) 记录最新的指纹；工具列表按指纹存放。
+    一组 endpoints 里的服务都有记录时，新会话可以直接用缓存建 Agent，无需等待 list_tools。
+    """
+
+    def __init__(self):
+        self._latest: dict[tuple[str, str], str] = {}  # (server, url) -> 指纹
+        self._tools: dict[str, list] = {}  # 指纹 -> 工具列表
+        self._lock = threading.Lock()
+
+    def lookup(self, endpoints: dict[str, str]) -> dict[str, tuple[list, str]]:
+        """返回已缓存的 {server: (tools, 指纹)}"""
+        with self._lock:
+            return {
+                server: (self._tools[self._latest[(server, url)]], self._latest[(server, url)])
+                for server, url in endpoints.items()
+                if (server, url) in self._latest
+            }
+
+    def store(self, server: str, url: str, tools) -> str:
+        fp = fingerprint(tools)
+        with self._lock:
+            self._tools[fp] = list(tools)
+            self._latest[(server, url)] = fp
+            # 不再被任何服务引用的旧版本直接丢掉
+            live = set(self._latest.values())
+            for old in [f for f in self._tools if f not in live]:
+                del self._tools[old]
+        return fp
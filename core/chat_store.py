@@ -0,0 +1,287 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from core.blob_store import BlobStore
+
+
+class ChatStore:
+    """
+    进程级的聊天记录持久化（sqlite，WAL 模式），所有会话共享：
+    - ui 表：界面上的聊天气泡（st.session_state.messages），按 seq 连续编号；
+    - llm 表：发给模型的历史，按轮次（turn）分组，重开会话时只恢复最近几轮；
+    - 只追加不修改；超过 inline_limit 的消息（图片 data URI、大段工具结果等）存进 BlobStore，
+      表里只留 digest；这些内容和消息引用的上传文件在 BlobStore 里按记录数 pin 住，
+      delete() 删除会话、prune() 清理超过 retention_days 没有更新的会话时一并 unpin；
+    - 同一个会话只有一个写入者：最后用 claim() 打开它的标签页。之前打开的标签页再写入时，
+      把它看到过的历史复制成一个新会话（fork）接着写，两边的消息不会互相覆盖或交错，
+      之后它用旧 id 的读写都转到新会话，resolve() 返回新 id。
+    """
+
+    def __init__(self, path: Path, blob_store: BlobStore, inline_limit: int = 4096,
+                 retention_days: float | None = None):
+        self.blob_store = blob_store
+        self.inline_limit = inline_limit
+        self.retention_days = retention_days  # None / 0 表示永久保留
+        self._pruned_at = 0.0
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")  # WAL 下足够安全，每次提交不必 fsync
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " id TEXT PRIMARY KEY, created REAL NOT NULL, updated REAL NOT NULL, owner TEXT);"
+            "CREATE TABLE IF NOT EXISTS ui ("
+            " session_id TEXT NOT NULL, seq INTEGER NOT NULL, payload TEXT, blob TEXT,"
+            " PRIMARY KEY (session_id, seq)) WITHOUT ROWID;"
+            "CREATE TABLE IF NOT EXISTS llm ("
+            " session_id TEXT NOT NULL, seq INTEGER NOT NULL, turn INTEGER NOT NULL, payload TEXT, blob TEXT,"
+            " PRIMARY KEY (session_id, seq)) WITHOUT ROWID;"
+            "CREATE INDEX IF NOT EXISTS llm_turn ON llm (session_id, turn);"
+        )
+        try:
+            self._db.execute("ALTER TABLE sessions ADD COLUMN owner TEXT")
+        except sqlite3.OperationalError:
+            pass  # 新建的表已经有这一列
+        self._llm_tail: dict[str, tuple[int, int]] = {}  # session -> (下一个 seq, 当前 turn)
+        # (session, owner) -> [ui 序号上限, llm 序号上限]：这个写入者看到过 / 写过的范围，fork 时复制到这里为止
+        self._seen: dict[tuple[str, str], list[int]] = {}
+        self._redirect: dict[tuple[str, str], str] = {}  # (旧 session, owner) -> fork 出来的 session
+
+    # ───────────── 序列化 ─────────────
+    def _encode(self, msg: dict) -> tuple[str | None, str | None]:
+        text = json.dumps(msg, ensure_ascii=False)
+        if len(text) <= self.inline_limit:
+            return text, None
+        return None, self.blob_store.put(text.encode("utf-8"), pinned=True)
+
+    def _decode(self, payload: str | None, blob: str | None) -> dict:
+        if payload is None:
+            payload = self.blob_store.read(blob).decode("utf-8")
+        return json.loads(payload)
+
+    @staticmethod
+    def _referenced_blobs(msg: dict) -> list[str]:
+        digests = [msg.get("blob"), (msg.get("download") or {}).get("blob")]
+        return [d for d in digests if d]
+
+    def _pinned_by(self, session_id: str, ui_end: int | None = None, llm_end: int | None = None) -> list[str]:
+        """会话（序号上限之前）的记录 pin 住的 digest，每条记录各算一次，与写入时的 pin 一一对应"""
+        end = 1 << 62
+        ui = self._db.execute(
+            "SELECT payload, blob FROM ui WHERE session_id = ? AND seq < ?",
+            (session_id, end if ui_end is None else ui_end),
+        ).fetchall()
+        llm = self._db.execute(
+            "SELECT blob FROM llm WHERE session_id = ? AND seq < ? AND blob IS NOT NULL",
+            (session_id, end if llm_end is None else llm_end),
+        ).fetchall()
+        digests = [blob for (blob,) in llm]
+        for payload, blob in ui:
+            if blob is not None:
+                digests.append(blob)
+            try:
+                digests.extend(self._referenced_blobs(self._decode(payload, blob)))
+            except OSError:
+                pass  # 内容文件已经不在了，它引用的文件也无从得知
+        return digests
+
+    def _touch(self, session_id: str):
+        now = time.time()
+        self._db.execute(
+            "INSERT INTO sessions (id, created, updated) VALUES (?, ?, ?)"
+            " ON CONFLICT(id) DO UPDATE SET updated = excluded.updated",
+            (session_id, now, now),
+        )
+
+    # ───────────── 写入者 ─────────────
+    def claim(self, session_id: str, owner: str):
+        """标签页打开会话时调用：成为它的写入者（最后打开的为准）；顺便每小时清理一次过期会话"""
+        now = time.time()
+        if self.retention_days and now - self._pruned_at > 3600:
+            self._pruned_at = now
+            self.prune()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO sessions (id, created, updated, owner) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT(id) DO UPDATE SET owner = excluded.owner",
+                (session_id, now, now, owner),
+            )
+            ui_end = self._db.execute(
+                "SELECT COALESCE(MAX(seq) + 1, 0) FROM ui WHERE session_id = ?", (session_id,)
+            ).fetchone()[0]
+            self._seen[(session_id, owner)] = [ui_end, self._tail(session_id)[0]]
+
+    def resolve(self, session_id: str, owner: str) -> str:
+        """这个写入者当前实际使用的会话 id（发生过 fork 时是新 id）"""
+        with self._lock:
+            return self._redirect.get((session_id, owner), session_id)
+
+    def _writable(self, session_id: str, owner: str | None) -> str:
+        """持有 _lock、在事务里调用：返回 owner 可以写入的会话 id，必要时先 fork"""
+        if owner is None:
+            return session_id
+        session_id = self._redirect.get((session_id, owner), session_id)
+        row = self._db.execute("SELECT owner FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        if row is None or row[0] in (None, owner):
+            return session_id
+        return self._fork(session_id, owner)
+
+    def _fork(self, session_id: str, owner: str) -> str:
+        ui_end, llm_end = self._seen.get((session_id, owner), (0, 0))
+        new_id = uuid.uuid4().hex
+        now = time.time()
+        self._db.execute("INSERT INTO sessions (id, created, updated, owner) VALUES (?, ?, ?, ?)",
+                         (new_id, now, now, owner))
+        self._db.execute(
+            "INSERT INTO ui SELECT ?, seq, payload, blob FROM ui WHERE session_id = ? AND seq < ?",
+            (new_id, session_id, ui_end),
+        )
+        self._db.execute(
+            "INSERT INTO llm SELECT ?, seq, turn, payload, blob FROM llm WHERE session_id = ? AND seq < ?",
+            (new_id, session_id, llm_end),
+        )
+        pins = self._pinned_by(session_id, ui_end, llm_end)  # 复制出来的记录同样要 pin 住引用的内容
+        if pins:
+            self.blob_store.pin(pins)
+        self._seen[(new_id, owner)] = [ui_end, llm_end]
+        # 之前 fork 过的旧 id 也一并指向最新的会话
+        for key, target in list(self._redirect.items()):
+            if key[1] == owner and target == session_id:
+                self._redirect[key] = new_id
+        self._redirect[(session_id, owner)] = new_id
+        return new_id
+
+    # ───────────── 删除 ─────────────
+    def delete(self, session_id: str):
+        """删除一个会话的全部记录，释放它 pin 住的内容"""
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                pins = self._pinned_by(session_id)
+                for table, column in (("ui", "session_id"), ("llm", "session_id"), ("sessions", "id")):
+                    self._db.execute(f"DELETE FROM {table} WHERE {column} = ?", (session_id,))
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._llm_tail.pop(session_id, None)
+            for key in [k for k in self._seen if k[0] == session_id]:
+                del self._seen[key]
+            # 指向被删会话的转向作废；从它 fork 出去的会话还在用，转向保留
+            for key in [k for k, v in self._redirect.items() if v == session_id]:
+                del self._redirect[key]
+        if pins:
+            self.blob_store.unpin(pins)
+
+    def prune(self) -> int:
+        """删除超过 retention_days 没有更新的会话，返回删除的个数"""
+        if not self.retention_days:
+            return 0
+        with self._lock:
+            stale = [sid for (sid,) in self._db.execute(
+                "SELECT id FROM sessions WHERE updated < ?", (time.time() - self.retention_days * 86400,)
+            )]
+        for session_id in stale:
+            self.delete(session_id)
+        return len(stale)
+
+    # ───────────── 界面消息 ─────────────
+    def ui_count(self, session_id: str) -> int:
+        with self._lock:
+            return self._db.execute(
+                "SELECT COALESCE(MAX(seq) + 1, 0) FROM ui WHERE session_id = ?", (session_id,)
+            ).fetchone()[0]
+
+    def append_ui(self, session_id: str, start: int, msgs: list[dict], owner: str | None = None):
+        """
+        从序号 start 开始追加一批界面消息；重复写入同一序号会被忽略。
+        给了 owner 时只写入它拥有的会话，会话已被别的标签页接管就先 fork，返回实际写入的会话 id。
+        """
+        # 先 pin 住引用的上传文件，再写大段消息，写入触发的淘汰不会删掉它们
+        pins = [d for m in msgs for d in self._referenced_blobs(m)]
+        if pins:
+            self.blob_store.pin(pins)
+        encoded = [self._encode(m) for m in msgs]
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                session_id = self._writable(session_id, owner)
+                self._db.executemany(
+                    "INSERT OR IGNORE INTO ui VALUES (?, ?, ?, ?)",
+                    [(session_id, start + i, *e) for i, e in enumerate(encoded)],
+                )
+                self._touch(session_id)
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            if owner is not None:
+                seen = self._seen.setdefault((session_id, owner), [0, 0])
+                seen[0] = max(seen[0], start + len(msgs))
+        return session_id
+
+    def load_ui(self, session_id: str, start: int, end: int) -> list[dict]:
+        """序号在 [start, end) 之间的界面消息"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT payload, blob FROM ui WHERE session_id = ? AND seq >= ? AND seq < ? ORDER BY seq",
+                (session_id, start, end),
+            ).fetchall()
+        return [self._decode(*row) for row in rows]
+
+    # ───────────── 模型历史 ─────────────
+    def _tail(self, session_id: str) -> tuple[int, int]:
+        tail = self._llm_tail.get(session_id)
+        if tail is None:
+            seq, turn = self._db.execute(
+                "SELECT COALESCE(MAX(seq) + 1, 0), COALESCE(MAX(turn), -1) FROM llm WHERE session_id = ?",
+                (session_id,),
+            ).fetchone()
+            tail = (seq, turn)
+        return tail
+
+    def append_llm(self, session_id: str, msg: dict, new_turn: bool, owner: str | None = None):
+        """
+        追加一条发给模型的消息；new_turn=True 表示新一轮的用户提问（ContextManager.on_message 的签名）。
+        owner 的含义同 append_ui()。
+        """
+        payload, blob = self._encode(msg)
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                session_id = self._writable(session_id, owner)
+                seq, turn = self._tail(session_id)
+                if new_turn:
+                    turn += 1
+                self._db.execute("INSERT INTO llm VALUES (?, ?, ?, ?, ?)",
+                                 (session_id, seq, max(turn, 0), payload, blob))
+                self._touch(session_id)
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._llm_tail[session_id] = (seq + 1, max(turn, 0))
+            if owner is not None:
+                self._seen.setdefault((session_id, owner), [0, 0])[1] = seq + 1
+
+    def load_llm_turns(self, session_id: str, turns: int) -> list[list[dict]]:
+        """最近 turns 轮的模型历史，每轮一个列表"""
+        with self._lock:
+            _, last = self._tail(session_id)
+            rows = self._db.execute(
+                "SELECT turn, payload, blob FROM llm WHERE session_id = ? AND turn > ? ORDER BY seq",
+                (session_id, last - turns),
+            ).fetchall()
+        result, current = [], None
+        for turn, payload, blob in rows:
+            if turn != current:
+                result.append([])
+                current = turn
+            result[-1].append(self._decode(payload, blob))
+        return result
@@ -0,0 +1,171 @@
+import re
+
+CJK_RE = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]")
+
+# 每条消息的固定开销（role、分隔符等）
+MESSAGE_OVERHEAD = 4
+# 图片按 detail 估算的 token 数；与 base64 长度无关
+IMAGE_TOKENS = {"low": 85, "high": 1105, "auto": 765}
+
+
+def count_text_tokens(text: str) -> int:
+    """
+    不依赖 tokenizer 的粗略估算：中日韩字符约 1 token/字，其余约 4 字符/token。
+    只用来做预算控制，偏差在可接受范围内。
+    """
+    if not text:
+        return 0
+    cjk = len(CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def count_message_tokens(msg: dict) -> int:
+    content = msg.get("content")
+    total = MESSAGE_OVERHEAD
+    if isinstance(content, str):
+        total += count_text_tokens(content)
+    elif isinstance(content, list):
+        for part in content:
+            if part.get("type") == "text":
+                total += count_text_tokens(part.get("text", ""))
+            elif part.get("type") == "image_url":
+                detail = part.get("image_url", {}).get("detail", "auto")
+                total += IMAGE_TOKENS.get(detail, IMAGE_TOKENS["auto"])
+    for call in msg.get("tool_calls") or []:
+        total += count_text_tokens(call["function"]["name"]) + count_text_tokens(call["function"]["arguments"])
+    return total
+
+
+def clip_text(text: str, max_tokens: int) -> str:
+    """超长文本保留开头和结尾，中间用提示替换"""
+    tokens = count_text_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    keep = int(len(text) * max_tokens / tokens)
+    head, tail = keep * 7 // 10, keep * 3 // 10
+    omitted = len(text) - head - tail
+    return f"{text[:head]}\n\n…[内容过长，已省略 {omitted} 个字符]…\n\n{text[len(text) - tail:]}"
+
+
+class ContextManager:
+    """
+    管理发送给模型的对话历史：
+    - 逐条记录 token 估算值，总量超过 budget 时把最早的整轮对话折叠进摘要；
+    - 系统提示词永远保留，最近 keep_turns 轮（含进行中的一轮）永不裁剪，
+      因此 assistant 的 tool_calls 与对应的 tool 消息不会被拆开；
+    - 单条工具结果超过 max_tool_tokens 时在写入时就截断；
+    - on_message(msg, new_turn) 在每条消息写入后回调，用来把历史追加到持久化存储。
+    """
+
+    SUMMARY_HEADER = "以下是更早对话的摘要（原文已省略，仅供参考）：\n"
+
+    def __init__(self, budget: int = 60000, max_tool_tokens: int = 6000, keep_turns: int = 2):
+        self.budget = budget
+        self.max_tool_tokens = max_tool_tokens
+        self.keep_turns = keep_turns
+
+        self.messages: list[dict] = []
+        self.tokens: list[int] = []
+        self.turn_starts: list[int] = []  # 每一轮用户提问在 messages 中的起始下标
+        self.summary_lines: list[str] = []
+        self._has_summary = False  # 摘要固定放在 messages[1]
+        self.on_message = None
+
+    @property
+    def total_tokens(self) -> int:
+        return sum(self.tokens)
+
+    def set_system(self, content: str):
+        msg = {"role": "system", "content": content}
+        if self.messages:
+            self.messages[0] = msg
+            self.tokens[0] = count_message_tokens(msg)
+        else:
+            self._push(msg)
+
+    def begin_turn(self, user_msg: dict):
+        self.turn_starts.append(len(self.messages))
+        self._push(user_msg)
+        if self.on_message is not None:
+            self.on_message(user_msg, True)
+
+    def append(self, msg: dict):
+        if msg.get("role") == "tool" and isinstance(msg.get("content"), str):
+            msg = dict(msg, content=clip_text(msg["content"], self.max_tool_tokens))
+        self._push(msg)
+        if self.on_message is not None:
+            self.on_message(msg, False)
+
+    def extend(self, msgs):
+        for msg in msgs:
+            self.append(msg)
+
+    def restore(self, turns: list[list[dict]]):
+        """从持久化存储恢复最近的若干轮（每轮第一条是用户提问），不触发 on_message"""
+        for turn in turns:
+            self.turn_starts.append(len(self.messages))
+            for msg in turn:
+                self._push(msg)
+        self.compact()
+
+    def _push(self, msg: dict):
+        self.messages.append(msg)
+        self.tokens.append(count_message_tokens(msg))
+
+    def compact(self):
+        """超出预算时，把最早的整轮对话折叠成摘要"""
+        folded = False
+        while self.total_tokens > self.budget and len(self.turn_starts) > self.keep_turns:
+            start, end = self.turn_starts[0], self.turn_starts[1]
+            self.summary_lines.extend(_summarize_turn(self.messages[start:end]))
+            del self.messages[start:end]
+            del self.tokens[start:end]
+            shift = end - start
+            self.turn_starts = [i - shift for i in self.turn_starts[1:]]
+            folded = True
+        if folded:
+            self._write_summary()
+
+    def _write_summary(self):
+        # 摘要本身也受限，最多占预算的 1/10，超出时丢弃最早的摘要行
+        limit = self.budget // 10
+        while len(self.summary_lines) > 1 and count_text_tokens("\n".join(self.summary_lines)) > limit:
+            self.summary_lines.pop(0)
+        msg = {"role": "system", "content": self.SUMMARY_HEADER + "\n".join(self.summary_lines)}
+
+        if self._has_summary:
+            self.messages[1] = msg
+            self.tokens[1] = count_message_tokens(msg)
+        else:
+            self.messages.insert(1, msg)
+            self.tokens.insert(1, count_message_tokens(msg))
+            self.turn_starts = [i + 1 for i in self.turn_starts]
+            self._has_summary = True
+
+
+def _text_of(msg: dict) -> str:
+    content = msg.get("content")
+    if isinstance(content, list):
+        return " ".join(p.get("text", "") for p in content if p.get("type") == "text")
+    return content or ""
+
+
+def _summarize_turn(turn: list[dict]) -> list[str]:
+    """抽取式摘要：保留用户问题、用到的工具和最终回答的开头，不额外调用模型"""
+    lines = [f"- 用户：{_short(_text_of(turn[0]), 200)}"]
+    tools = []
+    for msg in turn:
+        for call in msg.get("tool_calls") or []:
+            tools.append(call["function"]["name"])
+    if tools:
+        lines.append(f"  调用工具：{', '.join(dict.fromkeys(tools))}")
+    final = next((m for m in reversed(turn) if m.get("role") == "assistant" and not m.get("tool_calls")), None)
+    if final is not None:
+        lines.append(f"  助手：{_short(_text_of(final), 300)}")
+    return lines
+
+
+def _short(text: str, limit: int) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit] + "…"
+
@@ -0,0 +1,129 @@
+import hashlib
+import os
+import threading
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+
+from core.media import media_key
+
+DATAFRAME_SUFFIXES = (".csv", ".xls", ".xlsx")
+
+
+class DatasetCache:
+    """
+    表格预览引擎（进程级，由 st.cache_resource 持有，所有会话共享）：
+    - 第一次打开某个 csv / xlsx 时转成 parquet 放进 cache_dir，之后按 (路径, mtime, 大小) 直接复用；
+    - csv 用 pyarrow 流式读取、逐块写入 parquet，内存占用与文件大小无关；
+    - 预览只读选中的列和前 limit 行，读够就停，不会把整张表读进内存；
+    - 目录总大小超过 max_bytes 时删除最久没用过的缓存，被删的下次预览时从源文件重建。
+    聊天记录里只保存 open() 返回的引用（一个小 dict），不保存数据本身。
+    """
+
+    def __init__(self, cache_dir: Path, max_bytes: int = 2 << 30, batch_rows: int = 65536):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.batch_rows = batch_rows
+        self._lock = threading.Lock()
+        self._converting: dict[str, threading.Lock] = {}  # 同一个文件只转换一次，其他会话等它
+
+    def path(self, dataset_id: str) -> Path:
+        return self.cache_dir / f"{dataset_id}.parquet"
+
+    def open(self, path: str) -> dict:
+        """转换（或复用缓存）并返回引用：{"id", "source", "name", "rows", "columns"}"""
+        suffix = Path(path).suffix.lower()
+        if suffix not in DATAFRAME_SUFFIXES:
+            raise ValueError("仅支持 .csv / .xls / .xlsx")
+        key = media_key(path)
+        dataset_id = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:20]
+        target = self.path(dataset_id)
+        with self._lock:
+            lock = self._converting.setdefault(dataset_id, threading.Lock())
+        with lock:
+            if not target.exists():
+                self._convert(key[0], suffix, target)
+                self._prune(keep=target)
+        meta = pq.ParquetFile(target)
+        return {
+            "id": dataset_id,
+            "source": key[0],
+            "name": Path(path).name,
+            "rows": meta.metadata.num_rows,
+            "columns": meta.schema_arrow.names,
+        }
+
+    def _convert(self, source: str, suffix: str, target: Path):
+        tmp = target.with_name(target.name + ".tmp")
+        try:
+            if suffix == ".csv":
+                try:
+                    self._convert_csv(source, tmp)
+                except pa.ArrowInvalid:
+                    # 类型只按开头的数据块推断，后面出现不一致的值时整表按字符串重读
+                    self._convert_csv(source, tmp, as_strings=True)
+            else:
+                self._convert_excel(source, tmp)
+            os.replace(tmp, target)
+        finally:
+            tmp.unlink(missing_ok=True)
+
+    def _convert_csv(self, source: str, tmp: Path, as_strings: bool = False):
+        read_options = pacsv.ReadOptions(block_size=16 << 20)
+        convert_options = None
+        if as_strings:
+            names = pacsv.open_csv(source, read_options=read_options).schema.names
+            convert_options = pacsv.ConvertOptions(column_types={name: pa.string() for name in names})
+        reader = pacsv.open_csv(source, read_options=read_options, convert_options=convert_options)
+        with pq.ParquetWriter(tmp, reader.schema) as writer:
+            for batch in reader:
+                writer.write_batch(batch)
+
+    def _convert_excel(self, source: str, tmp: Path):
+        import pandas as pd  # xlsx 没有流式读取，只能整张表读进来转换一次
+
+        df = pd.read_excel(source, sheet_name=0)
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            table = pa.Table.from_pandas(df.astype(str), preserve_index=False)  # 混合类型的列
+        pq.write_table(table, tmp, row_group_size=self.batch_rows)
+
+    def preview(self, ref: dict, columns: list[str] | None = None, limit: int = 1000) -> pa.Table:
+        """
+        读取前 limit 行；columns 为空时读全部列。缓存被清理过时从源文件重建，源文件已经不在时
+        抛出 OSError；重建后的表里已经没有的列会被忽略。
+        """
+        target = self.path(ref["id"])
+        if not target.exists():
+            ref = self.open(ref["source"])  # 缓存被清理过，从源文件重建
+            target = self.path(ref["id"])
+        os.utime(target)  # mtime 记作最近使用时间，清理时最久没用的先删
+
+        parquet = pq.ParquetFile(target)
+        schema = parquet.schema_arrow
+        if columns:
+            columns = [name for name in columns if name in schema.names] or None  # 源文件改过，列可能变了
+        batches, rows = [], 0
+        for batch in parquet.iter_batches(batch_size=min(limit, self.batch_rows), columns=columns):
+            batches.append(batch)
+            rows += batch.num_rows
+            if rows >= limit:
+                break
+        if columns:
+            schema = pa.schema([schema.field(name) for name in columns])
+        return pa.Table.from_batches(batches, schema=schema).slice(0, limit)
+
+    def _prune(self, keep: Path):
+        files = [(p.stat().st_mtime, p.stat().st_size, p) for p in self.cache_dir.glob("*.parquet")]
+        total = sum(size for _, size, _ in files)
+        for _, size, p in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if p == keep:
+                continue
+            p.unlink(missing_ok=True)
+            total -= size
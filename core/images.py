@@ -0,0 +1,77 @@
+import base64
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+
+# 长边不超过这个尺寸时用 detail=low（按固定的少量 token 计费）
+LOW_DETAIL_SIDE = 512
+
+
+def _sniff_mime(data: bytes) -> str:
+    if data.startswith(b"\x89PNG"):
+        return "image/png"
+    if data.startswith(b"GIF8"):
+        return "image/gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/jpeg"
+
+
+class ImagePreprocessor:
+    """
+    图片发给模型之前先处理一遍（进程内共享、线程安全）：
+    - 按 EXIF 方向摆正后去掉全部元数据；
+    - 长边缩到 max_side 以内，重新编码成 WEBP；
+    - 按处理后的尺寸选择 detail；
+    - 结果按 (内容哈希, 参数) 做 LRU 缓存，同一张图重复发送不再重新编码。
+    没装 Pillow 时原样发送，detail 保持 auto；解码失败（格式不支持、文件损坏）抛 ValueError，
+    不把模型看不了的字节冒充成图片发出去。
+    """
+
+    def __init__(self, max_side: int = 1536, quality: int = 80, max_entries: int = 64):
+        self.max_side = max_side
+        self.quality = quality
+        self.max_entries = max_entries
+        self._cache: OrderedDict[str, dict] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def image_part(self, data: bytes) -> dict:
+        """返回可以直接放进 message content 的 image_url 片段"""
+        key = f"{hashlib.sha256(data).hexdigest()}:{self.max_side}:{self.quality}"
+        with self._lock:
+            part = self._cache.get(key)
+            if part is not None:
+                self._cache.move_to_end(key)
+                return part
+
+        part = self._encode(data)
+        with self._lock:
+            self._cache[key] = part
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return part
+
+    def _encode(self, data: bytes) -> dict:
+        try:
+            from PIL import Image, ImageOps
+        except ImportError:
+            url = f"data:{_sniff_mime(data)};base64,{base64.b64encode(data).decode('utf-8')}"
+            return {"type": "image_url", "image_url": {"url": url, "detail": "auto"}}
+
+        try:
+            with Image.open(io.BytesIO(data)) as img:
+                img = ImageOps.exif_transpose(img)
+                if img.mode not in ("RGB", "RGBA"):
+                    img = img.convert("RGBA" if "A" in img.getbands() or "transparency" in img.info else "RGB")
+                img.thumbnail((self.max_side, self.max_side))
+                buf = io.BytesIO()
+                # 不传 exif / icc_profile，元数据就不会写进新文件
+                img.save(buf, format="WEBP", quality=self.quality, method=4)
+                size = img.size
+        except Exception as e:
+            raise ValueError("图片格式不支持或文件已损坏") from e
+
+        detail = "low" if max(size) <= LOW_DETAIL_SIDE else "high"
+        url = f"data:image/webp;base64,{base64.b64encode(buf.getvalue()).decode('utf-8')}"
+        return {"type": "image_url", "image_url": {"url": url, "detail": detail}}
@@ -0,0 +1,137 @@
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import threading
+from concurrent import futures
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+# 可选的 PDF 解析策略，对应 partition_pdf(strategy=...)
+PDF_STRATEGIES = {
+    "fast": "快速（直接读取文本层）",
+    "hi_res": "高精度（版面分析 + OCR，较慢）",
+}
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def split_pages(data: bytes) -> list[bytes]:
+    """把 PDF 拆成单页 PDF，交给不同的进程并行解析；拆不开（加密、损坏等）就整份作为一页"""
+    try:
+        from pypdf import PdfReader, PdfWriter
+
+        reader = PdfReader(io.BytesIO(data))
+        pages = []
+        for page in reader.pages:
+            writer = PdfWriter()
+            writer.add_page(page)
+            buf = io.BytesIO()
+            writer.write(buf)
+            pages.append(buf.getvalue())
+    except Exception:
+        return [data]
+    return pages or [data]
+
+
+def _partition_page(page: bytes, strategy: str) -> str:
+    """在子进程里执行：解析单页 PDF 并拼出正文"""
+    from unstructured.partition.pdf import partition_pdf
+
+    elements = partition_pdf(file=io.BytesIO(page), strategy=strategy)
+    return "\n\n".join(
+        e.text for e in elements
+        if hasattr(e, "text") and e.text.strip()
+    )
+
+
+class PDFIngestor:
+    """
+    进程级的 PDF 解析流水线（由 st.cache_resource 持有，所有会话共享）：
+    - 每份 PDF 按页拆开，所有文件的所有页一起丢进进程池并行解析；
+    - 每解析完一页回调 on_progress(文件序号, 已完成页数, 总页数)，方便前端显示进度；
+    - 结果按 (内容哈希, 策略) 缓存到磁盘，重复上传同一份 PDF 直接读缓存。
+    """
+
+    def __init__(self, cache_dir: Path, max_workers: int | None = None):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_workers = max_workers or max(1, (os.cpu_count() or 2) - 1)
+        self._pool: futures.ProcessPoolExecutor | None = None
+        self._lock = threading.Lock()
+
+    def _executor(self) -> futures.ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                # Streamlit 进程里有多个线程，fork 容易死锁，统一用 spawn
+                self._pool = futures.ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self._pool
+
+    def _reset(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+
+    def _cache_path(self, digest: str, strategy: str) -> Path:
+        return self.cache_dir / f"{digest}-{strategy}.json"
+
+    def cached(self, digest: str, strategy: str) -> str | None:
+        path = self._cache_path(digest, strategy)
+        try:
+            return "\n\n".join(json.loads(path.read_text(encoding="utf-8"))["pages"])
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def extract(self, files: list[bytes], strategy: str = "fast", on_progress=None) -> list[str]:
+        """并行解析多份 PDF，按传入顺序返回每份的正文"""
+        digests = [content_hash(data) for data in files]
+        texts: list[str | None] = [self.cached(digest, strategy) for digest in digests]
+        for i, text in enumerate(texts):
+            if text is not None and on_progress is not None:
+                on_progress(i, 1, 1)
+
+        todo = [i for i, text in enumerate(texts) if text is None]
+        if not todo:
+            return texts
+
+        pages = {i: split_pages(files[i]) for i in todo}
+        results = {i: [None] * len(pages[i]) for i in todo}
+        done = dict.fromkeys(todo, 0)
+        jobs = {}
+        try:
+            pool = self._executor()
+            jobs = {
+                pool.submit(_partition_page, page, strategy): (i, n)
+                for i in todo
+                for n, page in enumerate(pages[i])
+            }
+            for job in futures.as_completed(jobs):
+                i, n = jobs[job]
+                results[i][n] = job.result()
+                done[i] += 1
+                if on_progress is not None:
+                    on_progress(i, done[i], len(pages[i]))
+        except BrokenProcessPool:
+            self._reset()  # 子进程崩溃（例如内存不足）后下次重新建池
+            raise
+        except BaseException:
+            for job in jobs:
+                job.cancel()
+            raise
+
+        for i in todo:
+            self._cache_path(digests[i], strategy).write_text(
+                json.dumps({"pages": results[i]}, ensure_ascii=False), encoding="utf-8"
+            )
+            texts[i] = "\n\n".join(results[i])
+        return texts
+
+    def close(self):
+        self._reset()
@@ -0,0 +1,191 @@
+import asyncio
+import random
+import time
+from collections import deque
+
+import openai
+
+from core.tracing import percentile
+
+
+class LatencyStats:
+    """最近 window 次 LLM 请求的首字延迟（TTFT）与总耗时，以及重试 / 对冲 / 超时次数"""
+
+    def __init__(self, window: int = 200):
+        self.ttft: deque[float] = deque(maxlen=window)
+        self.total: deque[float] = deque(maxlen=window)
+        self.requests = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.timeouts = 0
+
+    def snapshot(self) -> dict:
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "timeouts": self.timeouts,
+            **{f"ttft_p{p}": round(percentile(self.ttft, p), 3) for p in (50, 95, 99)},
+            **{f"total_p{p}": round(percentile(self.total, p), 3) for p in (50, 95, 99)},
+        }
+
+
+def is_retryable(err: BaseException) -> bool:
+    if isinstance(err, (asyncio.TimeoutError, openai.APIConnectionError)):  # APITimeoutError 是它的子类
+        return True
+    if isinstance(err, openai.APIStatusError):
+        return err.status_code == 429 or err.status_code >= 500
+    return False
+
+
+def retry_after(err: BaseException) -> float | None:
+    """服务端通过 Retry-After / retry-after-ms 头给出的等待时间"""
+    response = getattr(err, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        return None  # HTTP 日期格式的 Retry-After 不常见，按退避处理
+    return None
+
+
+class ResilientLLM:
+    """
+    包一层流式 chat.completions：
+    - 首个 chunk 超过 first_chunk_timeout、相邻 chunk 间隔超过 idle_timeout 都算超时；
+    - 429 / 5xx / 连接错误 / 超时在拿到首个 chunk 之前自动重试，指数退避加随机抖动，
+      服务端给了 Retry-After 就按它等；首个 chunk 已经渲染出去后不再重试；
+    - hedge=True 时，首个 chunk 迟迟不来（超过历史 TTFT 的 p95）就再发一个相同的请求，
+      谁先出首个 chunk 用谁，另一个取消。
+    客户端自身的重试要关掉（AsyncOpenAI(max_retries=0)），否则两层重试叠加。
+    """
+
+    def __init__(self, client: openai.AsyncOpenAI, stats: LatencyStats | None = None,
+                 max_retries: int = 3, base_delay: float = 0.5, max_delay: float = 8.0,
+                 first_chunk_timeout: float = 120.0, idle_timeout: float = 60.0,
+                 hedge: bool = False, hedge_percentile: float = 95, hedge_min_samples: int = 20,
+                 hedge_floor: float = 1.0):
+        self.client = client
+        self.stats = stats or LatencyStats()
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.first_chunk_timeout = first_chunk_timeout
+        self.idle_timeout = idle_timeout
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_floor = hedge_floor
+
+    def hedge_delay(self) -> float | None:
+        """样本够了才对冲，阈值取 TTFT 的 p95（不低于 hedge_floor 秒）"""
+        if not self.hedge or len(self.stats.ttft) < self.hedge_min_samples:
+            return None
+        return max(self.hedge_floor, percentile(self.stats.ttft, self.hedge_percentile))
+
+    def _backoff(self, attempt: int, err: BaseException) -> float:
+        hinted = retry_after(err)
+        if hinted is not None:
+            return min(hinted, self.max_delay * 4)
+        # full jitter：在 [0, base * 2^attempt] 里随机，避免大量会话同时重试
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def stream(self, on_retry=None, **kwargs):
+        """异步生成 chunk；on_retry(attempt, delay, err) 在每次重试前回调"""
+        start = time.perf_counter()
+        self.stats.requests += 1
+        attempt = 0
+        while True:
+            try:
+                first, it, stream, ttft = await self._first_chunk(kwargs)
+                break
+            except Exception as e:
+                if isinstance(e, asyncio.TimeoutError):
+                    self.stats.timeouts += 1
+                if attempt >= self.max_retries or not is_retryable(e):
+                    raise
+                delay = self._backoff(attempt, e)
+                attempt += 1
+                self.stats.retries += 1
+                if on_retry is not None:
+                    on_retry(attempt, delay, e)
+                await asyncio.sleep(delay)
+
+        # 只记成功那次请求自己的首 chunk 耗时，不含失败的尝试和退避，否则对冲阈值会被重试拉高
+        self.stats.ttft.append(ttft)
+        try:
+            if first is None:
+                return
+            yield first
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(it.__anext__(), timeout=self.idle_timeout)
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    self.stats.timeouts += 1
+                    raise
+                yield chunk
+            self.stats.total.append(time.perf_counter() - start)
+        finally:
+            await stream.close()
+
+    async def _open(self, kwargs):
+        """发起一次请求并等到首个 chunk，返回 (首个 chunk, 迭代器, 流, 这次请求的 TTFT)"""
+        start = time.perf_counter()
+        stream = await self.client.chat.completions.create(**kwargs)
+        it = stream.__aiter__()
+        try:
+            first = await it.__anext__()
+        except StopAsyncIteration:
+            first = None
+        except BaseException:
+            await stream.close()
+            raise
+        return first, it, stream, time.perf_counter() - start
+
+    async def _first_chunk(self, kwargs):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.first_chunk_timeout
+        primary = loop.create_task(self._open(kwargs))
+        tasks = [primary]
+        hedge_after = self.hedge_delay()
+        try:
+            if hedge_after is not None and hedge_after < self.first_chunk_timeout:
+                done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+                if not done:
+                    self.stats.hedges += 1
+                    tasks.append(loop.create_task(self._open(kwargs)))
+
+            error = None
+            while tasks:
+                remaining = deadline - loop.time()
+                done, _ = await asyncio.wait(tasks, timeout=max(remaining, 0), return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise asyncio.TimeoutError("等待模型首个响应超时")
+                # 一个失败了还要等另一个；两个都失败才抛出
+                for task in done:
+                    tasks.remove(task)
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.stats.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+            # 输掉的对冲请求如果已经建立了流，要把连接关掉
+            for task in tasks:
+                try:
+                    stream = (await task)[2]
+                except BaseException:
+                    continue
+                await stream.close()
@@ -0,0 +1,262 @@
+import asyncio
+import threading
+import weakref
+
+from fastmcp import Client
+from fastmcp.client.transports import StreamableHttpTransport
+from fastmcp.exceptions import ToolError
+
+
+class LoopThread:
+    """
+    在后台守护线程里常驻一个 asyncio 事件循环。
+    Streamlit 脚本线程通过 run()/submit() 把协程丢进来执行，
+    这样 MCP 长连接就能跨多次 ask() 复用，而不是每次 asyncio.run 新建一个循环。
+    """
+
+    def __init__(self, name: str = "mcp-loop"):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        """非阻塞提交，返回 concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout: float | None = None):
+        """阻塞等待协程执行完毕并返回结果"""
+        return self.submit(coro).result(timeout)
+
+    def stop(self):
+        if self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout=5)
+        if not self._thread.is_alive():
+            self.loop.close()
+
+
+class MCPSession:
+    """
+    单个 endpoint 的长连接。
+    连接的建立与关闭都放在同一个常驻任务 _runner 里完成（anyio 要求进出 cancel scope 在同一个 task），
+    空闲时定期 ping 保活；ping 或调用失败会触发重连。
+    """
+
+    def __init__(self, url: str, keepalive: float = 30.0, connect_timeout: float = 10.0):
+        self.url = url
+        self.keepalive = keepalive
+        self.connect_timeout = connect_timeout
+
+        self.client: Client | None = None
+        self.last_error: Exception | None = None
+
+        self._task: asyncio.Task | None = None
+        self._ready = asyncio.Event()
+        self._settled = asyncio.Event()  # 至少完成过一次连接尝试（无论成败）
+        self._wake = asyncio.Event()
+        self._closed = False
+        self._reconnect = False
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._runner())
+
+    async def _runner(self):
+        backoff = 1.0
+        while not self._closed:
+            failed = False
+            try:
+                async with Client(StreamableHttpTransport(self.url)) as cli:
+                    self.client = cli
+                    self.last_error = None
+                    self._ready.set()
+                    self._settled.set()
+                    backoff = 1.0
+                    while not self._closed and not self._reconnect:
+                        try:
+                            await asyncio.wait_for(self._wake.wait(), timeout=self.keepalive)
+                        except asyncio.TimeoutError:
+                            await cli.ping()  # 失败会抛异常，直接进入重连
+                        self._wake.clear()
+            except Exception as e:
+                self.last_error = e
+                failed = True
+            finally:
+                self._settled.set()
+                self.client = None
+                self._ready.clear()
+                self._reconnect = False
+
+            if failed and not self._closed:
+                # 连不上就指数退避，最长 30 秒重试一次
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+
+    async def get_client(self, fail_fast: bool = False) -> Client:
+        """fail_fast=True 时首次连接失败就立即报错，不等后台重连"""
+        self.start()
+        try:
+            if fail_fast:
+                await asyncio.wait_for(self._settled.wait(), timeout=self.connect_timeout)
+            if not self._ready.is_set():
+                await asyncio.wait_for(self._ready.wait(), timeout=0 if fail_fast else self.connect_timeout)
+        except asyncio.TimeoutError:
+            raise ConnectionError(f"无法连接到 MCP 服务 {self.url}: {self.last_error}") from self.last_error
+        return self.client
+
+    def request_reconnect(self, cli: Client | None = None):
+        """给了 cli 时只在它仍是当前连接时重连，几个并发调用同时发现断线也只重连一次"""
+        if cli is not None and cli is not self.client:
+            return
+        self._reconnect = True
+        self._ready.clear()
+        self._wake.set()
+
+    async def _connected_client(self) -> Client:
+        # 保活还没发现的断线在发送前处理掉：先等重连，请求不会发出去两次
+        cli = await self.get_client()
+        if not cli.is_connected():
+            self.request_reconnect(cli)
+            cli = await self.get_client()
+        return cli
+
+    async def call_tool(self, name: str, args: dict, retry: bool = False):
+        """
+        工具本身报错（ToolError）、服务端的协议错误、超时都直接抛出，连接还好好的就不重连，
+        同一连接上其他进行中的调用不受影响。请求发出后连接断开，服务端可能已经执行过，
+        只有 retry=True（只读、可以重复执行的工具）才在重连后再试一次。
+        """
+        for attempt in range(2):
+            cli = await self._connected_client()
+            try:
+                return await cli.call_tool(name, args)
+            except ToolError:
+                raise
+            except Exception:
+                if cli.is_connected():
+                    raise
+                self.request_reconnect(cli)
+                if attempt or not retry:
+                    raise
+
+    async def list_tools(self, fail_fast: bool = False):
+        cli = await self.get_client(fail_fast)
+        return await cli.list_tools()
+
+    async def close(self):
+        self._closed = True
+        self._wake.set()
+        if self._task is not None:
+            try:
+                await asyncio.wait_for(self._task, timeout=5)
+            except Exception:
+                self._task.cancel()
+            self._task = None
+
+
+class MCPSessionPool:
+    """
+    一组 endpoint 的长连接池，跑在 Agent 的会话级事件循环上。
+    connect() 时打开，ask() 里复用，Agent 被回收时关闭。
+    多用户模式下传入 session_factory(url)，长连接由进程级的 SharedRuntime 提供，关闭时不随之断开。
+    """
+
+    def __init__(self, endpoints: dict[str, str], runner: LoopThread,
+                 keepalive: float = 30.0, discover_timeout: float = 5.0, session_factory=None):
+        self.endpoints = endpoints
+        self.keepalive = keepalive
+        self.discover_timeout = discover_timeout
+        self.runner = runner  # 由 Agent 持有的会话级事件循环
+        self.session_factory = session_factory
+        self.sessions: dict[str, MCPSession] = {}
+        self.unreachable: dict[str, str] = {}  # server -> 最近一次的错误信息
+        self._retry_tasks: set[asyncio.Task] = set()
+        self.closed = False
+        self.runner.run(self._open())
+
+    async def _open(self):
+        # asyncio.Event 等对象需要在后台循环里创建
+        for server, url in self.endpoints.items():
+            if self.session_factory is not None:
+                self.sessions[server] = self.session_factory(url)
+                continue
+            session = MCPSession(url, keepalive=self.keepalive)
+            session.start()
+            self.sessions[server] = session
+
+    async def _list_with_deadline(self, server: str):
+        return await asyncio.wait_for(self.sessions[server].list_tools(fail_fast=True), timeout=self.discover_timeout)
+
+    async def _discover(self, on_late, servers=None):
+        servers = list(self.sessions) if servers is None else list(servers)
+        results = await asyncio.gather(
+            *(self._list_with_deadline(s) for s in servers), return_exceptions=True
+        )
+        found = {}
+        for server, res in zip(servers, results):
+            if isinstance(res, BaseException):
+                self.unreachable[server] = _describe(res)
+                task = asyncio.get_running_loop().create_task(self._retry_discovery(server, on_late))
+                self._retry_tasks.add(task)
+                task.add_done_callback(self._retry_tasks.discard)
+            else:
+                found[server] = res
+        return found
+
+    def discover(self, on_late, servers=None):
+        """
+        并发拉取服务（默认全部）的工具列表，每个服务最多等 discover_timeout 秒。
+        返回按时应答的 {server: tools}；超时/失败的服务记入 unreachable，
+        并在后台持续重试，成功后在后台线程里回调 on_late((server, tools))。
+        """
+        return self.runner.run(self._discover(on_late, servers))
+
+    def revalidate(self, servers, on_late):
+        """不阻塞地在后台重新拉取工具列表，所有结果都通过 on_late((server, tools)) 回调"""
+        async def _run():
+            for item in (await self._discover(on_late, servers)).items():
+                on_late(item)
+        return self.runner.submit(_run())
+
+    async def _retry_discovery(self, server: str, on_late):
+        delay = 2.0
+        while not self.closed:
+            await asyncio.sleep(delay)
+            try:
+                tools = await self._list_with_deadline(server)
+            except Exception as e:
+                self.unreachable[server] = _describe(e)
+                delay = min(delay * 2, 60.0)
+                continue
+            self.unreachable.pop(server, None)
+            on_late((server, tools))
+            return
+
+    async def call_tool(self, server: str, name: str, args: dict, retry: bool = False):
+        return await self.sessions[server].call_tool(name, args, retry=retry)
+
+    async def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for task in list(self._retry_tasks):
+            task.cancel()
+        if self.session_factory is not None:
+            return  # 共享的长连接归 SharedRuntime 管
+        await asyncio.gather(*(s.close() for s in self.sessions.values()), return_exceptions=True)
+
+
+def _describe(err: BaseException) -> str:
+    if isinstance(err, asyncio.TimeoutError):
+        return "连接超时"
+    return str(err) or type(err).__name__
+
+
+def close_on_collect(owner, close):
+    """owner 被垃圾回收（例如 Streamlit 会话结束）时调用 close() 释放连接与事件循环"""
+    return weakref.finalize(owner, close)
@@ -0,0 +1,115 @@
+import hashlib
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+
+# Streamlit 静态文件服务按扩展名决定 Content-Type，只有这些类型能正确显示
+STATIC_SUFFIXES = {".gif", ".png", ".jpg", ".jpeg", ".webp", ".bmp", ".svg"}
+
+
+def media_key(path: str) -> tuple[str, int, int]:
+    """(绝对路径, mtime_ns, 大小)：文件被改写后 key 随之变化，旧的渲染结果自然失效"""
+    st = os.stat(path)
+    return os.path.abspath(path), st.st_mtime_ns, st.st_size
+
+
+class MediaPublisher:
+    """
+    把本地图片 / GIF 发布到 Streamlit 的静态目录（static/media），浏览器直接按 URL 拉取，
+    重跑脚本时不必再读文件、做 base64。
+    - 同一个 (路径, mtime, 大小) 只发布一次，之后只需一次 os.stat；
+    - 优先硬链接，跨盘时退回复制；
+    - 目录总大小超过 max_bytes 时删除最早发布的文件，被删的下次用到时会重新发布。
+    静态目录不需要登录就能访问，所以：
+    - 只发布 allowed_roots 下的文件，模型传来的其他路径返回 None，由调用方走非公开的方式显示；
+    - 发布超过 max_age 秒的文件会被清掉，会话删除时用 unpublish() 撤下它展示过的文件。
+    """
+
+    def __init__(self, static_root: Path, max_bytes: int = 512 << 20, allowed_roots: list[Path] | None = None,
+                 max_age: float | None = None):
+        self.static_root = Path(static_root)
+        self.media_dir = self.static_root / "media"
+        self.media_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.allowed_roots = [Path(root).resolve() for root in allowed_roots or []]
+        self.max_age = max_age  # None / 0 表示不按时间清理
+        self._published: dict[tuple[str, int, int], str] = {}  # media_key -> 文件名
+        self._lock = threading.Lock()
+        with self._lock:
+            self._prune()
+
+    def url(self, path: str, suffix: str | None = None) -> str | None:
+        """
+        返回 /app/static/media/... 形式的 URL；文件类型不适合静态服务、或者不是存在的本地文件
+        （http 链接、已被移走 / 删除的文件）时返回 None，由调用方按原路径处理
+        """
+        suffix = (suffix or Path(path).suffix).lower()
+        if suffix not in STATIC_SUFFIXES:
+            return None
+        try:
+            if not self.allowed(path):
+                return None
+            key = media_key(path)
+            with self._lock:
+                name = self._published.get(key)
+                if name is None or not (self.media_dir / name).exists():
+                    name = self._publish(key, suffix)
+        except OSError:
+            return None
+        return f"/app/static/media/{name}"
+
+    def allowed(self, path: str) -> bool:
+        """解析符号链接后是否在 allowed_roots 下"""
+        real = Path(path).resolve()
+        return any(real.is_relative_to(root) for root in self.allowed_roots)
+
+    def unpublish(self, path: str, suffix: str | None = None):
+        """撤下一个文件的所有已发布版本；别的会话还要显示它时，下次渲染会重新发布"""
+        suffix = (suffix or Path(path).suffix).lower()
+        src = os.path.abspath(path)
+        with self._lock:
+            names = [self._published.pop(key) for key in [k for k in self._published if k[0] == src]]
+            try:
+                names.append(_media_name(media_key(path), suffix))  # 进程重启前发布的
+            except OSError:
+                pass
+            for name in names:
+                (self.media_dir / name).unlink(missing_ok=True)
+
+    def _publish(self, key: tuple[str, int, int], suffix: str) -> str:
+        src = key[0]
+        name = _media_name(key, suffix)
+        target = self.media_dir / name
+        if not target.exists():
+            tmp = target.with_name(name + ".tmp")
+            try:
+                os.link(src, tmp)
+            except OSError:
+                shutil.copyfile(src, tmp)
+            os.replace(tmp, target)
+            self._prune(keep=name)
+        self._published[key] = name
+        return name
+
+    def _prune(self, keep: str | None = None):
+        # 硬链接的 mtime 是源文件的，不能改；链接 / 复制都会刷新 ctime，用它近似发布时间
+        files = []
+        for p in self.media_dir.iterdir():
+            if p.is_file():
+                stat = p.stat()
+                files.append((stat.st_ctime, stat.st_size, p))
+        expired = time.time() - self.max_age if self.max_age else 0
+        total = sum(size for _, size, _ in files)
+        for ctime, size, p in sorted(files):
+            if total <= self.max_bytes and ctime >= expired:
+                break
+            if p.name == keep:
+                continue
+            p.unlink(missing_ok=True)
+            total -= size
+
+
+def _media_name(key: tuple[str, int, int], suffix: str) -> str:
+    return hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:20] + suffix
@@ -0,0 +1,122 @@
+import datetime
+import json
+from pathlib import Path
+
+
+def get_task():
+    # 找到项目根目录（core/ 的上一级）
+    base_dir = Path(__file__).resolve().parent.parent
+    # 拼出 JSON 文件的完整路径
+    json_path = base_dir / "Tasklist" / "Task.json"
+    # 读取并解析
+    with json_path.open("r", encoding="utf-8") as f:
+        tasks = json.load(f)
+
+    if not tasks:
+        return "用户还未创建任何的定时任务"
+
+    # 3. 拼接文本
+    lines = []
+    for idx, task in enumerate(tasks, start=1):
+        name = task.get("TaskName", "")
+        desc = task.get("Description", "")
+        sched = task.get("Schedule", "")
+        time = task.get("Time", "")
+        date = task.get("Date", "")
+
+        lines.append(f"任务{idx}：{name}")
+        lines.append(f"任务描述: {desc}")
+
+        # 根据 daily/once 分别处理
+        if sched == "daily":
+            lines.append(f"调度方式: 每日 {time} 执行一次")
+        elif sched == "once":
+            lines.append(f"调度方式: 在 {date} 的 {time} 执行一次")
+        else:
+            # 如果有其他类型，直接原样输出
+            lines.append(f"调度方式: {sched} {date} {time}")
+
+        # 分隔线
+        if idx != len(tasks):
+            lines.append("========================")
+
+    # 4. 合并并输出
+    result = "\n".join(lines)
+    return result
+
+
+# 系统提示词只放不变的内容，并且先放说明、后放工具列表：
+# 同一组服务的会话前缀逐字节相同，服务商的隐式提示词缓存可以命中。
+# 时间、定时任务这类易变信息放在每轮提问之后的 CONTEXT_MESSAGE 里。
+SYSTEM_MESSAGE = """
+你是一名严格遵守步骤的 AI 助手。
+
+================== 任务说明 ==================
+🔹 **第一步：判断用户意图是否明确**
+
+1. **已明确**  
+   - 如果用户输入已经包含清晰的目标、操作对象和期望结果  
+     （如：“请帮我上网搜查比特币实时价格并把结果保存到 data/bitcoin.json”），  
+     直接进入 *第二步·工作流*。
+
+2. **不明确**  
+   - 如果用户输入含糊或信息不足  
+     （如仅输入“比特币”或“保存”），请先：  
+     • 参考你能调用的工具，推测用户最可能的需求；  
+     • 用一句简洁的中文向用户**先确认需求**，并顺带说明你能执行的选项，格式示例：  
+       “请问您是想要 **___(推测的需求)___** 吗？如果是，我可以帮助你先**__(做的事情)__**,然后.....”  
+     • 等待并读取用户的补充或确认；  
+     • 只有在目标变得明确后，才进入 *第二步·工作流*。
+
+🔹 **第二步：工作流**
+
+{WORKFLOW}
+
+================== 可用工具 ==================
+当前可用工具有：
+
+{TOOLS}
+"""
+
+CONTEXT_MESSAGE = """【环境信息】（系统自动附加，不是用户输入）
+现在的时间是：{NOW}。
+在此之前用户有可能创建了一系列的定时或每日自动执行的脚本任务，任务的内容如下：
+
+{TASK}"""
+
+# 默认：一条消息只调用一个工具
+WORKFLOW_SERIAL = """1. 当任务需要工具时，先用中文说明【整体计划】；  
+   例如：“好的，我将先查询温哥华的天气，然后把结果保存成 weather.json。”  
+2. **同一条消息**里仅 **调用一个** tool（一次只能调用一个 tool）。  
+3. 获得工具返回值后：  
+   - 用中文总结当前进展，并决定下一步；  
+   - 若还需其他工具，重复步骤 1–2；  
+   - 若已完成所有步骤，则给出最终总结并结束。
+
+⚠️ **禁止** 跳过步骤，也不要在一条消息里触发多个互相关联的工具。"""
+
+# 并行模式（侧边栏开启）：互不依赖的工具可以在同一条消息里一起调用
+WORKFLOW_PARALLEL = """1. 当任务需要工具时，先用中文说明【整体计划】；  
+   例如：“好的，我将同时查询温哥华的天气和比特币价格，然后把结果保存成 weather.json。”  
+2. **互不依赖** 的工具调用（如同时查天气、查币价、搜网页）请放在 **同一条消息** 里一起调用，它们会被并发执行；  
+   **有依赖** 的调用（后一个需要前一个的返回值，例如先查询再保存）必须分到不同的消息里依次调用。  
+3. 获得工具返回值后：  
+   - 用中文总结当前进展，并决定下一步；  
+   - 若还需其他工具，重复步骤 1–2；  
+   - 若已完成所有步骤，则给出最终总结并结束。
+
+⚠️ **禁止** 跳过步骤，也不要把互相关联的工具放在同一条消息里。"""
+
+
+def build_system_message(tool_desc: str, parallel: bool) -> str:
+    workflow = WORKFLOW_PARALLEL if parallel else WORKFLOW_SERIAL
+    return SYSTEM_MESSAGE.replace("{WORKFLOW}", workflow).replace("{TOOLS}", tool_desc)
+
+
+def build_context_message() -> str:
+    """每轮提问时重新生成：当前时间和最新的定时任务列表"""
+    return (
+        CONTEXT_MESSAGE
+        .replace("{NOW}", datetime.datetime.now().strftime('%Y-%m-%d %H:%M'))
+        .replace("{TASK}", get_task())
+    )
@@ -0,0 +1,179 @@
+import json
+import math
+import re
+from collections import Counter
+
+WORD_RE = re.compile(r"[a-z0-9_]+")
+CJK_RUN_RE = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff]+")
+
+# 查询里去掉的常见词：英文虚词；中文按单字（含这些字的 bigram 都去掉）和常见的提问用语
+STOPWORDS = set(
+    "a an the is are was were be been being am do does did to of in on at for from by with about as into "
+    "and or but if then than so not no it its this that these those there here i me my we our you your he she "
+    "they them their what which who whom whose when where why how can could would should will shall may might "
+    "must have has had just also very too please tell show give like any some all".split()
+)
+CJK_STOP_CHARS = set("的了是吗呢吧啊呀么我你他她它在和与或也都就还又很")
+CJK_STOP_BIGRAMS = {
+    "什么", "怎么", "怎样", "为何", "哪里", "哪些", "哪个", "如何", "可以", "能否", "是否", "应该",
+    "一下", "一个", "这个", "那个", "这些", "那些", "我们", "你们", "他们", "现在", "今天", "请问", "帮我",
+}
+
+SEARCH_TOOL_NAME = "search_uploaded_documents"
+SEARCH_TOOL = {
+    "type": "function",
+    "function": {
+        "name": SEARCH_TOOL_NAME,
+        "description": "在用户本次会话上传的文档（PDF / txt / md / py）里按关键词检索，返回最相关的若干片段及其出处",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "query": {"type": "string", "description": "检索关键词或问题"},
+                "top_k": {"type": "integer", "description": "返回片段数量，默认 4"},
+            },
+            "required": ["query"],
+        },
+    },
+}
+
+
+def tokenize(text: str) -> list[str]:
+    """英文 / 数字按单词切分；中文没有空格，按相邻两字（bigram）切分，单字词保留单字"""
+    text = text.lower()
+    terms = WORD_RE.findall(text)
+    for run in CJK_RUN_RE.findall(text):
+        if len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+
+def query_terms(text: str) -> list[str]:
+    """检索用的查询词：tokenize() 之后去掉停用词，避免“is / the / 怎么”这类词把不相关的片段也匹配上"""
+    return [
+        t for t in tokenize(text)
+        if not (len(t) == 1 and t.isascii())  # what's -> s
+        and t not in STOPWORDS and t not in CJK_STOP_BIGRAMS and not (set(t) & CJK_STOP_CHARS)
+    ]
+
+
+def chunk_text(text: str, max_chars: int = 800, overlap: int = 100) -> list[str]:
+    """按段落打包成不超过 max_chars 的片段；单个段落过长时硬切，并保留 overlap 个字符的重叠"""
+    chunks, current = [], ""
+    for para in re.split(r"\n\s*\n", text):
+        para = para.strip()
+        if not para:
+            continue
+        if current and len(current) + len(para) + 2 > max_chars:
+            chunks.append(current)
+            current = ""
+        while len(para) > max_chars:
+            chunks.append(para[:max_chars])
+            para = para[max_chars - overlap:]
+        current = f"{current}\n\n{para}" if current else para
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class BM25:
+    """最简 BM25：add() 逐条加入已切好词的文本，scores() 返回每条的得分"""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._tf: list[Counter] = []
+        self._len: list[int] = []
+        self._df: Counter = Counter()
+        self._total_len = 0
+
+    def __len__(self):
+        return len(self._tf)
+
+    def add(self, terms: list[str]):
+        tf = Counter(terms)
+        self._tf.append(tf)
+        self._len.append(len(terms))
+        self._df.update(tf.keys())
+        self._total_len += len(terms)
+
+    def matched(self, index: int, query_terms) -> int:
+        """第 index 条文本命中了几个不同的查询词"""
+        tf = self._tf[index]
+        return sum(1 for t in set(query_terms) if t in tf)
+
+    def scores(self, query_terms) -> list[float]:
+        n = len(self._tf)
+        terms = set(query_terms)
+        if not n or not terms:
+            return [0.0] * n
+        avg_len = self._total_len / n or 1
+        idf = {t: math.log(1 + (n - self._df[t] + 0.5) / (self._df[t] + 0.5)) for t in terms if self._df[t]}
+
+        result = []
+        for tf, length in zip(self._tf, self._len):
+            score = 0.0
+            for t, w in idf.items():
+                f = tf.get(t)
+                if f:
+                    score += w * f * (self.k1 + 1) / (f + self.k1 * (1 - self.b + self.b * length / avg_len))
+            result.append(score)
+        return result
+
+
+class DocumentIndex:
+    """
+    单个会话上传文档的本地检索索引（BM25，不需要网络和模型）：
+    - add() 时切片并建立倒排统计；
+    - search() 按 BM25 打分返回 top-k 片段；
+    - 同时作为本地工具 search_uploaded_documents 提供给模型做后续查询。
+    """
+
+    def __init__(self):
+        self.chunks: list[dict] = []  # {"doc", "index", "text"}
+        self.docs: dict[str, int] = {}  # 文档名 -> 片段数
+        self._bm25 = BM25()
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def add(self, doc: str, text: str) -> int:
+        pieces = chunk_text(text)
+        for n, piece in enumerate(pieces):
+            self.chunks.append({"doc": doc, "index": n, "text": piece})
+            self._bm25.add(tokenize(piece))
+        self.docs[doc] = self.docs.get(doc, 0) + len(pieces)
+        return len(pieces)
+
+    def search(self, query: str, top_k: int = 4, min_coverage: float = 0.0) -> list[dict]:
+        """
+        min_coverage：片段至少要命中这个比例的（不同的）查询词，用来在自动附带片段时
+        挡掉只沾上一两个词的结果；模型主动检索时不限制。
+        """
+        terms = query_terms(query)
+        need = max(1, math.ceil(len(set(terms)) * min_coverage))
+        scored = [
+            (score, i) for i, score in enumerate(self._bm25.scores(terms))
+            if score > 0 and self._bm25.matched(i, terms) >= need
+        ]
+        scored.sort(reverse=True)
+        return [{**self.chunks[i], "score": round(score, 3)} for score, i in scored[:top_k]]
+
+    def leading(self, doc: str, count: int) -> list[dict]:
+        """某个文档开头的若干片段；用户只传文件、没提问题时用它代替检索"""
+        return [c for c in self.chunks if c["doc"] == doc][:count]
+
+    def run_tool(self, args: dict) -> str:
+        hits = self.search(args.get("query", ""), int(args.get("top_k") or 4))
+        if not hits:
+            return json.dumps({"result": "没有找到相关内容", "documents": list(self.docs)}, ensure_ascii=False)
+        return json.dumps({"result": hits}, ensure_ascii=False)
+
+    def as_tools(self) -> dict:
+        """交给 MCPAgent(local_tools=...) 的本地工具表：name -> (schema, handler)"""
+        return {SEARCH_TOOL_NAME: (SEARCH_TOOL, self.run_tool)}
+
+
+def format_chunks(chunks: list[dict]) -> str:
+    return "\n\n".join(f"[{c['doc']} #{c['index']}]\n{c['text']}" for c in chunks)
@@ -0,0 +1,158 @@
+import asyncio
+import threading
+from collections import Counter, OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+from core.llm_resilience import LatencyStats
+from core.mcp_pool import LoopThread, MCPSession
+
+
+async def _warm_up(client: AsyncOpenAI):
+    try:
+        await client.models.list()
+    except Exception:
+        pass  # 预热失败不影响使用，真正请求时会再报错
+
+
+class FairLimiter:
+    """
+    全局并发上限 + 每个用户的并发上限。
+    有空位时按用户轮转放行：某个用户一次性提交很多请求，也不会让其他用户一直排在后面。
+    只能在同一个事件循环里使用。
+    """
+
+    def __init__(self, total: int, per_user: int):
+        self.total = total
+        self.per_user = per_user
+        self.active: Counter = Counter()  # user -> 正在执行的数量
+        self._waiters: OrderedDict[str, deque[asyncio.Future]] = OrderedDict()  # 按轮转顺序排列
+
+    @property
+    def running(self) -> int:
+        return sum(self.active.values())
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(q) for q in self._waiters.values())
+
+    def _can_run(self, user: str) -> bool:
+        return self.running < self.total and self.active[user] < self.per_user
+
+    async def acquire(self, user: str):
+        if not self._waiters and self._can_run(user):
+            self.active[user] += 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(user, deque()).append(fut)
+        self._dispatch()  # 排在前面的用户可能都卡在自己的上限上，此时可以直接放行
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release(user)  # 已经分到了名额但调用方被取消，还回去
+            else:
+                self._forget(user, fut)
+            raise
+
+    def release(self, user: str):
+        self.active[user] -= 1
+        if self.active[user] <= 0:
+            del self.active[user]
+        self._dispatch()
+
+    def _forget(self, user: str, fut: asyncio.Future):
+        queue = self._waiters.get(user)
+        if queue is not None and fut in queue:
+            queue.remove(fut)
+            if not queue:
+                del self._waiters[user]
+
+    def _dispatch(self):
+        progressed = True
+        while progressed and self._waiters and self.running < self.total:
+            progressed = False
+            for user in list(self._waiters):
+                queue = self._waiters[user]
+                while queue and queue[0].done():
+                    queue.popleft()  # 已被取消、还没来得及自己出队的等待者
+                if not queue:
+                    del self._waiters[user]
+                    continue
+                if not self._can_run(user):
+                    continue
+                fut = queue.popleft()
+                if not queue:
+                    del self._waiters[user]
+                else:
+                    self._waiters.move_to_end(user)  # 放行一个后排到队尾，轮到下一个用户
+                self.active[user] += 1
+                fut.set_result(None)
+                progressed = True
+                break
+
+    @asynccontextmanager
+    async def slot(self, user: str):
+        await self.acquire(user)
+        try:
+            yield
+        finally:
+            self.release(user)
+
+
+class SharedRuntime:
+    """
+    多用户模式下的进程级资源（由 st.cache_resource 持有）：
+    - 一个共享的后台事件循环，所有会话的 Agent 都跑在上面；
+    - 所有 LLM 客户端（不同 API Key）共用一个 httpx 连接池；
+    - 同一个 MCP endpoint 只保持一条长连接，所有会话复用；
+    - LLM 请求与工具调用分别受全局 / 每用户并发上限约束，并按用户公平排队。
+    """
+
+    def __init__(self, max_llm: int = 16, max_llm_per_user: int = 2,
+                 max_tools: int = 32, max_tools_per_user: int = 4, keepalive: float = 30.0):
+        self.keepalive = keepalive
+        self.runner = LoopThread(name="shared-loop")
+        self.llm_limiter = FairLimiter(max_llm, max_llm_per_user)
+        self.tool_limiter = FairLimiter(max_tools, max_tools_per_user)
+        self.llm_stats = LatencyStats()
+
+        self._http = None
+        self._llm_clients: dict[tuple[str, str], AsyncOpenAI] = {}
+        self._sessions: dict[str, MCPSession] = {}
+        self._lock = threading.Lock()
+        self.runner.run(self._init())
+
+    async def _init(self):
+        # httpx 的连接池要在它所服务的事件循环里创建；同时在途的请求数由 llm_limiter 控制，
+        # 连接数不会超过 max_llm
+        self._http = DefaultAsyncHttpxClient()
+
+    def llm(self, api_key: str, base_url: str) -> AsyncOpenAI:
+        with self._lock:
+            client = self._llm_clients.get((api_key, base_url))
+            if client is None:
+                client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=self._http,
+                                     max_retries=0)
+                self._llm_clients[(api_key, base_url)] = client
+                self.runner.submit(_warm_up(client))
+            return client
+
+    def session(self, url: str) -> MCPSession:
+        """按 url 复用 MCP 长连接；需在共享事件循环里调用"""
+        session = self._sessions.get(url)
+        if session is None:
+            session = MCPSession(url, keepalive=self.keepalive)
+            session.start()
+            self._sessions[url] = session
+        return session
+
+    def stats(self) -> dict:
+        return {
+            "llm_running": self.llm_limiter.running,
+            "llm_waiting": self.llm_limiter.waiting,
+            "tools_running": self.tool_limiter.running,
+            "tools_waiting": self.tool_limiter.waiting,
+            "mcp_sessions": len(self._sessions),
+        }
@@ -0,0 +1,79 @@
+import json
+import uuid
+
+
+class StreamedReply:
+    """
+    逐个消费 chat.completions.create(stream=True) 的 chunk：
+    - feed() 返回本 chunk 的文本增量，调用方可以立即渲染；
+    - 同时把分散在多个 chunk 里的 tool_call 片段拼回完整调用，
+      每拼好一个就立刻回调 on_tool_call(position, call)，方便提前开始执行工具；
+    - 流结束后调用 close() 收尾最后一个调用。
+    """
+
+    def __init__(self, on_tool_call=None):
+        self.on_tool_call = on_tool_call
+
+        self.content = ""
+        self.tool_calls: list[dict] = []
+        self.finish_reason = None
+        self.usage = None  # stream_options={"include_usage": True} 时最后一个 chunk 带用量
+
+        self._partial: dict[int, dict] = {}  # index -> 正在拼接中的调用
+        self._open: int | None = None
+
+    def feed(self, chunk) -> str:
+        if getattr(chunk, "usage", None) is not None:
+            self.usage = chunk.usage
+        if not chunk.choices:
+            return ""
+        choice = chunk.choices[0]
+        delta = choice.delta
+
+        for tc in delta.tool_calls or []:
+            self._feed(tc)
+        if choice.finish_reason:
+            self.finish_reason = choice.finish_reason
+
+        if delta.content:
+            self.content += delta.content
+            return delta.content
+        return ""
+
+    def close(self):
+        if self._open is not None:
+            self._complete(self._open)
+
+    def _feed(self, tc):
+        # 有的兼容接口不给 index，此时每个片段都当作一个完整的新调用
+        index = tc.index if tc.index is not None else len(self._partial)
+        if index != self._open:
+            if self._open is not None:
+                self._complete(self._open)  # 出现了下一个调用，上一个一定已经拼完
+            self._open = index
+            self._partial[index] = {"id": "", "name": "", "arguments": ""}
+
+        part = self._partial[index]
+        if tc.id:
+            part["id"] = tc.id
+        if tc.function is not None:
+            if tc.function.name:
+                part["name"] += tc.function.name
+            if tc.function.arguments:
+                part["arguments"] += tc.function.arguments
+
+    def _complete(self, index: int):
+        part = self._partial[index]
+        call = {
+            "id": part["id"] or f"call_{uuid.uuid4().hex[:24]}",
+            "type": "function",
+            "function": {"name": part["name"], "arguments": part["arguments"] or "{}"},
+        }
+        self._open = None
+        self.tool_calls.append(call)
+        if self.on_tool_call is not None:
+            self.on_tool_call(len(self.tool_calls) - 1, call)
+
+
+def parse_arguments(call: dict) -> dict:
+    return json.loads(call["function"]["arguments"] or "{}")
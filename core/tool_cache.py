@@ -0,0 +1,75 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+def tool_cache_key(name: str, args: dict) -> str:
+    """工具名 + 规范化后的参数（键排序、去掉多余空白）"""
+    return name + "\x00" + json.dumps(args, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+
+
+class ToolResultCache:
+    """
+    工具结果缓存（进程内、线程安全）：
+    - 每个条目带过期时间，TTL 由调用方按工具传入；
+    - 超过 max_entries 时按 LRU 淘汰；
+    - 同一个 key 还在执行时，后来的相同调用直接复用那次调用的 task（同一轮内去重）。
+    """
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()  # key -> (过期时间, content)
+        self._inflight: dict = {}  # key -> 正在执行的 task/future
+        self._lock = threading.Lock()
+
+    def lookup(self, key: str):
+        """
+        命中缓存返回 (content, None)；
+        相同调用还在执行返回 (None, 那次调用的 task/future)；
+        未命中返回 (None, None)。
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1], None
+                del self._entries[key]
+            if key in self._inflight:
+                self.hits += 1
+                return None, self._inflight[key]
+            self.misses += 1
+            return None, None
+
+    def track(self, key: str, future):
+        with self._lock:
+            self._inflight[key] = future
+        future.add_done_callback(lambda _: self._untrack(key, future))
+
+    def _untrack(self, key: str, future):
+        with self._lock:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+
+    def put(self, key: str, content: str, ttl: float):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, content)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        有副作用的工具执行后清空所有缓存结果：
+        写文件的不只是文件系统服务（画图、执行代码、转 GIF 也会落盘），只清同一服务的不够。
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,46 @@
+from core.retrieval import BM25, tokenize
+
+
+def _tool_terms(schema: dict) -> list[str]:
+    """工具名（按下划线拆开）+ 描述 + 参数名和参数描述"""
+    fn = schema["function"]
+    parts = [fn["name"].replace("_", " "), fn.get("description") or ""]
+    for name, prop in ((fn.get("parameters") or {}).get("properties") or {}).items():
+        parts.append(name.replace("_", " "))
+        parts.append(str(prop.get("description", "")))
+    return tokenize(" ".join(parts))
+
+
+class ToolRouter:
+    """
+    每轮对话只把相关的工具发给模型：
+    - 用 BM25 在工具名、描述、参数上给本轮提问打分，取前 top_k 个；
+    - 本会话已经用过的、之前发过的（sticky）、pinned 里的工具（前端渲染、本地工具等）总是保留；
+    - 一个都匹配不上（“继续”“好的”这类追问）时沿用 sticky；还没有 sticky，或者工具总数本来就不多时，
+      退回完整列表。
+    返回的子集保持原列表顺序，同一组工具生成的请求参数是稳定的。
+    """
+
+    def __init__(self, tools: list[dict], top_k: int = 12, pinned: set[str] | None = None):
+        self.tools = tools
+        self.top_k = top_k
+        self.pinned = pinned or set()
+        self._bm25 = BM25()
+        for schema in tools:
+            self._bm25.add(_tool_terms(schema))
+
+    def select(self, query: str, used: set[str], sticky: set[str] | None = None) -> list[dict]:
+        if self.top_k <= 0 or len(self.tools) <= self.top_k:
+            return self.tools
+        sticky = sticky or set()
+        scores = self._bm25.scores(tokenize(query))
+        ranked = sorted(((s, i) for i, s in enumerate(scores) if s > 0), key=lambda x: (-x[0], x[1]))
+        if not ranked and not sticky:
+            return self.tools
+
+        keep = {i for _, i in ranked[:self.top_k]}
+        keep.update(
+            i for i, schema in enumerate(self.tools)
+            if schema["function"]["name"] in used | sticky | self.pinned
+        )
+        return [schema for i, schema in enumerate(self.tools) if i in keep]
@@ -0,0 +1,123 @@
+import contextlib
+import contextvars
+import json
+import math
+import os
+import threading
+import time
+from collections import deque
+from pathlib import Path
+
+_current: contextvars.ContextVar["Span | None"] = contextvars.ContextVar("current_span", default=None)
+
+
+def percentile(values, pct: float) -> float:
+    """最近秩法分位数；没有样本时返回 0"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+class Span:
+    __slots__ = ("name", "key", "trace_id", "span_id", "parent_id", "attributes", "start_ns", "error")
+
+    def __init__(self, name: str, key: str | None, parent: "Span | None", attributes: dict):
+        self.name = name
+        self.key = key
+        self.trace_id = parent.trace_id if parent is not None else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+
+class Tracer:
+    """
+    进程级的轻量 tracing（由 st.cache_resource 持有，所有会话共享）：
+    - span() 记录一段耗时，父子关系通过 contextvars 传递，asyncio 任务会自动继承；
+    - 每个 span 结束时按 OTLP JSON 的字段名追加一行到 directory/traces-YYYYMMDD.jsonl；
+    - 按 (span 名, key) 保留最近 window 个耗时，summary() 给侧边栏算 p50 / p95。
+    directory 为 None 时只做内存统计。
+    """
+
+    def __init__(self, directory: Path | None = None, window: int = 500):
+        self.directory = Path(directory) if directory else None
+        if self.directory is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+        self.window = window
+        self._lock = threading.Lock()
+        self._durations: dict[tuple[str, str], deque[float]] = {}
+        self._errors: dict[tuple[str, str], int] = {}
+        self._file = None
+        self._file_day = None
+
+    @contextlib.contextmanager
+    def span(self, name: str, key: str | None = None, parent: Span | None = None, **attributes):
+        """key 是统计维度（模型名、server/tool 等）；parent 缺省时取当前上下文里的 span"""
+        span = Span(name, key, parent if parent is not None else _current.get(), attributes)
+        token = _current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _current.reset(token)
+            self._finish(span)
+
+    def _finish(self, span: Span):
+        end_ns = time.time_ns()
+        stat_key = (span.name, span.key or "")
+        with self._lock:
+            durations = self._durations.get(stat_key)
+            if durations is None:
+                durations = self._durations[stat_key] = deque(maxlen=self.window)
+            durations.append((end_ns - span.start_ns) / 1e6)
+            if span.error is not None:
+                self._errors[stat_key] = self._errors.get(stat_key, 0) + 1
+            if self.directory is not None:
+                self._write(span, end_ns)
+
+    def _write(self, span: Span, end_ns: int):
+        record = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "parentSpanId": span.parent_id or "",
+            "name": span.name,
+            "startTimeUnixNano": span.start_ns,
+            "endTimeUnixNano": end_ns,
+            "attributes": {"key": span.key, **span.attributes} if span.key else span.attributes,
+            "status": {"code": "ERROR", "message": span.error} if span.error else {"code": "OK"},
+        }
+        day = time.strftime("%Y%m%d")
+        if day != self._file_day:
+            if self._file is not None:
+                self._file.close()
+            self._file = open(self.directory / f"traces-{day}.jsonl", "a", encoding="utf-8", buffering=1)
+            self._file_day = day
+        self._file.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+
+    def summary(self, prefix: str = "") -> list[dict]:
+        """每个 (span 名, key) 的次数、失败数和 p50 / p95 毫秒数，按 p95 从慢到快排列"""
+        with self._lock:
+            items = [(k, list(v)) for k, v in self._durations.items() if k[0].startswith(prefix)]
+            errors = dict(self._errors)
+        rows = [
+            {
+                "name": name,
+                "key": key,
+                "count": len(values),
+                "errors": errors.get((name, key), 0),
+                "p50_ms": round(percentile(values, 50), 1),
+                "p95_ms": round(percentile(values, 95), 1),
+            }
+            for (name, key), values in items
+        ]
+        rows.sort(key=lambda r: -r["p95_ms"])
+        return rows
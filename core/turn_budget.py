@@ -0,0 +1,67 @@
+import time
+
+# 预算项 -> 给用户和模型看的名称、单位
+LIMIT_LABELS = {
+    "steps": ("工具调用轮数", " 轮"),
+    "tokens": ("token 用量", " tokens"),
+    "seconds": ("耗时", " 秒"),
+}
+
+
+class TurnBudget:
+    """
+    一轮对话（用户的一次提问）的预算：调用工具的轮数、LLM 消耗的 token、墙钟耗时。
+    - 某一项用到 warn_ratio 时，warnings() 返回它一次，Agent 借此提醒模型开始收尾；
+    - 任一项用完后 exhausted() 返回它，Agent 不再提供工具，强制模型根据已有结果作答。
+    上限为 None / 0 表示这一项不限制。
+    """
+
+    def __init__(self, max_steps: int | None = None, max_tokens: int | None = None,
+                 max_seconds: float | None = None, warn_ratio: float = 0.8):
+        self.limits = {"steps": max_steps, "tokens": max_tokens, "seconds": max_seconds}
+        self.warn_ratio = warn_ratio
+        self.start = time.monotonic()
+        self.steps = 0
+        self.tokens = 0
+        self._warned: set[str] = set()
+
+    def record(self, tokens: int):
+        """一次 LLM 请求结束：累计输入 + 输出 token"""
+        self.tokens += tokens
+
+    def step(self):
+        """模型又要了一轮工具"""
+        self.steps += 1
+
+    def used(self) -> dict:
+        return {"steps": self.steps, "tokens": self.tokens, "seconds": round(time.monotonic() - self.start, 1)}
+
+    def remaining_seconds(self) -> float | None:
+        """耗时预算还剩多少秒，用来给单次工具调用和 LLM 请求设截止时间；不限耗时时返回 None"""
+        limit = self.limits["seconds"]
+        if not limit:
+            return None
+        return max(round(limit - (time.monotonic() - self.start), 1), 0.0)
+
+    def warnings(self) -> list[tuple[str, float, float]]:
+        """新跨过提醒线的预算项：[(项, 已用, 上限)]，每项只返回一次"""
+        result = []
+        for kind, used in self.used().items():
+            limit = self.limits[kind]
+            if limit and kind not in self._warned and used >= limit * self.warn_ratio:
+                self._warned.add(kind)
+                result.append((kind, used, limit))
+        return result
+
+    def exhausted(self) -> tuple[str, float, float] | None:
+        """第一个用完的预算项 (项, 已用, 上限)；都还有余量时返回 None"""
+        for kind, used in self.used().items():
+            limit = self.limits[kind]
+            if limit and used >= limit:
+                return kind, used, limit
+        return None
+
+
+def describe(kind: str, used: float, limit: float) -> str:
+    label, unit = LIMIT_LABELS[kind]
+    return f"{label} {used:g}/{limit:g}{unit}"
@@ -0,0 +1,11 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "bench"))
+
+import import_time  # noqa: E402
+
+
+def test_client_import_time_within_budget():
+    """client.py 顶层导入不超过 IMPORT_TIME_BUDGET_MS（默认 800 ms），也没有在顶层导入重依赖"""
+    assert import_time.main([]) == 0